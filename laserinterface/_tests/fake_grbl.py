@@ -0,0 +1,336 @@
+''' A fake grbl on a tcp port, to stream jobs without a machine. It has the
+rx buffer and planner of grbl 1.1: lines are acknowledged when they move
+into the planner, the planner finishes a block every block_ms. Jog lines
+($J=) take the time of their distance at their feed, without acceleration,
+and are dropped by a jog cancel (0x85). The feed and spindle overrides are
+kept between 10 and 200% and reported in the Ov field. Connect with
+the port socket://127.0.0.1:<port>. Start it from the root of the
+repository to measure the throughput of the headless runner with:
+
+    python -m laserinterface._tests.fake_grbl [gcode file] [block ms] '''
+
+from collections import deque
+from threading import Event, Lock, Thread
+import math
+import os
+import re
+import socket
+import sys
+import tempfile
+import time
+
+WELCOME = b"\r\nGrbl 1.1h ['$' for help]\r\n"
+SETTINGS = {
+    '$0': 10, '$1': 25, '$2': 0, '$3': 0, '$4': 0, '$5': 0, '$6': 0,
+    '$10': 1, '$11': 0.010, '$12': 0.002, '$13': 0, '$20': 0, '$21': 0,
+    '$22': 0, '$23': 0, '$24': 25.0, '$25': 500.0, '$26': 250, '$27': 1.0,
+    '$30': 1000, '$31': 0, '$32': 1, '$100': 80.0, '$101': 80.0,
+    '$102': 250.0, '$110': 5000.0, '$111': 5000.0, '$112': 500.0,
+    '$120': 10.0, '$121': 10.0, '$122': 10.0, '$130': 200.0, '$131': 200.0,
+    '$132': 200.0,
+}
+
+# override byte: (index in Ov, change or None for a reset)
+OVERRIDES = {
+    0x90: (0, None), 0x91: (0, 10), 0x92: (0, -10), 0x93: (0, 1),
+    0x94: (0, -1), 0x99: (2, None), 0x9A: (2, 10), 0x9B: (2, -10),
+    0x9C: (2, 1), 0x9D: (2, -1),
+}
+
+
+class FakeGrbl(Thread):
+    def __init__(self, port=0, block_ms=2.0, planner_blocks=15, rx_size=128,
+                 boot_time=0.2, auto_start=True):
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.block_time = block_ms/1000
+        self.boot_time = boot_time
+        self.planner_blocks = planner_blocks
+        self.rx_size = rx_size
+        self.settings = dict(SETTINGS)
+
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', port))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.url = f'socket://127.0.0.1:{self.port}'
+
+        # statistics of the connection, checked by the throughput test
+        self.lines_received = 0
+        self.bytes_received = 0
+        self.reports = 0
+        self.overflows = 0      # bytes lost because the rx buffer was full
+        self.rx_max = 0
+        # statistics of jogging, checked by the jog test
+        self.jog_lines = 0
+        self.jog_cancelled = None   # time of the last jog cancel
+        self.jog_starved = 0.0      # seconds the planner ran empty in a jog
+        self._jog_empty = None
+        # statistics of the overrides, checked by the override test
+        self.override_bytes = 0
+        self.lose_overrides = 0     # override bytes to drop, like noise
+
+        self.conn = None
+        self._lock = Lock()
+        self._quit = Event()
+        self.reset()
+
+        if auto_start:
+            self.start()
+
+    def reset(self):
+        with self._lock:
+            self.rx = deque()       # complete lines in the rx buffer
+            self.rx_partial = b''
+            self.rx_used = 0
+            self.planner = deque()
+            self.block_done = None  # time the current block is finished
+            self.hold = False
+            self.x = 0.0
+            self.y = 0.0
+            self.ov = [100, 100, 100]   # feed, rapid, spindle
+            self.ov_changed = True
+
+    def run(self):
+        while not self._quit.is_set():
+            try:
+                self.conn, _ = self.server.accept()
+            except OSError:
+                return
+            self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._boot()
+            Thread(target=self._execute, daemon=True).start()
+            self._receive()
+
+    def _boot(self):
+        ''' Opening the port resets the arduino, bytes received while the
+        bootloader runs are lost '''
+        time.sleep(self.boot_time)
+        self.conn.setblocking(False)
+        try:
+            while self.conn.recv(4096):
+                pass
+        except OSError:
+            pass
+        self.conn.setblocking(True)
+        self.reset()
+        self._write(WELCOME)
+
+    def close(self):
+        self._quit.set()
+        for sock in (self.conn, self.server):
+            if sock is not None:
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+
+    def _write(self, data):
+        try:
+            self.conn.sendall(data)
+        except OSError:
+            pass
+
+    def _receive(self):
+        while not self._quit.is_set():
+            try:
+                data = self.conn.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            for byte in data:
+                self._receive_byte(byte)
+
+    def _receive_byte(self, byte):
+        # real-time commands are handled directly, they never enter the buffer
+        if byte == ord('?'):
+            self._write(self._report().encode('ascii'))
+        elif byte == 0x18:
+            self.reset()
+            self._write(WELCOME)
+        elif byte == ord('!'):
+            self.hold = True
+        elif byte == ord('~'):
+            self.hold = False
+        elif byte == 0x85:
+            self._cancel_jog()
+        elif byte in OVERRIDES:
+            self._override(byte)
+        elif byte >= 0x80:
+            pass    # overrides
+        elif byte == ord('\r'):
+            pass
+        else:
+            with self._lock:
+                if self.rx_used >= self.rx_size:
+                    self.overflows += 1
+                    return
+                self.rx_used += 1
+                self.rx_max = max(self.rx_max, self.rx_used)
+                if byte == ord('\n'):
+                    self.rx.append(self.rx_partial)
+                    self.rx_partial = b''
+                else:
+                    self.rx_partial += bytes((byte,))
+
+    def _report(self):
+        with self._lock:
+            self.reports += 1
+            if self.hold:
+                state = 'Hold:0'
+            elif self.planner and self.planner[0][0].startswith('$J='):
+                state = 'Jog'
+            elif self.planner:
+                state = 'Run'
+            else:
+                state = 'Idle'
+            free = self.planner_blocks - len(self.planner)
+            ov = ''
+            if self.ov_changed or self.reports % 10 == 0:
+                ov = '|Ov:' + ','.join(str(value) for value in self.ov)
+                self.ov_changed = False
+            return (f'<{state}|MPos:{self.x:.3f},{self.y:.3f},0.000|'
+                    f'Bf:{free},{self.rx_size-self.rx_used}|FS:1000,0'
+                    f'{ov}>\r\n')
+
+    def _override(self, byte):
+        with self._lock:
+            self.override_bytes += 1
+            if self.lose_overrides:
+                self.lose_overrides -= 1
+                return
+            index, change = OVERRIDES[byte]
+            value = 100 if change is None else self.ov[index] + change
+            self.ov[index] = min(max(value, 10), 200)
+            self.ov_changed = True
+
+    def _execute(self):
+        ''' Moves lines from the rx buffer into the planner and finishes
+        blocks, like the main loop of grbl '''
+        conn = self.conn
+        while not self._quit.is_set() and self.conn is conn:
+            replies = []
+            with self._lock:
+                now = time.perf_counter()
+                if self.planner and not self.hold:
+                    line, duration, dx, dy = self.planner[0]
+                    if self.block_done is None:
+                        self.block_done = now + duration
+                    elif now >= self.block_done:
+                        self.planner.popleft()
+                        self.x += dx
+                        self.y += dy
+                        self.block_done = None
+                        if not self.planner and line.startswith('$J='):
+                            self._jog_empty = now
+
+                while self.rx and len(self.planner) < self.planner_blocks:
+                    line = self.rx.popleft()
+                    self.rx_used -= len(line)+1
+                    self.lines_received += 1
+                    self.bytes_received += len(line)+1
+                    replies.append(self._handle_line(line.decode('ascii')))
+            for reply in replies:
+                self._write(reply.encode('ascii'))
+            time.sleep(0.0002)
+
+    def _cancel_jog(self):
+        ''' Stops at once (no deceleration) and drops the jog lines in the
+        planner, the lines in the rx buffer are still executed '''
+        with self._lock:
+            if not self.planner or not self.planner[0][0].startswith('$J='):
+                return
+            if self.block_done is not None:
+                _, duration, dx, dy = self.planner[0]
+                done = 1 - max(self.block_done-time.perf_counter(), 0)/duration
+                self.x += dx*done
+                self.y += dy*done
+            self.planner.clear()
+            self.block_done = None
+            self.jog_cancelled = time.perf_counter()
+            self._jog_empty = None
+        # statistics of the overrides, checked by the override test
+        self.override_bytes = 0
+        self.lose_overrides = 0     # override bytes to drop, like noise
+
+    def _jog(self, line):
+        words = dict(re.findall(r'([A-Z])(-?[\d.]+)', line[3:]))
+        dx, dy = float(words.get('X', 0)), float(words.get('Y', 0))
+        if 'G90' in line:
+            dx, dy = dx-self.x, dy-self.y
+        feed = float(words.get('F', 0))
+        if not feed:
+            return 'error:22\r\n'
+        now = time.perf_counter()
+        if self._jog_empty is not None:
+            self.jog_starved += now - self._jog_empty
+            self._jog_empty = None
+        # statistics of the overrides, checked by the override test
+        self.override_bytes = 0
+        self.lose_overrides = 0     # override bytes to drop, like noise
+        self.jog_lines += 1
+        self.planner.append((line, math.hypot(dx, dy)/(feed/60), dx, dy))
+        return 'ok\r\n'
+
+    def _handle_line(self, line):
+        if line.startswith('$J='):
+            return self._jog(line)
+        if line == '$$':
+            return ''.join(f'{key}={value}\r\n'
+                           for key, value in self.settings.items()) + 'ok\r\n'
+        if line.startswith('$') and '=' in line:
+            key, value = line.split('=')
+            if key not in self.settings:
+                return 'error:3\r\n'
+            self.settings[key] = value
+            return 'ok\r\n'
+        if line and line[0] in 'GMXYZFS':
+            if line[0] == 'G' or line[0] in 'XYZ':
+                self.planner.append((line, self.block_time, 0.1, 0.0))
+            return 'ok\r\n'
+        return 'error:1\r\n' if line else 'ok\r\n'
+
+
+def _test_file(lines=2000):
+    handle, filename = tempfile.mkstemp(suffix='.nc', prefix='fake_grbl_')
+    with os.fdopen(handle, 'w') as file:
+        file.write('(throughput test)\nG21\nG90\nM4 S0\n')
+        for i in range(lines):
+            file.write(f'G1 X{i%100*0.1234567:.6f} Y{i%37*0.7654321:.6f} '
+                       f'S{i%1000} F3000\n')
+        file.write('M5\n')
+    return filename
+
+
+if __name__ == '__main__':
+    from laserinterface.headless import HeadlessRunner
+
+    filename = sys.argv[1] if len(sys.argv) > 1 else None
+    block_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    generated = filename is None
+    if generated:
+        filename = _test_file()
+
+    grbl = FakeGrbl(block_ms=block_ms)
+    runner = HeadlessRunner(port=grbl.url, use_gpio=False, json_lines=True,
+                            interval=1.0)
+    try:
+        start_cpu = time.process_time()
+        results = runner.run([filename])
+        cpu = time.process_time()-start_cpu
+    finally:
+        runner.close()
+        grbl.close()
+        if generated:
+            os.remove(filename)
+
+    result = results[0]
+    print(f'{grbl.lines_received} lines received in {result["duration"]:.2f}s'
+          f' ({grbl.lines_received/max(result["duration"], 1e-9):.0f} '
+          f'lines/s), cpu {cpu:.2f}s, rx buffer max {grbl.rx_max} bytes, '
+          f'{grbl.overflows} bytes lost', file=sys.stderr)
+    assert result['status'] == 'done'
+    assert grbl.overflows == 0, 'the rx buffer of grbl overflowed'
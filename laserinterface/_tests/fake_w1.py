@@ -0,0 +1,81 @@
+''' A fake 1-wire sysfs tree to run the TemperatureService without sensors.
+Start it from the root of the repository to check the service with:
+
+    python -m laserinterface._tests.fake_w1 '''
+
+import os
+import shutil
+import tempfile
+import time
+
+from laserinterface.helpers.temperature import TemperatureService
+
+
+class FakeW1Bus():
+    def __init__(self, directory=None):
+        self.directory = directory or tempfile.mkdtemp(prefix='w1_')
+
+    def add_sensor(self, name, temp_c=20.0):
+        os.makedirs(os.path.join(self.directory, name), exist_ok=True)
+        self.set_temp(name, temp_c)
+
+    def remove_sensor(self, name):
+        shutil.rmtree(os.path.join(self.directory, name))
+
+    def set_temp(self, name, temp_c, crc_ok=True):
+        ''' Write a w1_slave file like the w1-therm kernel module '''
+        milli = int(round(temp_c*1000))
+        raw = milli*16//1000 & 0xffff
+        data = f'{raw & 0xff:02x} {raw >> 8:02x} 4b 46 7f ff 0c 10 1c'
+        with open(os.path.join(self.directory, name, 'w1_slave'), 'w') as f:
+            f.write(f'{data} : crc=1c {"YES" if crc_ok else "NO"}\n')
+            f.write(f'{data} t={milli}\n')
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    bus = FakeW1Bus()
+    updates = []
+    service = TemperatureService(
+        updates.append, device_dir=bus.directory, read_interval=0.05,
+        retry_delay=0.01, scan_delay_max=0.2, rate_window=1,
+        predict_seconds=1, stale_after=0.5, load_modules=False)
+    try:
+        # no sensor yet, the service has to back off instead of spinning
+        time.sleep(0.5)
+        print(f'without sensors: {len(updates)} updates in 0.5s, '
+              f'temperature {service.temperature}')
+        assert len(updates) < 10 and service.temperature is None
+        assert not service.has_read     # no sensor yet, not a lost reading
+
+        bus.add_sensor('28-000000000001', 20.0)
+        bus.add_sensor('28-000000000002', 21.0)
+        time.sleep(0.3)
+        print(f'two sensors: {service.cached()}')
+        assert service.temperature == 21.0 and service.has_read
+
+        # a failing crc keeps the last good value
+        bus.set_temp('28-000000000002', 30.0, crc_ok=False)
+        time.sleep(0.2)
+        assert service.temperature == 21.0
+
+        # a rising temperature is predicted ahead
+        for i in range(10):
+            bus.set_temp('28-000000000001', 22.0+i)
+            time.sleep(0.05)
+        print(f'rising: temperature {service.temperature:.2f}, '
+              f'predicted {service.predicted:.2f}')
+        assert service.predicted > service.temperature
+
+        # without good readings the values get stale
+        bus.remove_sensor('28-000000000001')
+        bus.remove_sensor('28-000000000002')
+        time.sleep(0.7)
+        print(f'removed: temperature {service.temperature}')
+        assert service.temperature is None and service.has_read
+        print('ok')
+    finally:
+        service.close()
+        bus.close()
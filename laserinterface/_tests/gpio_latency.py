@@ -0,0 +1,95 @@
+''' Measures the time from an input change until the feed hold is written to
+the serial port, once with polled inputs and once with edge detection. Uses
+the mimiced gpio library and a loopback serial port, so it runs on any
+machine. Start it from the root of the repository with:
+
+    python -m laserinterface._tests.gpio_latency [max p99 in ms]
+
+When a max p99 is given, the script fails if edge detection is slower. The
+traces of the latencies are written to the temp directory. '''
+
+import copy
+import os
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+import serial
+
+from laserinterface._tests.mimic_gpio import GPIO_mimic
+
+# use the mimiced gpio library, even if the config asks for the real one
+GPIO = GPIO_mimic(random_inputs=False)
+sys.modules.setdefault('RPi', types.SimpleNamespace(GPIO=GPIO))
+
+from laserinterface.datamanager.machine import MachineStateManager  # noqa
+from laserinterface.datamanager.terminal import TerminalManager  # noqa
+from laserinterface.helpers import gpiointerface  # noqa
+from laserinterface.helpers.callbackhandler import CallbackHandler  # noqa
+from laserinterface.helpers.grblinterface import GrblInterface  # noqa
+
+gpiointerface.GPIO = GPIO
+gpiointerface.mimic_gpio = True
+gpiointerface.mimic_gpio_change = False
+# a copy of the gpio config, the input mode is changed per measurement
+gpiointerface.config = copy.deepcopy(
+    gpiointerface.config_manager.data['GPIO'])
+
+
+def serial_stand_in(grbl):
+    ''' Replace the serial port of grbl by a loopback, without starting the
+    sender and receiver threads '''
+    grbl.ser = serial.serial_for_url('loop://', timeout=1)
+    grbl.connected = True
+    return grbl
+
+
+def measure(mode, count=50):
+    gpiointerface.config['INPUT_MODE'] = mode
+    machine = MachineStateManager()
+    grbl = serial_stand_in(GrblInterface(TerminalManager(), machine))
+    gpio = gpiointerface.GpioInterface(machine, auto_start=False)
+    gpio.callback = CallbackHandler(grbl=grbl, gpio=gpio)
+    gpio.start()
+
+    name = next(iter(gpiointerface.config['INPUTS']))
+    pin = gpiointerface.config['INPUTS'][name]['PIN']
+
+    latencies = []
+    for i in range(count):
+        # input low is safe, high triggers the IN_ANY_OFF callback
+        GPIO.set_input(pin, False)
+        time.sleep(0.1)
+        grbl.ser.reset_input_buffer()
+        GPIO.set_input(pin, True)
+        while grbl.ser.read(1) != b'!':
+            pass
+        latencies.append((time.time() - GPIO.last_set[pin])*1000)
+        time.sleep(0.02)
+
+    gpio.close()
+    grbl.ser.close()
+    return latencies, machine.latency
+
+
+if __name__ == '__main__':
+    max_p99 = float(sys.argv[1]) if len(sys.argv) > 1 else None
+
+    for mode in ('POLL', 'EDGE'):
+        latencies, tracker = measure(mode)
+        print(f'{mode:>4}: input to hold latency in ms: '
+              f'median={statistics.median(latencies):.2f} '
+              f'max={max(latencies):.2f}')
+        print(f'      detected to written: {tracker.summary()}')
+        trace_file = os.path.join(tempfile.gettempdir(),
+                                  f'safety_latency_{mode.lower()}.txt')
+        tracker.dump(trace_file)
+        print(f'      traces written to {trace_file}')
+
+    if max_p99 is not None:
+        p99 = sorted(latencies)[int(len(latencies)*0.99)-1]
+        if p99 > max_p99:
+            print(f'FAILED: p99 of {p99:.2f}ms exceeds {max_p99}ms')
+            sys.exit(1)
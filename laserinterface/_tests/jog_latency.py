@@ -0,0 +1,89 @@
+''' Holds a jog button of a fake grbl for a while and releases it. Checks
+that the machine moved at the full feed without the planner running empty,
+that with a fast acceleration only a few jog lines were planned, and
+measures the time from the release until grbl received the jog cancel and
+until the machine stopped. Start it from the root of the repository with:
+
+    python -m laserinterface._tests.jog_latency [feed mm/min] [hold seconds]
+        [--process] '''
+
+import os
+import sys
+import time
+
+from laserinterface._tests.fake_grbl import FakeGrbl
+from laserinterface.helpers.machinepool import Station
+
+NAME = 'jog_test'
+
+
+def check(name, condition):
+    print(f'{"ok" if condition else "FAILED"}: {name}')
+    return condition
+
+
+def measure(grbl, station, feed, hold, x, y, max_blocks=None):
+    start_x, start_y = grbl.x, grbl.y
+    lines = grbl.jog_lines
+    starved = grbl.jog_starved
+    max_planned = 0
+
+    station.grbl.jog(x, y, feed)
+    start = time.perf_counter()
+    while time.perf_counter() - start < hold:
+        max_planned = max(max_planned, len(grbl.planner))
+        time.sleep(0.002)
+    released = time.perf_counter()
+    station.grbl.stop_jog()
+    while grbl.planner and time.perf_counter() - released < 2:
+        time.sleep(0.0005)
+    stopped = time.perf_counter()
+    time.sleep(0.3)     # a line on its way is planned and cancelled again
+
+    moved = ((grbl.x-start_x)**2 + (grbl.y-start_y)**2)**0.5
+    expected = min(feed, grbl.settings['$110'])/60*hold
+    cancel = (grbl.jog_cancelled or 0) - released
+    cancel = f'{cancel*1000:.1f}ms' if cancel > 0 else 'never'
+    print(f'moved {moved:.1f}mm of {expected:.1f}mm with '
+          f'{grbl.jog_lines-lines} lines, at most {max_planned} planned, '
+          f'planner empty for {(grbl.jog_starved-starved)*1000:.0f}ms, '
+          f'cancel received after {cancel}, stopped after '
+          f'{(stopped-released)*1000:.1f}ms')
+    ok = check('moved at the full feed', moved > expected*0.9)
+    ok &= check('the planner did not run empty',
+                grbl.jog_starved-starved < 0.05*hold)
+    ok &= check('stopped within 50ms', stopped-released < 0.05)
+    ok &= check('no motion after the stop', not grbl.planner)
+    if max_blocks is not None:
+        ok &= check(f'at most {max_blocks} lines planned',
+                    max_planned <= max_blocks)
+    return ok
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    feed = float(args[0]) if args else 3000
+    hold = float(args[1]) if len(args) > 1 else 1.5
+    process = '--process' in sys.argv
+
+    grbl = FakeGrbl(block_ms=0.5)
+    station = Station(NAME, port=grbl.url, process=process, pooled=False)
+    try:
+        assert station.grbl.connect(), 'could not connect to the fake grbl'
+        ok = measure(grbl, station, feed, hold, 1, 0)
+        ok &= measure(grbl, station, feed, hold/2, -1, 1)
+        ok &= measure(grbl, station, feed*2, hold/3, 0, -1)
+
+        # a fast machine decelerates in a short distance
+        print('acceleration 1000mm/s^2')
+        for key in ('$120', '$121'):
+            grbl.settings[key] = 1000.0
+        station.grbl.get_config()
+        ok &= measure(grbl, station, feed, hold, 1, 1, max_blocks=5)
+    finally:
+        station.grbl.disconnect()
+        grbl.close()
+        config_file = f'laserinterface/data/grbl_config_{NAME}.txt'
+        if os.path.exists(config_file):
+            os.remove(config_file)
+    print('all ok' if ok else 'FAILED')
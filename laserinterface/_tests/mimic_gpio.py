@@ -1,5 +1,5 @@
 from threading import Thread
-from time import sleep
+from time import sleep, time
 import random
 
 
@@ -10,9 +10,18 @@ class GPIO_mimic:
         self.val = {}
         self.state = {}
         self.BOARD = 0
+        self.BCM = 1
         self.IN = 1
         self.OUT = 0
 
+        self.RISING = 1
+        self.FALLING = 2
+        self.BOTH = 3
+
+        self.edge_callbacks = {}    # channel: (edge, callback, bouncetime)
+        self.last_edge = {}         # channel: time of last handled edge
+        self.last_set = {}          # channel: time of last set_input
+
         if random_inputs:
             input_modifier = Thread(target=self.__change_inputs, daemon=True)
             input_modifier.start()
@@ -20,12 +29,31 @@ class GPIO_mimic:
     def __change_inputs(self):
         sleep(2)
         while True:
-            for item in self.state.keys():
+            for item in list(self.state.keys()):
                 if self.state[item] == self.IN:
-                    self.val[item] = random.choice([True, False])
+                    self.set_input(item, random.choice([True, False]))
                 sleep(0.5)
             sleep(3)
 
+    def set_input(self, channel, value):
+        ''' Change an input like the hardware would, calls the edge callbacks
+        in a separate thread just like rpi.gpio does '''
+        old_value = self.val.get(channel)
+        self.val[channel] = value
+        self.last_set[channel] = time()
+        if old_value == value or channel not in self.edge_callbacks:
+            return
+
+        edge, callback, bouncetime = self.edge_callbacks[channel]
+        if edge != self.BOTH and (edge == self.RISING) != bool(value):
+            return
+        now = time()
+        if (now - self.last_edge.get(channel, 0))*1000 < bouncetime:
+            return
+        self.last_edge[channel] = now
+        if callback:
+            Thread(target=callback, args=(channel,), daemon=True).start()
+
     def checkModeValidator(self):
         pass
 
@@ -48,5 +76,13 @@ class GPIO_mimic:
         if(self.state[channel] == self.IN):
             return self.val[channel]
 
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=0):
+        if self.state.get(channel) != self.IN:
+            raise RuntimeError('Failed to add edge detection')
+        self.edge_callbacks[channel] = (edge, callback, bouncetime or 0)
+
+    def remove_event_detect(self, channel):
+        self.edge_callbacks.pop(channel, None)
+
     def cleanup(self):
-        pass
+        self.edge_callbacks = {}
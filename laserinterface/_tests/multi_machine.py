@@ -0,0 +1,80 @@
+''' Streams a job to several fake grbl devices at once with the MachinePool,
+to check that all machines keep their planner filled. The fake grbls run in
+a process of their own. Shows the lines per second of every machine, how
+often its planner ran empty and the cpu time used. Start it from the root of
+the repository with:
+
+    python -m laserinterface._tests.multi_machine [machines] [lines]
+        [block ms] [--process] '''
+
+import multiprocessing
+import os
+import sys
+import time
+
+from laserinterface._tests.fake_grbl import FakeGrbl, _test_file
+from laserinterface.helpers.machinepool import MachinePool
+
+
+def serve_fake_grbls(conn, count, block_ms):
+    grbls = [FakeGrbl(block_ms=block_ms) for _ in range(count)]
+    conn.send([grbl.url for grbl in grbls])
+    conn.recv()     # until the measurement is done
+    conn.send([(grbl.lines_received, grbl.overflows) for grbl in grbls])
+    conn.recv()     # until the machines are disconnected
+    for grbl in grbls:
+        grbl.close()
+
+
+def measure(count, lines, block_ms, process):
+    filename = _test_file(lines)
+    context = multiprocessing.get_context('spawn')
+    conn, child_conn = context.Pipe()
+    fakes = context.Process(target=serve_fake_grbls,
+                            args=(child_conn, count, block_ms), daemon=True)
+    fakes.start()
+    urls = conn.recv()
+
+    pool = MachinePool({f'laser_{nr}': {'PORT': url, 'PROCESS': process,
+                                        'INTERLOCK': True}
+                        for nr, url in enumerate(urls)})
+    try:
+        failed = pool.connect()
+        assert not failed, f'{len(failed)} machines did not connect'
+        start_cpu = time.process_time()
+        start_time = time.perf_counter()
+        for station in pool:
+            station.queue_job(filename)
+            station.start_next()
+        while any(station.busy or station.jobs for station in pool):
+            time.sleep(0.1)
+        duration = time.perf_counter()-start_time
+        cpu = time.process_time()-start_cpu
+    finally:
+        conn.send('done')
+        received = conn.recv()
+        pool.disconnect()
+        conn.send('stop')
+        fakes.join()
+        os.remove(filename)
+
+    total = 0
+    for station, (lines_received, overflows) in zip(pool, received):
+        result = station.results[-1]
+        total += result['lines']
+        print(f"{station.name}: {result['status']}, "
+              f"{result['lines']/max(result['duration'], 1e-9):5.0f} lines/s, "
+              f"{overflows} bytes lost\n    {result.get('summary', '')}")
+        assert overflows == 0, 'the rx buffer of grbl overflowed'
+        assert lines_received >= result['lines']
+    print(f'{count} machines {"(processes)" if process else "(threads)"}: '
+          f'{total/duration:.0f} lines/s in total, {duration:.2f}s, cpu of '
+          f'this process {cpu:.2f}s, {os.cpu_count()} cpu cores')
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    count = int(args[0]) if len(args) > 0 else 8
+    lines = int(args[1]) if len(args) > 1 else 2000
+    block_ms = float(args[2]) if len(args) > 2 else 1.0
+    measure(count, lines, block_ms, '--process' in sys.argv)
@@ -0,0 +1,143 @@
+''' Optimizes a gcode file in which every cut turns the laser on (M3 S..)
+and off (M5) itself, like most laser CAM output. Checks that the optimized
+program cuts the same lines, that some cuts were reversed and that every
+G1 move of the result runs with the laser on, so a reversed cut is preceded
+by M3 or M4 with the power of the cut. Then the same with air assist (M8,
+M9), dwells and comments between the cuts, which have to stay with their
+cut, and a G92 between the cuts, which refuses the optimization. Start it
+from the root of the repository with:
+
+    python -m laserinterface._tests.optimize_laser [cuts] '''
+
+import math
+import os
+import random
+import sys
+import tempfile
+
+from laserinterface.helpers.gcodereader import GcodeReader, ModalState
+from laserinterface.helpers.pathoptimizer import PathOptimizer
+
+
+def check(name, condition):
+    print(f'{"ok" if condition else "FAILED"}: {name}')
+    return condition
+
+
+def _test_file(cuts, gaps=False, between=''):
+    ''' Short cuts in a random order, half of them with M4. With gaps, every
+    cut is preceded by a comment, a dwell and M8 or M9. between is written
+    before the cut in the middle. '''
+    rng = random.Random(2)
+    handle, filename = tempfile.mkstemp(suffix='.nc', prefix='optimize_')
+    with os.fdopen(handle, 'w') as file:
+        file.write('(optimize laser test)\nG21\nG90\nM5\n')
+        for k in range(cuts):
+            x, y = rng.uniform(0, 200), rng.uniform(0, 200)
+            angle = rng.uniform(0, 2*math.pi)
+            if gaps:
+                file.write(f'(cut {k})\n{"M9" if k % 3 else "M8"}\n'
+                           f'G4 P0.{k % 5}\n')
+            if k == cuts//2:
+                file.write(between)
+            file.write(f'G0 X{x:.3f} Y{y:.3f}\n')
+            file.write(f'{"M3" if k % 2 else "M4"} S{rng.randint(200, 1000)}'
+                       f'\n')
+            file.write('G1 F1000 ')
+            for step in range(1, 4):
+                file.write(f'X{x+step*5*math.cos(angle):.3f} '
+                           f'Y{y+step*5*math.sin(angle):.3f}\n')
+            file.write('M5\n')
+        file.write('G0 X0 Y0\nM2\n')
+    return filename
+
+
+def lit_moves(filename):
+    ''' Returns the G1 moves with the laser on, as rounded (start, end) with
+    the air assist (M8) on or off, and the number of G1 moves with the laser
+    off '''
+    state = ModalState()
+    lit, unlit = {}, 0
+    air = False
+    with open(filename) as file:
+        for line in file:
+            start = (state.x, state.y)
+            state.update(line)
+            end = (state.x, state.y)
+            air = {'M8': True, 'M9': False}.get(line.strip(), air)
+            if state.motion != 'G1' or start == end:
+                continue
+            if state.spindle == 'M5' or not state.power:
+                unlit += 1
+            else:
+                lit[tuple(sorted(
+                    (round(x, 2), round(y, 2)) for x, y in (start, end)))] = air
+    return lit, unlit
+
+
+def carried_lines(filename):
+    ''' The comments and dwells of the file, in the order of the file '''
+    with open(filename) as file:
+        return [line for line in file if line.startswith(('(cut', 'G4'))]
+
+
+def optimize(filename, out_filename):
+    toolpath = GcodeReader().parse(filename)
+    optimizer = PathOptimizer(filename, toolpath.paths)
+    optimizer.optimize()
+    optimizer.write(out_filename)
+    reversed_cuts = sum(cut.reversed for cut in optimizer.cuts)
+    print(f'{len(optimizer.cuts)} cuts, {reversed_cuts} reversed, travel '
+          f'{optimizer.travel_before:.0f}mm -> '
+          f'{optimizer.travel_after:.0f}mm')
+    return optimizer, reversed_cuts
+
+
+if __name__ == '__main__':
+    cuts = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    ok = True
+    for gaps in (False, True):
+        filename = _test_file(cuts, gaps)
+        out_filename = filename.replace('.nc', '_optimized.nc')
+        try:
+            optimizer, reversed_cuts = optimize(filename, out_filename)
+            before, _ = lit_moves(filename)
+            after, unlit = lit_moves(out_filename)
+            ok &= check('all cuts were found', len(optimizer.cuts) == cuts)
+            ok &= check('some cuts were reversed', reversed_cuts > 0)
+            ok &= check('the travel was reduced',
+                        optimizer.travel_after < optimizer.travel_before)
+            ok &= check('every G1 move runs with the laser on', not unlit)
+            ok &= check('the same lines are cut', before == after)
+            if gaps:
+                ok &= check('some lines are cut with air assist',
+                            sum(before.values()) > 0)
+                # the lines before the first cut stay in the header, the
+                # others are written before their cut
+                carried = [line for k in optimizer.order
+                           for line in optimizer.cuts[k].carried]
+                ok &= check('the comments and dwells are kept', sorted(
+                    carried_lines(filename)) == sorted(carried_lines(
+                        out_filename)))
+                ok &= check('the dwells are written in the new order',
+                            [line.decode() for line in carried]
+                            == carried_lines(out_filename)[2:])
+        finally:
+            for name in (filename, out_filename):
+                if os.path.exists(name):
+                    os.remove(name)
+
+    filename = _test_file(cuts, True, 'G92 X0 Y0\n')
+    out_filename = filename.replace('.nc', '_optimized.nc')
+    try:
+        optimize(filename, out_filename)
+        refused = False
+    except ValueError as e:
+        print(f'refused: {e}')
+        refused = True
+    finally:
+        for name in (filename, out_filename):
+            if os.path.exists(name):
+                os.remove(name)
+    ok &= check('a G92 between the cuts refuses the optimization', refused)
+    print('all ok' if ok else 'FAILED')
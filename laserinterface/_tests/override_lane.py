@@ -0,0 +1,141 @@
+''' Changes the overrides of a fake grbl while a job is streamed to it.
+Checks that the override commands are the shortest sequences, that quick
+changes (presses, dragging a slider) are coalesced into few bytes, that the
+Ov field of the reports confirms the result and that a lost override byte
+is corrected. Shows the time from queueing a realtime command until it is
+written, while the sender writes lines. Start it from the root of the
+repository with:
+
+    python -m laserinterface._tests.override_lane [block ms] '''
+
+import os
+import sys
+import time
+
+from laserinterface._tests.fake_grbl import FakeGrbl, _test_file
+from laserinterface.helpers.machinepool import Station
+from laserinterface.helpers.realtimelane import OVERRIDE_STEPS, override_bytes
+
+NAME = 'override_test'
+
+
+def check(name, condition):
+    print(f'{"ok" if condition else "FAILED"}: {name}')
+    return condition
+
+
+def naive_length(value, target):
+    ''' Presses of the buttons, without the clamping '''
+    if target == 100:
+        return 1
+    tens, ones = divmod(abs(target-value), 10)
+    return tens + ones
+
+
+def check_sequences():
+    longest = 0
+    ok = True
+    for value in range(10, 201):
+        for target in range(10, 201):
+            sequence = override_bytes('feed', value, target)
+            longest = max(longest, len(sequence))
+            result = value
+            for byte in sequence:
+                step = {0x91: 10, 0x92: -10, 0x93: 1, 0x94: -1}.get(byte)
+                result = 100 if step is None else min(max(
+                    result+step, 10), 200)
+            ok &= result == target
+            ok &= len(sequence) <= naive_length(value, target)
+    ok = check('every sequence reaches its target', ok)
+    ok &= check('100% to 157% takes 9 bytes',
+                len(override_bytes('feed', 100, 157)) == 9)
+    ok &= check('195% to 200% takes 1 byte',
+                len(override_bytes('power', 195, 200)) == 1)
+    print(f'at most {longest} bytes for any change')
+    return ok
+
+
+def settle(grbl, index, target, timeout=5):
+    start = time.monotonic()
+    while grbl.ov[index] != target and time.monotonic()-start < timeout:
+        time.sleep(0.01)
+    time.sleep(0.3)     # a few reports to confirm
+    return grbl.ov[index] == target
+
+
+def latency_summary(histogram):
+    samples = list(histogram.samples('latency', ()))
+    count = samples[-2][2]
+    if not count:
+        return 'no samples'
+    p99 = next(labels[-1][1] for name, labels, value in samples
+               if name.endswith('_bucket') and value >= 0.99*count)
+    return (f'{count} realtime commands, mean '
+            f'{samples[-1][2]/count*1000:.2f}ms, p99 < {float(p99)*1000:g}ms')
+
+
+if __name__ == '__main__':
+    block_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    ok = check_sequences()
+
+    grbl = FakeGrbl(block_ms=block_ms)
+    station = Station(NAME, port=grbl.url, pooled=False, interlocked=True)
+    filename = _test_file(20000)
+    try:
+        assert station.grbl.connect(), 'could not connect to the fake grbl'
+        lane = station.grbl.realtime
+        station.start_job(filename)
+        time.sleep(0.5)
+
+        # presses of +1, quicker than the coalescing interval
+        sent = grbl.override_bytes
+        for k in range(17):
+            station.grbl.override('feed', 101+k)
+        ok &= check('17 quick presses reach 117%', settle(grbl, 0, 117))
+        print(f'17 presses took {grbl.override_bytes-sent} bytes')
+        ok &= check('quick presses are coalesced',
+                    grbl.override_bytes-sent < 17)
+
+        # dragging a slider from 100% to 157%, a touch event every 16ms
+        sent = grbl.override_bytes
+        values = (100, 104, 110, 121, 133, 140, 151, 157)
+        for value in values[1:]:
+            station.grbl.override('power', value)
+            time.sleep(0.016)
+        ok &= check('dragging reaches 157%', settle(grbl, 2, 157))
+        separate = sum(len(override_bytes('power', value, target))
+                       for value, target in zip(values, values[1:]))
+        print(f'dragging took {grbl.override_bytes-sent} bytes, {separate} '
+              f'bytes without coalescing, the buttons 57 presses')
+        ok &= check('the drag is coalesced',
+                    grbl.override_bytes-sent < min(separate, 57/2))
+
+        # a step at a time, each one written at once
+        sent = grbl.override_bytes
+        for step in OVERRIDE_STEPS:
+            station.grbl.override('feed', lane.targets['feed'] +
+                                  OVERRIDE_STEPS[step])
+            time.sleep(0.05)
+        ok &= check('single presses are written at once',
+                    grbl.override_bytes-sent == len(OVERRIDE_STEPS))
+
+        # a lost byte is corrected after the report
+        grbl.lose_overrides = 1
+        station.grbl.override('feed', 130)
+        start = time.monotonic()
+        ok &= check('a lost override byte is corrected',
+                    settle(grbl, 0, 130) and lane.m_mismatch.value == 1)
+        print(f'corrected after {time.monotonic()-start-0.3:.1f}s')
+        ok &= check('the overrides are confirmed by the reports',
+                    not lane._changed)
+        ok &= check('the job was streamed meanwhile', station.busy)
+        print(latency_summary(lane.m_latency))
+    finally:
+        station.stop()
+        station.grbl.disconnect()
+        grbl.close()
+        os.remove(filename)
+        config_file = f'laserinterface/data/grbl_config_{NAME}.txt'
+        if os.path.exists(config_file):
+            os.remove(config_file)
+    print('all ok' if ok else 'FAILED')
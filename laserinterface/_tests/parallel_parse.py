@@ -0,0 +1,113 @@
+''' Compares the parallel parse of a large gcode file with the sequential
+parse of the GcodeReader: the toolpaths have to be identical. The file mixes
+rapids, cuts, arcs, laser switching, relative moves, inch sections and
+unknown commands, so the state guesses at the chunk starts are sometimes
+wrong. Prints the times of both, with a single cpu core the parallel parse
+can not be faster. Start it from the root of the repository with:
+
+    python -m laserinterface._tests.parallel_parse [lines] [workers] '''
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import astuple
+import math
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from laserinterface.helpers.gcodereader import GcodeReader
+from laserinterface.helpers.parallelreader import parse_parallel
+
+
+def _test_file(lines):
+    ''' Write a gcode file with sections of different kinds '''
+    rng = random.Random(4)
+    handle, filename = tempfile.mkstemp(suffix='.nc', prefix='parallel_')
+    with os.fdopen(handle, 'w') as file:
+        file.write('(parallel parse test)\nG21\nG90\nF1200\n')
+        n = 4
+        while n < lines:
+            kind = rng.random()
+            size = rng.randint(50, 5000)
+            if kind < 0.5:
+                # raster: modal G1 lines with power changes
+                file.write(f'G0 X0 Y{rng.uniform(0, 300):.3f}\nM4\nG1\n')
+                for k in range(size):
+                    file.write(f'X{k*0.1:.3f} S{rng.randint(0, 1000)}\n')
+                file.write('M5\n')
+            elif kind < 0.7:
+                # contours with arcs
+                file.write('M3 S800\n')
+                for k in range(size):
+                    angle = k/size*2*math.pi
+                    file.write(f'G2 X{100+50*math.cos(angle):.3f} '
+                               f'Y{100+50*math.sin(angle):.3f} I-1 J1\n')
+                file.write('M5\n')
+            elif kind < 0.8:
+                # relative moves, the position depends on all lines before
+                file.write('G91\nG1 F600\n')
+                for k in range(size):
+                    file.write(f'X{rng.uniform(-1, 1):.3f} '
+                               f'Y{rng.uniform(-1, 1):.3f} ; step\n')
+                file.write('G90\n')
+            elif kind < 0.9:
+                # inches
+                file.write('G20\n')
+                for k in range(size):
+                    file.write(f'G0 X{rng.uniform(0, 10):.4f}\n')
+                file.write('G21\nG4 P0.1\n\n')
+            else:
+                # several commands on a line and unknown commands
+                for k in range(size):
+                    file.write(f'G1 X{k%200}G0 Y{k%150} (both)\nG17\n')
+            n += size + 4
+    return filename
+
+
+def compare(sequential, parallel):
+    ''' Returns the fields that differ '''
+    differences = []
+    for name in ('filename', 'key', 'lines', 'job_duration', 'max_x', 'max_y',
+                 'min_x', 'min_y', 'warnings', 'error'):
+        if getattr(sequential, name) != getattr(parallel, name):
+            differences.append(name)
+    if [astuple(p) for p in sequential.paths] != \
+            [astuple(p) for p in parallel.paths]:
+        differences.append('paths')
+    if sequential.checkpoints != parallel.checkpoints:
+        differences.append('checkpoints')
+    return differences
+
+
+if __name__ == '__main__':
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 400000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    filename = _test_file(lines)
+    executor = ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        size = os.path.getsize(filename)
+        start = time.perf_counter()
+        sequential = GcodeReader().parse(filename)
+        sequential_time = time.perf_counter() - start
+        print(f'{size/1e6:.1f}MB, {sequential.lines} lines, '
+              f'{len(sequential.paths)} paths: sequential '
+              f'{sequential_time:.2f}s')
+
+        # start all workers before measuring
+        list(executor.map(time.sleep, [0.5]*workers))
+        start = time.perf_counter()
+        parallel = parse_parallel(filename, executor, workers)
+        parallel_time = time.perf_counter() - start
+        print(f'parallel ({workers} workers, {os.cpu_count()} cpu cores) '
+              f'{parallel_time:.2f}s, '
+              f'speedup {sequential_time/parallel_time:.2f}x')
+
+        differences = compare(sequential, parallel)
+        print('identical' if not differences
+              else f'DIFFERENT: {", ".join(differences)}')
+    finally:
+        executor.shutdown()
+        os.remove(filename)
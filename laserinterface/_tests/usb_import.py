@@ -0,0 +1,135 @@
+''' Imports gcode files from a fake usb stick: a directory with files, a
+block device in a fake sysfs tree below a usb host controller and a fake
+mount table. Mounts a usb stick and a sata disk, checks that only the gcode
+files of the stick are copied (verified, at the throttled rate), that they
+are not copied again when the stick is mounted again, and that a changed
+file is. Start it from the root of the repository with:
+
+    python -m laserinterface._tests.usb_import [rate in bytes/s] '''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from laserinterface.helpers.thumbnail import content_hash
+from laserinterface.helpers.usbimport import UsbImporter, usb_mounts
+
+SYS_DEVICES = {
+    'sdb1': 'devices/platform/scb/fd500000.pcie/pci0000:00/0000:01:00.0/'
+            'usb1/1-1/1-1.3/1-1.3:1.0/host0/target0:0:0/0:0:0:0/block/sdb/'
+            'sdb1',
+    'sda1': 'devices/platform/scb/fd500000.pcie/ata1/host1/target1:0:0/'
+            '1:0:0:0/block/sda/sda1',
+}
+
+
+def fake_system(root):
+    ''' The sysfs tree and the mount table, returns their paths '''
+    sys_block = os.path.join(root, 'sys', 'class', 'block')
+    os.makedirs(sys_block)
+    for name, device in SYS_DEVICES.items():
+        os.makedirs(os.path.join(root, 'sys', device))
+        os.symlink(os.path.join('..', '..', device),
+                   os.path.join(sys_block, name))
+    mounts_file = os.path.join(root, 'mounts')
+    with open(mounts_file, 'w') as file:
+        file.write('/dev/mmcblk0p2 / ext4 rw,noatime 0 0\n'
+                   'proc /proc proc rw 0 0\n')
+    return mounts_file, sys_block
+
+
+def mount(mounts_file, device, path):
+    with open(mounts_file, 'a') as file:
+        path = path.replace(' ', '\\040')
+        file.write(f'/dev/{device} {path} vfat rw,relatime 0 0\n')
+
+
+def unmount(mounts_file, device):
+    with open(mounts_file) as file:
+        lines = [line for line in file
+                 if not line.startswith(f'/dev/{device} ')]
+    with open(mounts_file, 'w') as file:
+        file.writelines(lines)
+
+
+def fake_stick(path, size):
+    os.makedirs(os.path.join(path, 'jobs'))
+    files = {
+        'logo.nc': size,
+        'jobs/box lid.gcode': size//4,
+        'jobs/notes.pdf': 1000,
+    }
+    for name, length in files.items():
+        with open(os.path.join(path, name), 'w') as file:
+            line = f'G1 X{len(name)} Y10 S500 ; {name}\n'
+            file.write(line * (length // len(line)))
+
+
+def wait_for(imported, count, timeout=30):
+    start = time.monotonic()
+    while len(imported) < count and time.monotonic() - start < timeout:
+        time.sleep(0.05)
+    return time.monotonic() - start
+
+
+def check(name, condition):
+    print(f'{"ok" if condition else "FAILED"}: {name}')
+    return condition
+
+
+if __name__ == '__main__':
+    rate = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    root = tempfile.mkdtemp(prefix='usb_import_')
+    try:
+        mounts_file, sys_block = fake_system(root)
+        gcode_dir = os.path.join(root, 'gcode_files')
+        stick = os.path.join(root, 'media', 'JOBS STICK')
+        disk = os.path.join(root, 'media', 'disk')
+        fake_stick(stick, 2*rate)
+        fake_stick(disk, 1000)
+
+        imported = []
+        importer = UsbImporter(gcode_dir, rate, mounts_file, sys_block,
+                               interval=0.2)
+        importer.callbacks.append(imported.append)
+        importer.start()
+
+        mount(mounts_file, 'sda1', disk)
+        mount(mounts_file, 'sdb1', stick)
+        ok = check('only the stick is on usb', list(usb_mounts(
+            mounts_file, sys_block).values()) == ['sdb1'])
+        duration = wait_for(imported, 1)
+        copies = sorted(os.path.relpath(path, gcode_dir)
+                        for path in (imported[0] if imported else []))
+        size = sum(os.path.getsize(os.path.join(gcode_dir, path))
+                   for path in copies)
+        print(f'copied {copies}, {size/1e6:.1f}MB in {duration:.2f}s '
+              f'({size/duration/1e6:.2f}MB/s, limit {rate/1e6:.2f}MB/s)')
+        ok &= check('the gcode files of the stick are copied', copies == [
+            'JOBS STICK/jobs/box lid.gcode', 'JOBS STICK/logo.nc'])
+        ok &= check('the copies are identical', all(
+            content_hash(os.path.join(gcode_dir, path))
+            == content_hash(os.path.join(stick, os.path.relpath(
+                path, 'JOBS STICK'))) for path in copies))
+        ok &= check('the copy is throttled', size/duration < rate*1.1)
+        ok &= check('no partial files are left', not any(
+            name.endswith('.part') for _, _, names in os.walk(gcode_dir)
+            for name in names))
+
+        # mounted again, with one file changed
+        unmount(mounts_file, 'sdb1')
+        time.sleep(0.5)
+        with open(os.path.join(stick, 'logo.nc'), 'a') as file:
+            file.write('M5\n')
+        mount(mounts_file, 'sdb1', stick)
+        wait_for(imported, 2)
+        ok &= check('only the changed file is copied again', len(imported) == 2
+                    and [os.path.basename(p) for p in imported[1]]
+                    == ['logo.nc'])
+
+        importer.close()
+        print('all ok' if ok else 'FAILED')
+    finally:
+        shutil.rmtree(root)
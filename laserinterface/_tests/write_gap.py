@@ -0,0 +1,78 @@
+''' Measures the gaps between serial writes while a job is streamed and the
+ui is busy, once with the grbl connection in a thread and once in its own
+process (GRBL.PROCESS). The busy ui is simulated by parsing a gcode file in
+a loop, like the preview does. Uses the fake grbl in a process of its own,
+so it runs on any machine. With a single cpu core the processes can not run
+in parallel, the gaps then show the share of the cpu. Start it from the
+root of the repository with:
+
+    python -m laserinterface._tests.write_gap [lines] [block ms] '''
+
+from threading import Event, Thread
+import io
+import multiprocessing
+import os
+import statistics
+import sys
+
+from laserinterface._tests.fake_grbl import FakeGrbl, _test_file
+from laserinterface.headless import HeadlessRunner
+from laserinterface.helpers.gcodereader import GcodeReader
+
+
+def busy_ui(filename, stop):
+    ''' Parse the file again and again, holding the gil like the preview '''
+    while not stop.is_set():
+        # parse, handle_file would take the toolpath from the cache
+        GcodeReader().parse(filename)
+
+
+def serve_fake_grbl(conn, block_ms):
+    grbl = FakeGrbl(block_ms=block_ms)
+    conn.send(grbl.url)
+    conn.recv()     # until the measurement is done
+    grbl.close()
+
+
+def measure(filename, process, block_ms, load):
+    context = multiprocessing.get_context('spawn')
+    conn, child_conn = context.Pipe()
+    fake = context.Process(target=serve_fake_grbl,
+                           args=(child_conn, block_ms), daemon=True)
+    fake.start()
+    runner = HeadlessRunner(port=conn.recv(), use_gpio=False,
+                            output=io.StringIO(), process=process)
+    stop = Event()
+    if load:
+        Thread(target=busy_ui, args=(filename, stop), daemon=True).start()
+    try:
+        result = runner.run([filename])[0]
+        gaps = sorted(gap*1000 for gap in runner.grbl.write_gaps)
+    finally:
+        stop.set()
+        runner.close()
+        conn.send('stop')
+        fake.join()
+
+    def quantile(q):
+        return gaps[min(int(q*len(gaps)), len(gaps)-1)] if gaps else 0.0
+
+    print(f'{"process" if process else "thread ":7} '
+          f'{"busy ui" if load else "idle ui"}: '
+          f'{result["lines_per_second"]:6.0f} lines/s, write gaps in ms: '
+          f'median={statistics.median(gaps) if gaps else 0:.2f} '
+          f'p90={quantile(0.9):.2f} p99={quantile(0.99):.2f} '
+          f'max={quantile(1):.2f} (n={len(gaps)})\n    {result["summary"]}')
+    return result
+
+
+if __name__ == '__main__':
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    block_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    filename = _test_file(lines)
+    try:
+        for process in (False, True):
+            for load in (False, True):
+                measure(filename, process, block_ms, load)
+    finally:
+        os.remove(filename)
@@ -0,0 +1,314 @@
+# dependencies
+from collections.abc import Mapping
+from threading import Event, Lock, Thread
+import logging
+import os
+import pickle
+
+_log = logging.getLogger().getChild(__name__)
+
+DATA_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+CONFIG_FILE = os.path.join(DATA_DIR, 'config.yaml')
+CACHE_FILE = os.path.join(DATA_DIR, '.config.cache')
+CACHE_VERSION = 1
+
+NUMBER = (int, float)
+# expected types of the config values, other keys are not checked
+SCHEMA = {
+    'GENERAL': {
+        'LASER_PULSE_DURATION': NUMBER,
+        'TRIM_DECIMALS_TO': (int, bool),
+        'GCODE_DIR': str,
+        'FULLSCREEN': bool,
+        'MIMIC_GPIO_LIB': bool,
+        'MIMIC_GPIO_CHANGE': bool,
+        'LATENCY_FILE': str,
+        'METRICS_PORT': (int, bool),
+        'TRACE': bool,
+        'TRACE_BUFFER_SIZE': int,
+        'TRACE_FILE': str,
+        'PARSE_WORKERS': int,
+        'PARSE_NICE': int,
+        'PARALLEL_PARSE_SIZE': int,
+        'TOOLPATH_CACHE_SIZE': int,
+        'LIBRARY_FILE': str,
+        'THUMBNAIL_DIR': str,
+        'USB_IMPORT': bool,
+        'USB_COPY_RATE': int,
+    },
+    'GRBL': {
+        'PORT': str,
+        'POLL_STATE_FREQ': NUMBER,
+        'WELCOME_TIMEOUT': NUMBER,
+        'REPORT_BUFFER': bool,
+        'PROCESS': bool,
+        'BAUDRATE': int,
+        'RX_BUFFER_SIZE': int,
+    },
+    'GPIO': {
+        'PINTYPE': str,
+        'POLL_FREQ': NUMBER,
+        'INPUT_MODE': str,
+        'EDGE_POLL_FREQ': NUMBER,
+        'DEBOUNCE_MS': NUMBER,
+        'TEMP_RANGE': dict,
+        'TEMP_SENSORS': dict,
+        'OUTPUTS': dict,
+        'SAFETY_OUTPUTS': list,
+        'INPUTS': dict,
+    },
+    'CALLBACKS': dict,
+    'MACHINES': dict,
+}
+# sections that can be left out of the config
+OPTIONAL_SECTIONS = ('MACHINES',)
+# expected types of the settings of a machine in MACHINES
+MACHINE_SCHEMA = {
+    'PORT': str,
+    'PROCESS': bool,
+    'INTERLOCK': bool,
+}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def _plain(value):
+    ''' Convert the ruamel.yaml types to builtin types, so the config can be
+    pickled and is cheap to access '''
+    if isinstance(value, Mapping):
+        return {str(key): _plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    for kind in (bool, int, float, str):
+        if isinstance(value, kind):
+            return kind(value)
+    return value
+
+
+def validate(data):
+    ''' Raises a ConfigError if a section is missing or a value has the wrong
+    type '''
+    if not isinstance(data, dict):
+        raise ConfigError('the config has to be a mapping of sections')
+    for section, keys in SCHEMA.items():
+        if section not in data:
+            if section in OPTIONAL_SECTIONS:
+                continue
+            raise ConfigError(f'section {section} is missing')
+        if not isinstance(keys, dict):
+            if not isinstance(data[section], keys):
+                raise ConfigError(f'{section} has the wrong type')
+            continue
+        for key, kind in keys.items():
+            value = data[section].get(key)
+            if value is None:
+                continue
+            kinds = kind if isinstance(kind, tuple) else (kind,)
+            # bool is a subclass of int, but true is no valid frequency
+            if isinstance(value, bool) and bool not in kinds \
+                    or not isinstance(value, kinds):
+                raise ConfigError(
+                    f'{section}.{key} has the wrong type ({value!r})')
+
+    for name, machine in (data.get('MACHINES') or {}).items():
+        if not isinstance(machine, dict) or \
+                not isinstance(machine.get('PORT'), str):
+            raise ConfigError(f'MACHINES.{name} needs a PORT')
+        for key, kind in MACHINE_SCHEMA.items():
+            value = machine.get(key)
+            if value is not None and not isinstance(value, kind):
+                raise ConfigError(
+                    f'MACHINES.{name}.{key} has the wrong type ({value!r})')
+
+
+class ConfigSection(Mapping):
+    ''' Read only view of a section of the config. The values are looked up
+    in the current config, so a section kept at import time shows the
+    values after a reload. Values are accessible as items or attributes. '''
+
+    def __init__(self, manager, path):
+        self._manager = manager
+        self._path = path
+
+    def _data(self):
+        data = self._manager.data
+        for key in self._path:
+            data = data[key]
+        return data
+
+    def __getitem__(self, key):
+        value = self._data()[key]
+        if isinstance(value, dict):
+            return ConfigSection(self._manager, self._path + (key,))
+        return value
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __iter__(self):
+        return iter(self._data())
+
+    def __len__(self):
+        return len(self._data())
+
+    def __repr__(self):
+        return f'ConfigSection({".".join(self._path)}: {self._data()!r})'
+
+    def get_typed(self, key, kind, default=None):
+        ''' Returns the value converted to kind, or default if not set '''
+        value = self.get(key, default)
+        if value is None:
+            return default
+        try:
+            return kind(value)
+        except (TypeError, ValueError):
+            raise ConfigError(
+                f'{".".join(self._path + (key,))} is not a {kind.__name__}')
+
+
+class ConfigManager():
+    def __init__(self, config_file=CONFIG_FILE, cache_file=CACHE_FILE):
+        # ConfigManager parses the config file once for all modules. The
+        # parsed config is stored in a cache file, which is used at the next
+        # start while the config file did not change. The config file can be
+        # watched, subscribers are called with the changed sections after a
+        # reload.
+
+        self.config_file = config_file
+        self.cache_file = cache_file
+        self.data = {}
+        self.file_key = None    # (mtime, size) of the loaded config file
+
+        self.subscribers = []   # (callback, sections)
+        self._lock = Lock()
+        self._watcher = None
+        self._quit = Event()
+
+        self.data = self._load()
+
+    def _stat_key(self):
+        stat = os.stat(self.config_file)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _load(self, use_cache=True):
+        key = self._stat_key()
+        if use_cache:
+            try:
+                with open(self.cache_file, 'rb') as file:
+                    version, cache_key, data = pickle.load(file)
+                if version == CACHE_VERSION and cache_key == key:
+                    self.file_key = key
+                    return data
+            except (OSError, EOFError, ValueError, pickle.PickleError):
+                pass
+
+        data = self._parse()
+        self.file_key = key
+        try:
+            tmp_file = self.cache_file + '.tmp'
+            with open(tmp_file, 'wb') as file:
+                pickle.dump((CACHE_VERSION, key, data), file)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            _log.warning(f'could not write the config cache: {e}')
+        return data
+
+    def _parse(self):
+        # ruamel.yaml is only needed when the cache is outdated
+        import ruamel.yaml
+        yaml = ruamel.yaml.YAML(typ='safe')
+        with open(self.config_file, 'r') as ymlfile:
+            data = _plain(yaml.load(ymlfile))
+        validate(data)
+        _log.info(f'parsed the config file {self.config_file}')
+        return data
+
+    def section(self, name):
+        return ConfigSection(self, (name,))
+
+    def __getitem__(self, name):
+        return self.section(name)
+
+    def subscribe(self, callback, sections=None):
+        ''' callback(changed_sections) is called after a reload changed one of
+        the sections (all if None) '''
+        self.subscribers.append((callback, sections))
+
+    def reload(self):
+        ''' Parse the config file again and notify the subscribers of the
+        changed sections. An invalid config is not applied. Returns the
+        changed sections. '''
+        with self._lock:
+            try:
+                data = self._load(use_cache=False)
+            except Exception as e:
+                _log.error(f'config not reloaded: {e}')
+                # wait for the next change of the file
+                self.file_key = self._stat_key()
+                return set()
+            old_data, self.data = self.data, data
+
+        changed = {name for name in set(old_data) | set(data)
+                   if old_data.get(name) != data.get(name)}
+        if changed:
+            _log.info(f'config reloaded, changed: {", ".join(sorted(changed))}')
+        for callback, sections in list(self.subscribers):
+            if changed and (sections is None or changed & set(sections)):
+                try:
+                    callback(changed)
+                except Exception:
+                    _log.exception(f'config subscriber {callback} failed')
+        return changed
+
+    def update(self, section, key, value):
+        ''' Change a single value in the config file, keeping its comments,
+        and reload the config '''
+        import ruamel.yaml
+        yaml = ruamel.yaml.YAML()
+        with self._lock:
+            with open(self.config_file, 'r') as ymlfile:
+                full_config = yaml.load(ymlfile)
+            full_config[section][key] = value
+            with open(self.config_file, 'w') as ymlfile:
+                yaml.dump(full_config, ymlfile)
+        self.reload()
+
+    def watch(self, interval=1.0):
+        ''' Reload the config when the file changes. The file is checked every
+        interval seconds, a change is applied once the file is unchanged for
+        an interval, so half written files are not loaded. '''
+        if self._watcher is not None:
+            return
+        self._watcher = Thread(target=self._watch, args=(interval,),
+                               daemon=True)
+        self._watcher.start()
+
+    def close(self):
+        self._quit.set()
+
+    def _watch(self, interval):
+        pending = None
+        while not self._quit.wait(interval):
+            try:
+                key = self._stat_key()
+            except OSError:
+                continue
+            if key == self.file_key:
+                pending = None
+            elif key == pending:
+                self.reload()
+                pending = None
+            else:
+                pending = key
+
+
+# the config of the application, shared by all modules
+config_manager = ConfigManager()
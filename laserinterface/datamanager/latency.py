@@ -0,0 +1,134 @@
+# dependencies
+from collections import deque
+from threading import Lock, local
+import logging
+import time
+
+_log = logging.getLogger().getChild(__name__)
+
+# upper bounds of the histogram buckets in ms
+BUCKETS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, float('inf')]
+
+
+class Trace:
+    ''' Timestamps of a single event on its way to the serial port '''
+
+    def __init__(self, event, start=None):
+        self.event = event
+        self.stages = [('start', start or time.perf_counter())]
+
+    def mark(self, stage):
+        self.stages.append((stage, time.perf_counter()))
+
+    @property
+    def duration(self):
+        ''' time from the start to the last stage in ms '''
+        return (self.stages[-1][1] - self.stages[0][1])*1000
+
+
+class LatencyTracker():
+    def __init__(self, sample_count=1000):
+        # LatencyTracker measures the time from a safety event (like an input
+        # change) until the resulting realtime command is written to grbl.
+        # A trace is started by the thread that detects the event, stages
+        # are marked along the way and the trace ends at the serial write.
+
+        self.samples = deque(maxlen=sample_count)   #: total latency in ms
+        self.stage_samples = {}       #: latency per stage in ms
+        self.histogram = [0]*len(BUCKETS)
+        self.count = 0
+        self.max = 0.0
+        self.last_trace = None
+
+        self._lock = Lock()
+        self._local = local()
+
+    def begin(self, event, start=None):
+        ''' Start a trace for the current thread. start is the perf_counter
+        time the event was detected. A nested event does not start a new
+        trace. '''
+        if getattr(self._local, 'trace', None) is not None:
+            return self._local.trace
+        self._local.trace = Trace(event, start)
+        return self._local.trace
+
+    def current(self):
+        return getattr(self._local, 'trace', None)
+
+    def resume(self, trace):
+        ''' Continue a trace (of another thread) in the current thread '''
+        self._local.trace = trace
+
+    def mark(self, stage):
+        trace = getattr(self._local, 'trace', None)
+        if trace is not None:
+            trace.mark(stage)
+
+    def discard(self):
+        ''' Stop tracing in the current thread without storing the trace '''
+        self._local.trace = None
+
+    def end(self, trace=None):
+        ''' Store the latency of the trace (default the one of the current
+        thread) after the realtime command has been written. '''
+        if trace is None:
+            trace = getattr(self._local, 'trace', None)
+            self._local.trace = None
+        if trace is None:
+            return
+
+        trace.mark('write')
+        latency = trace.duration
+        with self._lock:
+            self.samples.append(latency)
+            self.count += 1
+            self.max = max(self.max, latency)
+            for i, bound in enumerate(BUCKETS):
+                if latency <= bound:
+                    self.histogram[i] += 1
+                    break
+            prev_time = trace.stages[0][1]
+            for stage, stage_time in trace.stages[1:]:
+                self.stage_samples.setdefault(
+                    stage, deque(maxlen=self.samples.maxlen)).append(
+                        (stage_time-prev_time)*1000)
+                prev_time = stage_time
+            self.last_trace = trace
+
+        _log.debug(f'{trace.event} reached grbl in {latency:.3f} ms')
+
+    def percentile(self, percent, samples=None):
+        with self._lock:
+            samples = sorted(self.samples if samples is None else samples)
+        if not samples:
+            return 0.0
+        index = min(int(len(samples)*percent/100), len(samples)-1)
+        return samples[index]
+
+    def summary(self):
+        ''' returns a single line with the p50, p99 and max latency '''
+        if not self.count:
+            return 'no safety events measured'
+        return (f'p50={self.percentile(50):.2f}ms '
+                f'p99={self.percentile(99):.2f}ms '
+                f'max={self.max:.2f}ms (n={self.count})')
+
+    def dump(self, filename):
+        ''' Write the summary, histogram and latency per stage to a file '''
+        with self._lock:
+            histogram = list(self.histogram)
+            stages = {name: list(s) for name, s in self.stage_samples.items()}
+
+        with open(filename, 'w') as file:
+            file.write(f'Safety reaction latency: {self.summary()}\n\n')
+            file.write('Histogram (ms):\n')
+            lower = 0
+            for bound, count in zip(BUCKETS, histogram):
+                file.write(f'  {lower:>6} - {bound:<6}: {count}\n')
+                lower = bound
+            file.write('\nLatency per stage (ms):\n')
+            for name, samples in stages.items():
+                file.write(f'  {name:<10}: '
+                           f'p50={self.percentile(50, samples):.3f} '
+                           f'p99={self.percentile(99, samples):.3f} '
+                           f'max={max(samples):.3f}\n')
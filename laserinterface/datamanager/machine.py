@@ -1,15 +1,47 @@
 # dependencies
 import logging
+import time
+
+from laserinterface.datamanager.latency import LatencyTracker
+from laserinterface.datamanager.metrics import MetricsRegistry
+from laserinterface.datamanager.planner import PlannerMonitor
+from laserinterface.datamanager.tracing import tracer
 
 _log = logging.getLogger().getChild(__name__)
 
 
 class MachineStateManager():
-    def __init__(self):
+    def __init__(self, name=None):
         self.grbl_config = {}
         self.grbl_status = {'WCO': [.0, .0, .0]}
         self.gpio_status = {}
-        self.cooling_temp = 99
+        self.cooling_temp = None    # no sensor found yet
+        self.job_active = False
+        self.latency = LatencyTracker()
+
+        # with several machines, their metrics are labeled with the name
+        self.name = name
+        self.metrics = MetricsRegistry(**({'machine': name} if name else {}))
+        self.m_reports = self.metrics.counter(
+            'grbl_status_reports_total', 'Status reports received')
+        self.m_idle_in_job = self.metrics.counter(
+            'grbl_idle_during_job_seconds_total',
+            'Time grbl reported Idle while a job was active')
+        self.metrics.gauge(
+            'grbl_planner_blocks_free', 'Free blocks in the planner (Bf)',
+            lambda: self.grbl_status.get('Bf', (None,))[0])
+        self.metrics.gauge(
+            'grbl_rx_bytes_free', 'Free bytes in the rx buffer (Bf)',
+            lambda: self.grbl_status.get('Bf', (None, None))[1])
+        self.metrics.gauge(
+            'cooling_temperature_celsius', 'Temperature of the laser tube',
+            lambda: self.cooling_temp)
+        self.metrics.gauge(
+            'job_active', 'A job is being sent',
+            lambda: int(self.job_active))
+        self.last_report_time = time.monotonic()
+
+        self.planner = PlannerMonitor(self.metrics)
 
         self.grbl_callbacks = []
         self.temp_callbacks = []
@@ -21,7 +53,14 @@ class MachineStateManager():
             callback(self.grbl_status)
         return callable(callback)
 
+    @tracer.traced('machine.handle_grbl_report')
     def handle_grbl_report(self, state_in):
+        now = time.monotonic()
+        if self.job_active and self.grbl_status.get('state') == 'Idle':
+            self.m_idle_in_job.inc(now-self.last_report_time)
+        self.last_report_time = now
+        self.m_reports.inc()
+
         state_items = state_in[1:-1].split('|')  # remove < > and split
         self.grbl_status['state'] = state_items.pop(0)
         for item in state_items:
@@ -46,6 +85,8 @@ class MachineStateManager():
             except ValueError:
                 _log.warning(f'received a corrupt status report {state_in}')
 
+        self.planner.update(self.grbl_status, now)
+
         if self.grbl_callbacks:
             for callback in self.grbl_callbacks:
                 callback(self.grbl_status)
@@ -71,7 +112,9 @@ class MachineStateManager():
         return callable(callback)
 
     def update_gpio(self, item, new_state):
-        _log.debug(f'gpio "{item}" changed -> "{new_state}", start callbacks')
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug('gpio "%s" changed -> "%s", start callbacks', item,
+                       new_state)
         self.gpio_status[item] = new_state
         if self.gpio_callbacks:
             for callback in self.gpio_callbacks:
@@ -0,0 +1,258 @@
+# dependencies
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, RLock, Thread, local
+from weakref import finalize
+import logging
+import time
+
+_log = logging.getLogger().getChild(__name__)
+
+# upper bounds of the latency histograms in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2,
+                   0.5, 1.0)
+
+
+class _Owner():
+    ''' Only referenced by a thread local, collected when the thread ends '''
+    __slots__ = ('__weakref__',)
+
+
+class _ThreadCells():
+    ''' Values updated by many threads. Every thread has its own cell, so an
+    update needs no lock, the cells are summed when the values are read. The
+    cell of an ended thread (like a debounce timer of the gpio) is added to
+    the base, so the cells do not grow with every thread ever started. '''
+
+    def __init__(self, size):
+        self._base = [0]*size
+        self._cells = []
+        self._local = local()
+        # not used by the updates, reentrant as a finalizer can run anywhere
+        self._lock = RLock()
+
+    def _cell(self):
+        cell = [0]*len(self._base)
+        with self._lock:
+            self._cells.append(cell)
+        owner = _Owner()
+        finalize(owner, self._retire, cell)
+        self._local.cell = cell
+        self._local.owner = owner
+        return cell
+
+    def _retire(self, cell):
+        with self._lock:
+            self._cells.remove(cell)
+            self._base = [a+b for a, b in zip(self._base, cell)]
+
+    def _totals(self):
+        with self._lock:
+            cells = list(self._cells)
+            base = self._base
+        return [sum(values) for values in zip(base, *cells)]
+
+
+class Counter(_ThreadCells):
+    ''' Counter that is only increased, with a cell per thread '''
+    kind = 'counter'
+
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        try:
+            self._local.cell[0] += amount
+        except AttributeError:
+            self._cell()[0] += amount
+
+    @property
+    def value(self):
+        return self._totals()[0]
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge():
+    ''' Value that is set, or read from a function when it is exported '''
+    kind = 'gauge'
+
+    def __init__(self, function=None):
+        self.function = function
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return float('nan')
+        return self._value
+
+    def samples(self, name, labels):
+        value = self.value
+        if value is not None:
+            yield name, labels, value
+
+
+class Histogram(_ThreadCells):
+    ''' Distribution of observed values, with a cell per thread '''
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # counts per bucket (the last one is +Inf), then the sum
+        super().__init__(len(self.buckets)+2)
+
+    def observe(self, value):
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            cell = self._cell()
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def samples(self, name, labels):
+        totals = self._totals()
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), totals):
+            cumulative += count
+            yield (f'{name}_bucket', labels + (('le', str(bound)),),
+                   cumulative)
+        yield f'{name}_count', labels, cumulative
+        yield f'{name}_sum', labels, totals[-1]
+
+
+class Rate(Gauge):
+    ''' Increase per second of a counter since the previous export '''
+
+    def __init__(self, counter):
+        super().__init__(self._rate)
+        self.counter = counter
+        self._last = (time.monotonic(), counter.value)
+
+    def _rate(self):
+        now, value = time.monotonic(), self.counter.value
+        last_time, last_value = self._last
+        self._last = (now, value)
+        if now <= last_time:
+            return 0.0
+        return (value-last_value)/(now-last_time)
+
+
+class MetricsRegistry():
+    def __init__(self, **labels):
+        # MetricsRegistry holds the metrics of the application. The hot paths
+        # keep a reference to their metric, so updating it is an attribute
+        # access and an addition. Metrics with labels are created once per
+        # label value. The labels of the registry are added to all its
+        # metrics, to tell the machines apart when several are exported.
+
+        self.metrics = {}   # name: (kind, help, {labels: metric})
+        self.labels = tuple(sorted(labels.items()))
+        self._lock = Lock()
+
+    def _get(self, name, help_text, labels, factory):
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            kind, _, children = self.metrics.setdefault(
+                name, (None, help_text, {}))
+            metric = children.get(labels)
+            if metric is None:
+                metric = children[labels] = factory()
+                self.metrics[name] = (metric.kind, help_text, children)
+            return metric
+
+    def counter(self, name, help_text='', **labels):
+        return self._get(name, help_text, labels, Counter)
+
+    def gauge(self, name, help_text='', function=None, **labels):
+        return self._get(name, help_text, labels, lambda: Gauge(function))
+
+    def histogram(self, name, help_text='', buckets=LATENCY_BUCKETS,
+                  **labels):
+        return self._get(name, help_text, labels, lambda: Histogram(buckets))
+
+    def rate(self, name, counter, help_text=''):
+        return self._get(name, help_text, {}, lambda: Rate(counter))
+
+    def families(self):
+        ''' Returns (name, kind, help, [(labels, metric)]) per metric '''
+        with self._lock:
+            return [(name, kind, help_text,
+                     [(self.labels + labels, metric)
+                      for labels, metric in children.items()])
+                    for name, (kind, help_text, children)
+                    in self.metrics.items()]
+
+    def export(self):
+        ''' Returns all metrics in the prometheus text format '''
+        return export_registries([self])
+
+
+def export_registries(registries):
+    ''' Returns the metrics of the registries in the prometheus text format,
+    the metrics with the same name are exported as one family '''
+    families = {}
+    for registry in registries:
+        for name, kind, help_text, children in registry.families():
+            family = families.setdefault(name, [kind, help_text, []])
+            family[2].extend(children)
+
+    lines = []
+    for name, (kind, help_text, children) in sorted(families.items()):
+        if help_text:
+            lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, metric in children:
+            for sample, sample_labels, value in metric.samples(name, labels):
+                if sample_labels:
+                    label_text = ','.join(
+                        f'{key}="{label}"' for key, label in sample_labels)
+                    sample = f'{sample}{{{label_text}}}'
+                lines.append(f'{sample} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter(Thread):
+    def __init__(self, registry, port, host='127.0.0.1', auto_start=True):
+        # MetricsExporter serves the metrics of the registry at
+        # http://host:port/metrics for prometheus or a simple curl. The
+        # registry can be anything with an export() method.
+        Thread.__init__(self)
+        self.daemon = True
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.export().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                _log.debug(format % args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        _log.info(f'serving metrics at http://{host}:{port}/metrics')
+
+        if auto_start:
+            self.start()
+
+    def run(self):
+        self.server.serve_forever()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
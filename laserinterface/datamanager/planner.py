@@ -0,0 +1,179 @@
+# dependencies
+from collections import deque
+import logging
+import time
+
+_log = logging.getLogger().getChild(__name__)
+
+STARVED_BLOCKS = 1      # planner blocks in use at or below which it starves
+MIN_LOOKAHEAD = 3       # lines prepared ahead of the sender
+MAX_LOOKAHEAD = 48
+MAX_WRITE_BATCH = 8     # lines combined in a single serial write
+CAUSES = ('machine', 'cpu', 'io')
+
+
+class JobStats():
+    ''' Planner statistics of a single job '''
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.samples = {cause: 0 for cause in CAUSES}
+        self.starvations = 0
+        self.starved_time = 0.0
+        self.blocks_sum = 0
+        self.reports = 0
+        self.moving = False         # no starvation before the first motion
+        self.stream_done = False    # the planner drains at the end
+
+    @property
+    def bound(self):
+        ''' The cause of most reports: machine (the planner is filled, the
+        motion is the limit), cpu (no lines prepared when starving) or io
+        (lines waiting for the serial link when starving) '''
+        return max(self.samples, key=self.samples.get)
+
+    def summary(self):
+        duration = time.monotonic()-self.start_time
+        mean_blocks = self.blocks_sum/self.reports if self.reports else 0
+        shares = ', '.join(
+            f'{cause} {count*100/max(self.reports, 1):.0f}%'
+            for cause, count in self.samples.items())
+        return (f'job took {duration:.0f}s, planner {mean_blocks:.1f} blocks '
+                f'on average, starved {self.starvations} times for '
+                f'{self.starved_time:.1f}s, {self.bound}-bound ({shares})')
+
+
+class PlannerMonitor():
+    def __init__(self, metrics=None, history_seconds=60):
+        # PlannerMonitor follows the planner blocks grbl has in use, using the
+        # Bf field (free planner blocks, free rx bytes) of the status report.
+        # During a job a nearly empty planner is a starvation: the machine
+        # slows down at every segment. The cause is found from the lines
+        # waiting to be sent, and the streaming is adapted to it:
+        #  - no lines waiting: preparing the lines is too slow (cpu), so more
+        #    lines are prepared ahead (lookahead)
+        #  - lines waiting: the serial link is too slow (io), so more lines
+        #    are written at once (write_batch)
+
+        self.block_capacity = 0     # free blocks while idle = planner size
+        self.rx_capacity = 0
+        self.blocks_used = None
+        self.history = deque()      # (time, blocks used)
+        self.history_seconds = history_seconds
+
+        self.queued_lines = None    # returns the lines waiting to be sent
+        self.job = None             # JobStats of the active job
+        self.starved_since = None
+        self.starved_cause = None
+
+        self.lookahead = MIN_LOOKAHEAD
+        self.write_batch = 1
+
+        self.m_starvations = {}
+        if metrics is not None:
+            for cause in CAUSES[1:]:
+                self.m_starvations[cause] = metrics.counter(
+                    'grbl_planner_starvations_total',
+                    'Times the planner ran empty during a job', cause=cause)
+            metrics.gauge('grbl_planner_occupancy',
+                          'Mean fraction of the planner in use', self.occupancy)
+            metrics.gauge('stream_lookahead_lines',
+                          'Lines the job is read ahead of the sender',
+                          lambda: self.lookahead)
+            metrics.gauge('stream_write_batch_lines',
+                          'Max lines combined in a serial write',
+                          lambda: self.write_batch)
+
+    def start_job(self):
+        self.job = JobStats()
+        self.starved_since = None
+        self.lookahead = MIN_LOOKAHEAD
+        self.write_batch = 1
+
+    def stream_finished(self):
+        ''' All lines of the job are queued, the planner drains from now '''
+        if self.job is not None:
+            self.job.stream_done = True
+
+    def end_job(self):
+        ''' Returns the summary of the finished job '''
+        job, self.job = self.job, None
+        if job is None:
+            return ''
+        self._end_starvation(time.monotonic(), job)
+        summary = job.summary()
+        _log.info(summary)
+        return summary
+
+    def update(self, status, now=None):
+        ''' Called for every status report '''
+        if now is None:
+            now = time.monotonic()
+        state = status.get('state', '')
+        bf = status.get('Bf')
+
+        if bf and state == 'Idle':
+            # the planner is empty when idle, all blocks are free
+            self.block_capacity = int(bf[0])
+            self.rx_capacity = int(bf[1])
+        if bf and self.block_capacity:
+            self.blocks_used = max(self.block_capacity - int(bf[0]), 0)
+            self.history.append((now, self.blocks_used))
+            while self.history[0][0] < now-self.history_seconds:
+                self.history.popleft()
+
+        job = self.job
+        if job is None or job.stream_done:
+            return
+        if state == 'Run':
+            job.moving = True
+        if not job.moving or state not in ('Run', 'Idle'):
+            return  # not started yet, paused or in alarm
+
+        # without Bf an Idle state during a job is the only sign
+        if self.blocks_used is not None and bf:
+            starved = self.blocks_used <= STARVED_BLOCKS
+        else:
+            starved = state == 'Idle'
+
+        if starved:
+            queued = self.queued_lines() if self.queued_lines else 0
+            cause = 'io' if queued else 'cpu'
+        else:
+            cause = 'machine'
+        job.samples[cause] += 1
+        job.reports += 1
+        job.blocks_sum += self.blocks_used or 0
+
+        if starved and self.starved_since is None:
+            self.starved_since = now
+            self.starved_cause = cause
+            job.starvations += 1
+            if cause in self.m_starvations:
+                self.m_starvations[cause].inc()
+            _log.warning(f'planner starved ({cause}-bound), '
+                         f'{self.blocks_used} blocks in use')
+            self.adapt(cause)
+        elif not starved:
+            self._end_starvation(now, job)
+
+    def _end_starvation(self, now, job):
+        if self.starved_since is not None:
+            job.starved_time += now-self.starved_since
+            self.starved_since = None
+
+    def adapt(self, cause):
+        ''' Change the streaming for the cause of a starvation '''
+        if cause == 'cpu' and self.lookahead < MAX_LOOKAHEAD:
+            self.lookahead = min(self.lookahead*2, MAX_LOOKAHEAD)
+            _log.info(f'reading {self.lookahead} lines ahead')
+        elif cause == 'io' and self.write_batch < MAX_WRITE_BATCH:
+            self.write_batch = min(self.write_batch*2, MAX_WRITE_BATCH)
+            _log.info(f'writing up to {self.write_batch} lines at once')
+
+    def occupancy(self):
+        ''' Mean fraction of the planner in use over the history '''
+        if not self.history or not self.block_capacity:
+            return None
+        return (sum(used for _, used in self.history)
+                / len(self.history) / self.block_capacity)
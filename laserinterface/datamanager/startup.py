@@ -0,0 +1,63 @@
+# dependencies
+from contextlib import contextmanager
+from threading import Lock
+import logging
+import time
+
+_log = logging.getLogger().getChild(__name__)
+
+
+class StartupProfiler():
+    def __init__(self):
+        # StartupProfiler records how long the phases of the startup take.
+        # Imports are recorded with mark() (time since the previous mark),
+        # initialization steps with phase(). Phases of background threads
+        # can overlap the main thread, they are reported with their start.
+
+        self.start_time = time.perf_counter()
+        self.last_mark = self.start_time
+        self.phases = []    # (name, start since start_time, duration) in s
+        self.interactive_time = None
+        self._lock = Lock()
+
+    def _add(self, name, start, duration):
+        with self._lock:
+            self.phases.append((name, start-self.start_time, duration))
+
+    def mark(self, name):
+        ''' Record the time since the previous mark as a phase '''
+        now = time.perf_counter()
+        self._add(name, self.last_mark, now-self.last_mark)
+        self.last_mark = now
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add(name, start, time.perf_counter()-start)
+            self.last_mark = time.perf_counter()
+
+    def interactive(self):
+        ''' Called when the first frame is shown, logs the report once '''
+        if self.interactive_time is not None:
+            return
+        self.interactive_time = time.perf_counter()-self.start_time
+        _log.info(self.report())
+
+    def report(self):
+        with self._lock:
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+        lines = ['Startup phases (start, duration):']
+        for name, start, duration in phases:
+            lines.append(f'  {start*1000:8.1f} ms {duration*1000:8.1f} ms  '
+                         f'{name}')
+        if self.interactive_time is not None:
+            lines.append(f'Time to interactive: '
+                         f'{self.interactive_time*1000:.1f} ms')
+        return '\n'.join(lines)
+
+
+# started as first import of main.py
+profiler = StartupProfiler()
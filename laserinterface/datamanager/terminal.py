@@ -1,4 +1,5 @@
 from laserinterface.data.grbl_doc import ERROR_CODES, CONFIG
+from laserinterface.datamanager.tracing import tracer
 
 import logging
 _log = logging.getLogger().getChild(__name__)
@@ -24,6 +25,7 @@ class TerminalManager():
         #  - linenumber: int
         #  - state:      str
         #  - line:       str
+        #  - job_line:   int (only for lines send as part of a job)
 
         self.history_count = history_count      #: line count stored in history
         self.callbacks = []
@@ -37,8 +39,14 @@ class TerminalManager():
 
         self.line_number = 0
         self.line_number_error = 0
+        self.last_job_line = -1        #: file line of the last job line ok'd
+
+    def start_job(self, start_line=0):
+        ''' A job starts at start_line, no line of it is ok'd yet '''
+        self.last_job_line = start_line-1
 
     def clear_buffers(self):
+        self.last_job_line = -1
         while len(self.line_out_buffer) > 0:
             line = self.line_out_buffer.pop(0)
             line[1] = STATES['cancel']
@@ -77,6 +85,7 @@ class TerminalManager():
         # sort by linenumber and return
         return sorted(lines, key=lambda x: x[0])
 
+    @tracer.traced('terminal.callback')
     def callback(self):
         # All callbacks are called every time a line is modified
         if self.callbacks:
@@ -122,6 +131,8 @@ class TerminalManager():
             self.line_number_error = line[0]
         else:
             line[1] = STATES['send_ok']
+        if len(line) > 3:
+            self.last_job_line = line[3]
         self.line_history.append(line)
         lines_too_many = len(self.line_history)-self.history_count
         if lines_too_many > 0:
@@ -131,15 +142,27 @@ class TerminalManager():
         self.callback()
         return True
 
-    def store_send(self, send_line):
+    def store_send(self, send_line, job_line=None):
         # send a line to grbl. Currently in Serial OUT buffer
         # when send succesfully, call send_succes()
         line = [self.line_number, STATES['send_wait'], send_line]
+        if job_line is not None:
+            line.append(job_line)
         self.line_number += 1
         self.line_out_buffer.append(line)
 
         self.callback()
 
+    def store_sent(self, send_line, job_line=None):
+        # a line of a job, send directly to the buffer of grbl
+        line = [self.line_number, STATES['send_buf'], send_line]
+        if job_line is not None:
+            line.append(job_line)
+        self.line_number += 1
+        self.line_wait_for_ok.append(line)
+
+        self.callback()
+
     def send_to_buffer(self):
         # when a line is send from the output buffer and received at the buffer
         # of grbl. This function moves the line to the correct variables.
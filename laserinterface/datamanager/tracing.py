@@ -0,0 +1,167 @@
+# dependencies
+from collections import deque
+from contextlib import nullcontext
+from functools import wraps
+from threading import RLock, current_thread, local
+from weakref import finalize
+import json
+import logging
+import os
+import time
+
+_log = logging.getLogger().getChild(__name__)
+
+NO_SPAN = nullcontext()
+
+
+class _Owner():
+    ''' Only referenced by a thread local, collected when the thread ends '''
+    __slots__ = ('__weakref__',)
+
+
+class _Ring():
+    ''' The spans of a single thread. Only that thread writes, so no lock is
+    needed. The ring grows up to its size, then the oldest spans are
+    overwritten. '''
+
+    def __init__(self, size):
+        thread = current_thread()
+        self.tid = thread.ident
+        self.thread_name = thread.name
+        self.size = size
+        self.spans = []
+        self.count = 0
+
+    def add(self, span):
+        if self.count < self.size:
+            self.spans.append(span)
+        else:
+            self.spans[self.count % self.size] = span
+        self.count += 1
+
+    def ordered(self):
+        if self.count <= self.size:
+            return self.spans[:self.count]
+        start = self.count % self.size
+        return self.spans[start:] + self.spans[:start]
+
+
+class _Span():
+    __slots__ = ('tracer', 'name', 'start')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        self.tracer._ring().add((self.name, self.start, end-self.start))
+        return False
+
+
+class Tracer():
+    def __init__(self, buffer_size=20000):
+        # Tracer records the start and duration of spans of code, per thread
+        # in a ring buffer. It is disabled by default, then span() returns a
+        # shared empty context and traced functions only check a flag. The
+        # spans are saved as chrome trace events (chrome://tracing, perfetto).
+        # The ring of an ended thread (like a painter of a file) is freed,
+        # its spans are moved to one ring shared by all ended threads.
+
+        self.enabled = False
+        self.buffer_size = buffer_size
+        self.rings = []
+        self.retired = deque(maxlen=buffer_size)   # (tid, thread, span)
+        self._local = local()
+        # only used when a thread adds or retires its ring, reentrant as a
+        # finalizer can run anywhere
+        self._lock = RLock()
+
+    def enable(self, buffer_size=None):
+        if buffer_size:
+            self.buffer_size = buffer_size
+            with self._lock:
+                self.retired = deque(self.retired, maxlen=buffer_size)
+        self.enabled = True
+        _log.info(f'tracing enabled, {self.buffer_size} spans per thread')
+
+    def disable(self):
+        self.enabled = False
+
+    def _ring(self):
+        try:
+            return self._local.ring
+        except AttributeError:
+            ring = _Ring(self.buffer_size)
+            with self._lock:
+                self.rings.append(ring)
+            owner = _Owner()
+            finalize(owner, self._retire, ring)
+            self._local.ring = ring
+            self._local.owner = owner
+            return ring
+
+    def _retire(self, ring):
+        with self._lock:
+            self.rings.remove(ring)
+            self.retired.extend((ring.tid, ring.thread_name, span)
+                                for span in ring.ordered())
+
+    def span(self, name):
+        ''' with tracer.span('name'): records the duration of the block '''
+        if not self.enabled:
+            return NO_SPAN
+        return _Span(self, name)
+
+    def traced(self, name):
+        ''' Decorator recording every call of a function as a span '''
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with _Span(self, name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def events(self):
+        ''' Returns the spans as chrome trace events '''
+        pid = os.getpid()
+        with self._lock:
+            rings = list(self.rings)
+            spans = list(self.retired)
+        for ring in rings:
+            spans.extend((ring.tid, ring.thread_name, span)
+                         for span in ring.ordered())
+
+        events = []
+        threads = {}
+        for tid, thread_name, (name, start, duration) in spans:
+            if threads.get(tid) != thread_name:
+                threads[tid] = thread_name
+                events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                    'tid': tid, 'args': {'name': thread_name}})
+            events.append({
+                'name': name, 'cat': name.split('.')[0], 'ph': 'X',
+                'ts': start/1000, 'dur': duration/1000,
+                'pid': pid, 'tid': tid})
+        return events
+
+    def dump(self, filename):
+        ''' Write the spans to a json file, returns the number of spans '''
+        events = self.events()
+        with open(filename, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+        count = sum(1 for event in events if event['ph'] == 'X')
+        _log.info(f'wrote {count} spans to {filename}')
+        return count
+
+
+# shared by all modules, enabled from the config in main.py
+tracer = Tracer()
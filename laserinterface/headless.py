@@ -0,0 +1,207 @@
+''' Stream gcode files to grbl without the user interface. Progress is
+written to stdout as text or as json lines, the log goes to stderr:
+
+    python -m laserinterface.headless [--json] [--port URL] file [file ...]
+
+The port can be any pyserial url, like socket://127.0.0.1:5000 for the fake
+grbl in laserinterface._tests.fake_grbl. '''
+
+# dependencies
+from threading import Event, Thread
+import argparse
+import json
+import logging
+import signal
+import sys
+import time
+
+from laserinterface.data.grbl_doc import COMMANDS
+from laserinterface.datamanager.machine import MachineStateManager
+from laserinterface.datamanager.terminal import TerminalManager
+from laserinterface.helpers.grblinterface import GrblInterface
+from laserinterface.helpers.grblprocess import GrblProcess
+
+_log = logging.getLogger().getChild(__name__)
+
+
+class HeadlessRunner():
+    def __init__(self, port=None, use_gpio=True, json_lines=False,
+                 interval=1.0, output=None, process=False):
+        # HeadlessRunner wires the backend together like MainLayoutApp, but
+        # without kivy. The gpio is optional, without it the safety inputs
+        # and job callbacks are not available (only for tests on a pc).
+
+        self.json_lines = json_lines
+        self.interval = interval
+        self.output = output or sys.stdout
+        self.stopping = False
+        self._done = Event()
+
+        self.terminal = TerminalManager()
+        self.machine = MachineStateManager()
+        grbl_class = GrblProcess if process else GrblInterface
+        self.grbl = grbl_class(
+            machine=self.machine, terminal=self.terminal, port=port)
+
+        self.gpio = None
+        self.callback = None
+        if use_gpio:
+            # only imported when used, it loads the gpio library
+            from laserinterface.helpers.callbackhandler import CallbackHandler
+            from laserinterface.helpers.gpiointerface import GpioInterface
+            self.gpio = GpioInterface(machine=self.machine, auto_start=False)
+            self.callback = CallbackHandler(grbl=self.grbl, gpio=self.gpio)
+            self.gpio.callback = self.callback
+            self.gpio.start()
+            self.gpio.pin_write('OUT_LIGHT', True)
+            self.gpio.pin_write('OUT_COOLING', True)
+
+        self.streamer = self.grbl.job_streamer()
+
+    def emit(self, event, **fields):
+        ''' Write an event to the output '''
+        if self.json_lines:
+            text = json.dumps({'event': event, 'time': time.time(), **fields})
+        else:
+            text = f'{event:8} ' + '  '.join(
+                f'{key}={value:.1f}' if isinstance(value, float)
+                else f'{key}={value}' for key, value in fields.items())
+        print(text, file=self.output, flush=True)
+
+    def do_callback(self, event):
+        if self.callback is not None:
+            self.callback.do_callback(event)
+
+    def connect(self):
+        if self.grbl.connected:
+            return True
+        if not self.grbl.connect():
+            self.emit('error', message=f'could not connect to '
+                      f'{self.grbl.port}')
+            return False
+        self.emit('connected', port=self.grbl.port)
+        return True
+
+    def run(self, files, repeat_count=1, start_line=0):
+        ''' Stream the files one after another. Returns a result per file,
+        stops after a stopped or failed file. '''
+        results = []
+        if not self.connect():
+            return results
+        for filename in files:
+            if self.stopping:
+                break
+            result = self.run_file(filename, repeat_count, start_line)
+            results.append(result)
+            if result['status'] != 'done':
+                break
+        return results
+
+    def run_file(self, filename, repeat_count=1, start_line=0):
+        self.emit('start', file=filename, repeat=repeat_count)
+        self._done.clear()
+        reporter = Thread(target=self._report_progress, daemon=True)
+
+        self.do_callback('JOB_START')
+        reporter.start()
+        try:
+            summary = self.streamer.stream(filename, repeat_count, start_line)
+        except OSError as e:
+            _log.error(f'could not stream {filename}: {e}')
+            summary = None
+            result = {'status': 'error', 'message': str(e)}
+        else:
+            result = {'status': 'stopped' if summary is None else 'done'}
+        finally:
+            self._done.set()
+            reporter.join()
+            self.do_callback('JOB_STOP')
+
+        duration = self.streamer.duration
+        result.update({
+            'file': filename,
+            'lines': self.streamer.lines_sent,
+            'duration': duration,
+            'lines_per_second': self.streamer.lines_sent/max(duration, 1e-9),
+            'summary': summary or '',
+        })
+        self.emit(result['status'], **{
+            key: value for key, value in result.items() if key != 'status'})
+        return result
+
+    def _report_progress(self):
+        while not self._done.wait(self.interval):
+            self.emit(
+                'progress', file=self.streamer.filename,
+                progress=self.streamer.progress,
+                lines=self.streamer.lines_sent,
+                job_line=self.terminal.last_job_line+1,
+                duration=self.streamer.duration,
+                state=self.machine.grbl_status.get('state', ''))
+
+    def stop(self):
+        ''' Stop sending the job, like the stop button of the ui '''
+        self.stopping = True
+        self.streamer.stop()
+        self.grbl.serial_send(COMMANDS['feed hold'])
+        self.grbl.serial_send('M5')
+
+    def close(self):
+        self.grbl.disconnect()
+        if self.gpio is not None:
+            self.gpio.close()
+            self.callback.executor.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m laserinterface.headless',
+        description='Stream gcode files to grbl without the user interface.')
+    parser.add_argument('files', nargs='+', help='gcode files to stream')
+    parser.add_argument('--port', help='serial port or pyserial url, '
+                        'instead of GRBL.PORT of the config')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='times every file is streamed')
+    parser.add_argument('--start-line', type=int, default=0,
+                        help='line of the first file to start at')
+    parser.add_argument('--json', action='store_true',
+                        help='write the progress as json lines')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between progress updates')
+    parser.add_argument('--no-gpio', action='store_true',
+                        help='run without gpio (no safety inputs!)')
+    parser.add_argument('--process', action='store_true',
+                        help='run the serial connection in its own process')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), stream=sys.stderr)
+
+    runner = HeadlessRunner(
+        port=args.port,
+        use_gpio=not args.no_gpio, json_lines=args.json,
+        interval=args.interval, process=args.process)
+
+    def interrupt(signum, frame):
+        if runner.stopping:
+            raise KeyboardInterrupt
+        _log.warning('stopping the job, interrupt again to quit')
+        runner.stop()
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, interrupt)
+
+    try:
+        results = runner.run(args.files, args.repeat, args.start_line)
+    finally:
+        runner.close()
+
+    if not results:
+        return 2
+    if len(results) < len(args.files) or \
+            any(result['status'] != 'done' for result in results):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
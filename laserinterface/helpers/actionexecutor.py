@@ -0,0 +1,91 @@
+# dependencies
+from itertools import count
+from threading import Lock, Thread
+import logging
+import queue
+import time
+
+_log = logging.getLogger().getChild(__name__)
+
+# Priorities of the actions, lower runs first
+PRIORITY = {
+    'SAFETY': 0,    # feed hold and laser off, run by a dedicated worker
+    'GRBL': 1,
+    'OUTPUT': 2,
+}
+
+
+class ActionExecutor:
+    ''' Runs the actions of callbacks outside of the thread that raised the
+    event. Safety actions have their own worker, so they never wait for a
+    slow action. Other actions are run in order of priority. '''
+
+    def __init__(self, metrics=None):
+        self.safety_queue = queue.Queue()
+        self.action_queue = queue.PriorityQueue()
+
+        self.m_dispatch = None
+        if metrics is not None:
+            self.m_dispatch = metrics.histogram(
+                'callback_dispatch_seconds',
+                'Time from an event until its action starts')
+            metrics.gauge('callback_queue_actions', 'Actions waiting',
+                          self.action_queue.qsize, queue='actions')
+            metrics.gauge('callback_queue_actions', 'Actions waiting',
+                          self.safety_queue.qsize, queue='safety')
+        self._order = count()   # keeps actions of equal priority in order
+        self._quit = False
+
+        self.stats = {}     # action name: [count, total ms, max ms]
+        self._stats_lock = Lock()
+
+        self.safety_worker = Thread(
+            target=self._worker, args=(self.safety_queue,), daemon=True)
+        self.safety_worker.start()
+        self.action_worker = Thread(
+            target=self._worker, args=(self.action_queue,), daemon=True)
+        self.action_worker.start()
+
+    def submit(self, priority, name, function, *args):
+        item = (priority, next(self._order), name, function, args,
+                time.perf_counter())
+        if priority == PRIORITY['SAFETY']:
+            self.safety_queue.put(item)
+        else:
+            self.action_queue.put(item)
+
+    def close(self):
+        self._quit = True
+        # wake up the workers
+        self.safety_queue.put((-1, -1, None, None, (), 0))
+        self.action_queue.put((-1, -1, None, None, (), 0))
+
+    def _worker(self, action_queue):
+        while not self._quit:
+            priority, _, name, function, args, submit_time = \
+                action_queue.get()
+            if function is None:
+                continue
+
+            start_time = time.perf_counter()
+            if self.m_dispatch is not None:
+                self.m_dispatch.observe(start_time-submit_time)
+            try:
+                function(*args)
+            except Exception:
+                _log.exception(f'Action "{name}" failed')
+            duration = (time.perf_counter()-start_time)*1000
+
+            with self._stats_lock:
+                stats = self.stats.setdefault(name, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += duration
+                stats[2] = max(stats[2], duration)
+
+    def summary(self):
+        ''' returns a line per action with the count, mean and max duration '''
+        with self._stats_lock:
+            stats = sorted(self.stats.items())
+        return '\n'.join(
+            f'{name}: n={n}, mean={total/n:.3f}ms, max={max_ms:.3f}ms'
+            for name, (n, total, max_ms) in stats)
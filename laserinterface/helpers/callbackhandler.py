@@ -1,22 +1,44 @@
+from threading import Lock
 import logging
-import ruamel.yaml
 
 from laserinterface.data.grbl_doc import COMMANDS
+from laserinterface.datamanager.config import config_manager
+from laserinterface.helpers.actionexecutor import ActionExecutor, PRIORITY
 
 _log = logging.getLogger().getChild(__name__)
 
-yaml = ruamel.yaml.YAML()
-config_file = 'laserinterface/data/config.yaml'
-with open(config_file, 'r') as ymlfile:
-    config = yaml.load(ymlfile)
-
 
 class CallbackHandler:
-    def __init__(self, grbl, gpio):
+    def __init__(self, grbl, gpio, machines=None):
         self.grbl = grbl
         self.gpio = gpio
+        # the grbl commands also go to the other interlocked stations of
+        # the MachinePool, their lasers are stopped by the same inputs
+        self.grbls = [grbl]
+        if machines is not None:
+            self.grbls += [station.grbl for station in machines.interlocked
+                           if station.grbl is not grbl]
 
-    def do_callback(self, event):
+        self.rules = {}         # (type, name, state): [(rule_nr, actions)]
+        self.event_plans = {}   # event: [(action, target, value)]
+        self.safety_outputs = set()     # switched off with safety priority
+        self.compile(config_manager['CALLBACKS'])
+        config_manager.subscribe(self.reload, ('CALLBACKS', 'GPIO'))
+
+        # outputs submitted to the executor and not yet applied, events are
+        # resolved against them under the lock that also applies them
+        self._pending = {}
+        self._lock = Lock()
+
+        self.executor = ActionExecutor(metrics=gpio.machine.metrics)
+
+    def reload(self, changed_sections=None):
+        ''' Compile the callbacks of the reloaded config again. Events that
+        are being handled keep using the old rules. '''
+        self.compile(config_manager['CALLBACKS'])
+        _log.info('Reloaded the callbacks from the config')
+
+    def compile(self, callbacks):
         # Callbacks can be configured in the config.yaml in this format:
         # events/rules:
         #   {OUT/IN}_{PIN_NAME/ANY}_{ON/OFF/ANY}
@@ -26,57 +48,169 @@ class CallbackHandler:
         #   OUT_{NAME}: {ON/OFF/EQUAL/OPPOSITE}
         #   SEND_GRBL: {HOLD/CONTINUE}
 
+        # The rules are stored by (type, name, state), where name and state
+        # can be 'ANY'. state is None for TEMP and JOB rules.
+        rules = {}
+        for rule_nr, (rule, actions) in enumerate(callbacks.items()):
+            rule_type, rule_name = rule.upper().strip().split('_', 1)
+            rule_state = None
+            if rule_type not in ('TEMP', 'JOB'):
+                rule_name, rule_state = rule_name.rsplit('_', 1)
+
+            actions = [(str(name).upper(), str(state).upper())
+                       for name, state in actions.items()]
+            for name, state in actions:
+                if name.startswith('OUT'):
+                    valid = state in ('ON', 'OFF', 'EQUAL', 'OPPOSITE')
+                else:
+                    valid = (name == 'SEND_GRBL'
+                             and state in ('HOLD', 'RESUME'))
+                if not valid:
+                    _log.warning(f'action {name}: {state} not recognized')
+
+            rules.setdefault((rule_type, rule_name, rule_state), []).append(
+                (rule_nr, actions))
+
+        # replace both at once, so a running event never mixes old and new
+        self.rules, self.event_plans = rules, {}
+        self.safety_outputs = {
+            f'OUT_{name}'.upper()
+            for name in config_manager['GPIO'].get('SAFETY_OUTPUTS') or ()}
+
+    def _plan(self, event):
+        ''' Find all rules matching the event and turn their actions into a
+        list of ('OUT', name, state) and ('GRBL', command, None) items '''
         # type = {OUT/IN} or TEMP or JOB
         # name = {PIN_NAME/ANY} or {RED/ORANGE/GREEN} or {START/STOP/PAUSE}
         # event = {ON/OFF/ANY} or None
-
-        event = event.upper()
-        _log.info(f'Callback started for {event}')
-
         event_type, event_name = event.split('_', 1)
-        if event_type not in ('TEMP', 'JOB'):
+        event_state = None
+        if event_type in ('TEMP', 'JOB'):
+            keys = [(event_type, event_name, None)]
+        else:
             event_name, event_state = event_name.rsplit('_', 1)
+            keys = [(event_type, name, state)
+                    for name in (event_name, 'ANY')
+                    for state in (event_state, 'ANY')]
 
-        # GPIO
-        for rule, actions in config['CALLBACKS'].items():
-            rule_type, rule_name = rule.upper().strip().split('_', 1)
+        # keep the order of the config file
+        matches = []
+        for key in keys:
+            matches.extend(self.rules.get(key, ()))
+        matches.sort(key=lambda match: match[0])
 
-            activate = False
-            if rule_type in ('TEMP', 'JOB'):
-                activate = (rule == event)
-            else:      # GPIO rules
-                rule_name, rule_state = rule_name.rsplit('_', 1)
-                activate = bool(
-                    (rule_type == event_type) and
-                    ((rule_name == 'ANY') or (rule_name == event_name)) and
-                    ((rule_state == 'ANY') or (rule_state == event_state))
-                )
-
-            if activate:
-                _log.info(f'"{event}" triggered "{actions}"')
-                for action_name, action_state in actions.items():
-                    # trigger GPIO actions
-                    if action_name.startswith('OUT'):
-                        if action_state == 'ON':
-                            self.gpio.pin_write(action_name, True)
-                        elif action_state == 'OFF':
-                            self.gpio.pin_write(action_name, False)
-                        elif action_state == 'EQUAL':
-                            new_state = True if event_state == 'ON' else False
-                            self.gpio.pin_write(action_name, new_state)
-                        elif action_state == 'OPPOSITE':
-                            new_state = True if event_state == 'OFF' else False
-                            self.gpio.pin_write(action_name, new_state)
-                        else:
-                            _log.warning(
-                                f'action state: {action_state} not recognized')
-
-                    # GRBL commands
-                    if action_name == 'SEND_GRBL':
-                        if action_state == 'HOLD':
-                            self.grbl.serial_send(COMMANDS['feed hold'])
-                        elif action_state == 'RESUME':
-                            self.grbl.serial_send(COMMANDS['cycle resume'])
-                        else:
-                            _log.warning(
-                                f'action state: {action_state} not recognized')
+        plan = []
+        for rule_nr, actions in matches:
+            for action_name, action_state in actions:
+                # GPIO actions
+                if action_name.startswith('OUT'):
+                    if action_state == 'ON':
+                        new_state = True
+                    elif action_state == 'OFF':
+                        new_state = False
+                    elif action_state == 'EQUAL':
+                        new_state = (event_state == 'ON')
+                    elif action_state == 'OPPOSITE':
+                        new_state = (event_state == 'OFF')
+                    else:
+                        continue
+                    plan.append(('OUT', action_name, new_state))
+
+                # GRBL commands
+                elif action_name == 'SEND_GRBL':
+                    if action_state == 'HOLD':
+                        plan.append(('GRBL', COMMANDS['feed hold'], None))
+                    elif action_state == 'RESUME':
+                        plan.append(('GRBL', COMMANDS['cycle resume'], None))
+        return plan
+
+    def get_plan(self, event):
+        ''' The plan of an event is made once and then reused '''
+        event_plans = self.event_plans
+        plan = event_plans.get(event)
+        if plan is None:
+            plan = event_plans[event] = self._plan(event.upper())
+        return plan
+
+    def resolve(self, event):
+        ''' Follow the cascade of callbacks started by the event. Output
+        changes start new events, which are handled here instead of through
+        the gpio. The outputs are taken as they will be once the submitted
+        changes are applied, called with the lock held. Returns the changed
+        outputs and the grbl commands. '''
+        gpio_status = dict(self.gpio.machine.gpio_status)
+        gpio_status.update(self._pending)
+        outputs = {}
+        commands = []
+        handled = set()
+        events = [event]
+        while events:
+            event = events.pop(0)
+            if event in handled:
+                continue    # prevents loops between rules
+            handled.add(event)
+
+            for action, target, value in self.get_plan(event):
+                if action == 'GRBL':
+                    if target not in commands:
+                        commands.append(target)
+                elif outputs.get(target, gpio_status.get(target)) != value:
+                    outputs[target] = value
+                    events.append(f'{target}_{"ON" if value else "OFF"}')
+
+        # only keep the outputs that end up different from the current state
+        outputs = {item: value for item, value in outputs.items()
+                   if gpio_status.get(item) != value}
+        return outputs, commands
+
+    def _send_grbl(self, command, trace):
+        latency = self.gpio.machine.latency
+        latency.resume(trace)
+        latency.mark('action')
+        self.grbl.serial_send(command)
+        latency.discard()
+        for grbl in self.grbls[1:]:
+            grbl.serial_send(command)
+
+    def _apply_outputs(self, outputs):
+        ''' Set the outputs that were not changed again by a later event '''
+        with self._lock:
+            changes = {item: value for item, value in outputs.items()
+                       if self._pending.get(item) == value}
+            for item in changes:
+                del self._pending[item]
+            self.gpio.apply_outputs(changes)
+
+    def do_callback(self, event):
+        ''' Start the actions of all rules matching the event. The actions
+        are run by the executor, safety actions first: the feed hold and
+        switching off the SAFETY_OUTPUTS of the gpio config. '''
+        latency = self.gpio.machine.latency
+        latency.mark('callback')
+        trace = latency.current()
+
+        # every event passes here, the message is only made when shown
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug('Callback started for %s', event)
+        with self._lock:
+            outputs, commands = self.resolve(event)
+            self._pending.update(outputs)
+
+            for command in commands:
+                if command == COMMANDS['feed hold']:
+                    priority = PRIORITY['SAFETY']
+                else:
+                    priority = PRIORITY['GRBL']
+                self.executor.submit(priority, f'SEND_GRBL {command}',
+                                     self._send_grbl, command, trace)
+
+            safety = {item: value for item, value in outputs.items()
+                      if item in self.safety_outputs and not value}
+            if safety:
+                self.executor.submit(PRIORITY['SAFETY'], 'SAFETY OUTPUTS',
+                                     self._apply_outputs, safety)
+            others = {item: value for item, value in outputs.items()
+                      if item not in safety}
+            if others:
+                self.executor.submit(PRIORITY['OUTPUT'], 'OUTPUTS',
+                                     self._apply_outputs, others)
@@ -0,0 +1,162 @@
+# dependencies
+from threading import Event, Thread
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+
+_log = logging.getLogger().getChild(__name__)
+
+# inotify events, see inotify(7)
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+EVENT = struct.Struct('iIII')   # watch descriptor, mask, cookie, name length
+
+
+def _inotify():
+    ''' Returns the libc with inotify, or None '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None,
+                           use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def snapshot(directory):
+    ''' All files below directory: {path: (modification time, size)} '''
+    files = {}
+    pending = [directory]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=True):
+                            pending.append(entry.path)
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            files[entry.path] = (stat.st_mtime_ns,
+                                                 stat.st_size)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return files
+
+
+class DirWatcher():
+    def __init__(self, directory, callback, settle=1.0):
+        # DirWatcher calls callback(paths) with the files and directories
+        # below directory that were added, changed or removed. The changes
+        # are collected until none came in for settle seconds, so a file
+        # that is being copied is reported once it is complete. On linux the
+        # kernel reports the changes (inotify), elsewhere the directory is
+        # compared every settle seconds. A callback with the directory
+        # itself means everything may have changed.
+
+        self.directory = os.path.abspath(directory)
+        self.callback = callback
+        self.settle = settle
+        self._quit = Event()
+        self._watches = {}  # watch descriptor: directory
+
+        libc = _inotify()
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC) \
+            if libc else -1
+        self._libc = libc
+        if self._fd < 0:
+            _log.info(f'polling {self.directory} for changes')
+            self._files = snapshot(self.directory)
+            target = self._poll
+        else:
+            self._add_tree(self.directory)
+            target = self._read_events
+        self._thread = Thread(target=target, daemon=True)
+        self._thread.start()
+
+    def _add_tree(self, directory):
+        ''' Watch directory and all directories below it '''
+        for root, _, _ in os.walk(directory, followlinks=True):
+            wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                _log.warning(f'can not watch {root}: '
+                             f'{os.strerror(ctypes.get_errno())}')
+                continue
+            self._watches[wd] = root
+
+    def _read_events(self):
+        pending = set()
+        while not self._quit.is_set():
+            ready, _, _ = select.select([self._fd], [], [], self.settle)
+            if not ready:
+                if pending:
+                    self._report(pending)
+                    pending = set()
+                continue
+            try:
+                data = os.read(self._fd, 64*1024)
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                _log.error(f'watching {self.directory} failed: {e}')
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                name = data[offset+EVENT.size:offset+EVENT.size+length]
+                offset += EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, everything may have changed
+                    pending.add(self.directory)
+                    continue
+                directory = self._watches.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self._watches[wd]
+                    continue
+                path = os.path.join(directory,
+                                    os.fsdecode(name.rstrip(b'\0')))
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(path)
+                pending.add(path if name else directory)
+        os.close(self._fd)
+
+    def _poll(self):
+        pending = set()
+        while not self._quit.wait(self.settle):
+            files, self._files = self._files, snapshot(self.directory)
+            changed = {path for path in files.keys() | self._files.keys()
+                       if files.get(path) != self._files.get(path)}
+            if changed:
+                pending |= changed
+            elif pending:
+                self._report(pending)
+                pending = set()
+
+    def _report(self, paths):
+        try:
+            self.callback(paths)
+        except Exception:
+            _log.exception('directory change callback failed')
+
+    def close(self):
+        ''' Stop watching, within settle seconds '''
+        self._quit.set()
@@ -0,0 +1,339 @@
+# dependencies
+from concurrent.futures import FIRST_COMPLETED, wait
+from stat import S_ISREG
+from threading import Event, Lock, Thread
+import logging
+import os
+import sqlite3
+import tempfile
+
+from laserinterface.datamanager.config import config_manager
+from laserinterface.helpers import jobqueue
+from laserinterface.helpers.dirwatcher import DirWatcher, snapshot
+from laserinterface.helpers.gcodereader import parse_file
+from laserinterface.helpers.thumbnail import ThumbnailCache, content_hash
+from laserinterface.helpers.thumbnail import encode_png, laser_length, render
+from laserinterface.helpers.toolpathcache import file_key
+
+_log = logging.getLogger().getChild(__name__)
+
+config = config_manager['GENERAL']
+
+# the files shown by the file chooser
+GCODE_EXTENSIONS = ('.txt', '.nc', '.gcode', '.tap', '.cnc', '.apt', '.ncc',
+                    '.hnc', '.dnc')
+SCHEMA_VERSION = 2
+SCHEMA = '''
+    CREATE TABLE files (
+        path TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        described INTEGER NOT NULL DEFAULT 0,
+        lines INTEGER,
+        min_x REAL, min_y REAL, max_x REAL, max_y REAL,
+        duration REAL,
+        laser_length REAL,
+        error TEXT,
+        hash TEXT
+    );
+    CREATE INDEX files_name ON files (name COLLATE NOCASE);
+    CREATE INDEX files_mtime ON files (mtime_ns);
+    CREATE INDEX files_duration ON files (duration);
+    CREATE INDEX files_size ON files (size);
+'''
+# the columns of an entry
+COLUMNS = ('path', 'name', 'size', 'mtime_ns', 'described', 'lines', 'min_x',
+           'min_y', 'max_x', 'max_y', 'duration', 'laser_length', 'error',
+           'hash')
+SORT_KEYS = {
+    'name': 'name COLLATE NOCASE',
+    'date': 'mtime_ns',
+    'duration': 'duration',
+    'size': 'size',
+}
+
+
+def is_gcode(path):
+    return path.lower().endswith(GCODE_EXTENSIONS)
+
+
+def _escape(text):
+    ''' Escape the wildcards of LIKE '''
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def describe(filename, cache_dir):
+    ''' Return the values of the library entry of a file, runs in a parse
+    worker. The file is only parsed when its content is not in the cache, the
+    thumbnail is stored in the cache. '''
+    try:
+        key = file_key(filename)
+        digest = content_hash(filename)
+    except OSError:
+        return None     # removed
+    cache = ThumbnailCache(cache_dir)
+    values = cache.load(digest)
+    if values is None:
+        toolpath = parse_file(filename)
+        if not toolpath.key:
+            return None     # removed, the error is not of the content
+        if toolpath.error:
+            values = {'error': toolpath.error}
+            cache.store(digest, values)
+        else:
+            values = {
+                'lines': toolpath.lines,
+                'min_x': toolpath.min_x,
+                'min_y': toolpath.min_y,
+                'max_x': toolpath.max_x,
+                'max_y': toolpath.max_y,
+                'duration': toolpath.job_duration,
+                'laser_length': laser_length(toolpath.paths),
+                'error': '',
+            }
+            cache.store(digest, values, encode_png(render(
+                toolpath.paths, toolpath.min_x, toolpath.min_y,
+                toolpath.max_x, toolpath.max_y)))
+    return dict(values, path=filename, mtime_ns=key[0], size=key[1],
+                hash=digest)
+
+
+class GcodeLibrary():
+    def __init__(self, directory=None, db_file=None):
+        # GcodeLibrary is an index of the gcode files below GCODE_DIR, kept
+        # in a sqlite database: size, modification time, line count, bounds,
+        # estimated duration, laser on length and the hash of the content of
+        # every file. The thumbnails are kept in a ThumbnailCache by that
+        # hash, so a copied or renamed file is not parsed again.
+        # Browsing, sorting and searching only query the database. New and
+        # changed files are listed at once and described in the background
+        # by the parse workers, at most one file per worker at a time, so a
+        # queued job is parsed without waiting for the whole library. The
+        # changes are reported by a DirWatcher, the whole directory is
+        # compared with the database at start. Callbacks are called with
+        # the changed paths.
+
+        self.directory = os.path.abspath(directory or config['GCODE_DIR'])
+        self.db_file = db_file or config.get(
+            'LIBRARY_FILE', 'laserinterface/data/library.db')
+        self.callbacks = []
+        try:
+            self.cache = ThumbnailCache(config.get(
+                'THUMBNAIL_DIR', 'laserinterface/data/thumbnails'))
+        except OSError as e:
+            # the files are parsed again at every start
+            _log.error(f'could not open the thumbnail cache: {e}')
+            self.cache = ThumbnailCache(tempfile.mkdtemp(prefix='thumbnails'))
+
+        self._lock = Lock()
+        try:
+            self.db = sqlite3.connect(self.db_file, check_same_thread=False)
+            self._create()
+        except sqlite3.Error as e:
+            # the index is rebuilt at every start
+            _log.error(f'could not open the library {self.db_file}: {e}')
+            self.db = sqlite3.connect(':memory:', check_same_thread=False)
+            self._create()
+        self.db.row_factory = sqlite3.Row
+
+        self._changed = set()   # paths to check, the directory for all
+        self._wake = Event()
+        self._quit = Event()
+        self.watcher = None
+        self._scanner = None
+
+    def _create(self):
+        with self._lock:
+            # the index can be rebuilt, changes do not have to survive a
+            # power cut
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            version = self.db.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                self.db.executescript('DROP TABLE IF EXISTS files;' + SCHEMA)
+                self.db.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+            self.db.commit()
+
+    def start(self):
+        ''' Compare the directory with the index and follow its changes '''
+        if self._scanner is not None:
+            return
+        self.rescan()
+        self.watcher = DirWatcher(self.directory, self.rescan)
+        self._scanner = Thread(target=self._scan, daemon=True)
+        self._scanner.start()
+
+    def close(self):
+        self._quit.set()
+        self._wake.set()
+        if self.watcher is not None:
+            self.watcher.close()
+
+    def rescan(self, paths=None):
+        ''' Check the paths (files or directories) again, all if None '''
+        with self._lock:
+            self._changed |= set(paths or (self.directory,))
+        self._wake.set()
+
+    # queries
+    def query(self, search='', sort='name', descending=False):
+        ''' The entries (dicts without the thumbnail) with search in their
+        name, sorted by sort (name, date, duration or size) '''
+        pattern = '%' + _escape(search) + '%'
+        order = f'{SORT_KEYS[sort]} {"DESC" if descending else "ASC"}'
+        with self._lock:
+            rows = self.db.execute(
+                f'SELECT {", ".join(COLUMNS)} FROM files '
+                f"WHERE name LIKE ? ESCAPE '\\' ORDER BY {order}, name",
+                (pattern,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def entry(self, path):
+        with self._lock:
+            row = self.db.execute(
+                f'SELECT {", ".join(COLUMNS)} FROM files WHERE path = ?',
+                (os.path.abspath(path),)).fetchone()
+        return dict(row) if row else None
+
+    def thumbnail(self, path):
+        ''' The thumbnail (png) of a file, or None '''
+        with self._lock:
+            row = self.db.execute(
+                'SELECT hash FROM files WHERE path = ?',
+                (os.path.abspath(path),)).fetchone()
+        return self.cache.thumbnail(row[0]) if row and row[0] else None
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    # scanning
+    def _scan(self):
+        pending = []    # files to describe
+        running = {}    # Future: path
+        prune = False   # the cache, after the whole directory was compared
+        while not self._quit.is_set():
+            if not pending and not running:
+                if prune:
+                    self._prune()
+                    prune = False
+                self._wake.wait()
+                self._wake.clear()
+            with self._lock:
+                changed, self._changed = self._changed, set()
+            prune |= self.directory in changed
+            if changed:
+                try:
+                    todo = self._compare(changed)
+                except Exception:
+                    # compared again with the next change
+                    _log.exception('library: comparing the files failed')
+                    todo = set()
+                pending = [path for path in pending if path not in todo]
+                pending.extend(sorted(todo))
+
+            while pending and len(running) < jobqueue.workers():
+                path = pending.pop(0)
+                try:
+                    running[jobqueue.submit(
+                        describe, path, self.cache.directory)] = path
+                except RuntimeError:
+                    return  # the workers are shut down
+            if not running:
+                continue
+            done, _ = wait(list(running), timeout=0.5,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                path = running.pop(future)
+                try:
+                    values = future.result()
+                    if values is not None:
+                        self._store(values)
+                except Exception as e:
+                    _log.error(f'could not describe {path}: {e!r}')
+                    continue
+                self._notify({path})
+
+    def _compare(self, paths):
+        ''' Update the index of the paths with the files on disk. Returns the
+        files that have to be described. '''
+        files = {}
+        checked = []    # (path, everything below it)
+        for path in paths:
+            path = os.path.abspath(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None     # removed, like a renamed .part file
+            if stat is not None and S_ISREG(stat.st_mode):
+                files[path] = (stat.st_mtime_ns, stat.st_size)
+                checked.append((path, False))
+            else:
+                # a directory, or removed
+                files.update(snapshot(path))
+                checked.append((path, True))
+        files = {path: key for path, key in files.items() if is_gcode(path)}
+
+        with self._lock:
+            known = {}
+            for path, below in checked:
+                pattern = _escape(path.rstrip(os.sep) + os.sep) + '%' \
+                    if below else ''
+                for row in self.db.execute(
+                        'SELECT path, mtime_ns, size, described FROM files '
+                        "WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                        (path, pattern)):
+                    known[row[0]] = (row[1], row[2], row[3])
+
+            removed = [path for path in known if path not in files]
+            todo = set()
+            for path, key in files.items():
+                if known.get(path, (None, None, 0)) == key + (1,):
+                    continue
+                todo.add(path)
+                # listed at once, described later
+                self.db.execute(
+                    'INSERT INTO files (path, name, size, mtime_ns) '
+                    'VALUES (?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET '
+                    'size = excluded.size, mtime_ns = excluded.mtime_ns, '
+                    'described = 0',
+                    (path, os.path.relpath(path, self.directory),
+                     key[1], key[0]))
+            self.db.executemany('DELETE FROM files WHERE path = ?',
+                                [(path,) for path in removed])
+            self.db.commit()
+
+        if removed or todo:
+            _log.info(f'library: {len(todo)} new or changed files, '
+                      f'{len(removed)} removed')
+            self._notify(set(removed) | todo)
+        return todo
+
+    def _store(self, values):
+        values = dict(values, described=1)
+        columns = [key for key in values if key != 'path']
+        with self._lock:
+            # only if the file was not changed again while it was described
+            self.db.execute(
+                f'UPDATE files SET '
+                f'{", ".join(f"{key} = :{key}" for key in columns)} '
+                f'WHERE path = :path AND mtime_ns = :mtime_ns '
+                f'AND size = :size', values)
+            self.db.commit()
+
+    def _prune(self):
+        with self._lock:
+            keep = {row[0] for row in self.db.execute(
+                'SELECT hash FROM files WHERE hash IS NOT NULL')}
+        try:
+            self.cache.prune(keep)
+        except OSError as e:
+            _log.error(f'could not prune the thumbnail cache: {e}')
+
+    def _notify(self, paths):
+        for callback in list(self.callbacks):
+            try:
+                callback(paths)
+            except Exception:
+                _log.exception('library callback failed')
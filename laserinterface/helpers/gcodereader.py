@@ -1,15 +1,21 @@
 
 # Dependencies
-from dataclasses import dataclass, field
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field, replace
+from functools import cached_property
 import logging
 import math
+import os
 import re
-import sys
+
+from laserinterface.datamanager.tracing import tracer
+from laserinterface.helpers.toolpathcache import file_key, toolpath_cache
 
 _log = logging.getLogger().getChild(__name__)
 
 # Constants values
 INCH = 25.4    # mm per inch
+CHECKPOINT_INTERVAL = 1000    # lines between the stored modal states
 
 # Constants for movement types
 MOVE_TYPE = {
@@ -29,6 +35,189 @@ class Path:
     laser_on: bool = False  # laser powered on (M3, M4) of off (M5) on path
     start_line: int = 0     # Linenumber of gcode command where the move starts
     end_line: int = 0       # Linenumber of gcode command where the move ended
+    point_lines: list = field(default_factory=list)  # file line of each point
+
+
+@dataclass
+class ModalState:
+    ''' The modal state of grbl at the start of a line in a gcode file. Used
+    to resume a job at any line. Positions are in mm, the feed in the units of
+    the file. '''
+    line: int = 0           # Linenumber in the file where the state applies
+    offset: int = 0         # Byte offset of that line in the file
+    inches: bool = False    # G20 (True) or G21 (False)
+    absolute: bool = True   # G90 (True) or G91 (False)
+    motion: str = 'G0'      # G0, G1, G2 or G3
+    spindle: str = 'M5'     # M3, M4 or M5
+    feed: float = 0.0
+    power: float = 0.0
+    x: float = 0.0
+    y: float = 0.0
+
+    re_words = re.compile(r'([A-Z])\s*([+-]?[\d.]+)')
+
+    def update(self, line):
+        ''' Apply the modal commands of a single line of gcode. '''
+        line = re.sub(r'\(.*?\)|;.*', '', line).upper().strip()
+        if not line or line.startswith('$'):
+            return
+
+        x = y = None
+        for letter, value in self.re_words.findall(line):
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+            if letter == 'G':
+                if value in (0, 1, 2, 3):
+                    self.motion = f'G{int(value)}'
+                elif value in (20, 21):
+                    self.inches = (value == 20)
+                elif value in (90, 91):
+                    self.absolute = (value == 90)
+            elif letter == 'M' and value in (3, 4, 5):
+                self.spindle = f'M{int(value)}'
+            elif letter == 'F':
+                self.feed = value
+            elif letter == 'S':
+                self.power = value
+            elif letter == 'X':
+                x = value
+            elif letter == 'Y':
+                y = value
+
+        # G20/G21 and G90/G91 apply to the whole line
+        scale = INCH if self.inches else 1.0
+        if x is not None:
+            self.x = x*scale if self.absolute else self.x + x*scale
+        if y is not None:
+            self.y = y*scale if self.absolute else self.y + y*scale
+
+    def preamble(self):
+        ''' Returns the lines that move to the stored position with the laser
+        off, and then restore the modal state. '''
+        lines = ['M5', 'G21', 'G90', f'G0X{self.x:.3f}Y{self.y:.3f}']
+        if self.inches:
+            lines.append('G20')
+        if not self.absolute:
+            lines.append('G91')
+        if self.motion in ('G0', 'G1'):
+            lines.append(self.motion)
+        else:
+            _log.warning(f'Resuming inside an arc ({self.motion}), the next '
+                         f'line has to repeat the arc command')
+        if self.feed:
+            lines.append(f'F{self.feed:g}')
+        lines.append(f'S{self.power:g}')
+        if self.spindle != 'M5':
+            lines.append(self.spindle)
+        return lines
+
+
+def seek_line(file, line_nr, checkpoint=None):
+    ''' Move a file opened in binary mode to the start of line_nr, starting at
+    the checkpoint (a ModalState). Returns the modal state at that line. '''
+    state = replace(checkpoint) if checkpoint else ModalState()
+    file.seek(state.offset)
+    while state.line < line_nr:
+        raw = file.readline()
+        if not raw:
+            break
+        state.update(raw.decode('ascii', 'ignore'))
+        state.offset += len(raw)
+        state.line += 1
+    return state
+
+
+class ToolpathIndex:
+    ''' Maps line numbers of a gcode file to the points of its paths. All
+    point line numbers are stored in drawing order, so the amount of points
+    executed up to a line is found with a binary search. The modal state
+    checkpoints are used to resume the file at any line. '''
+
+    def __init__(self, paths=(), checkpoints=(), filename=''):
+        self.paths = list(paths)
+        self.offsets = []        # index of the first point of each path
+        self.point_lines = []    # file line number of every point
+
+        self.filename = filename
+        self.checkpoints = list(checkpoints)
+        self.checkpoint_lines = [state.line for state in self.checkpoints]
+
+        for _path in self.paths:
+            self.offsets.append(len(self.point_lines))
+            self.point_lines.extend(_path.point_lines)
+
+    def __len__(self):
+        return len(self.point_lines)
+
+    def points_done(self, line_nr):
+        ''' returns the number of points reached when line_nr is executed '''
+        return bisect_right(self.point_lines, line_nr)
+
+    def points_of_line(self, line_nr):
+        ''' returns the range (first, last) of the points added by line_nr,
+        empty for a line without a move '''
+        return (bisect_left(self.point_lines, line_nr),
+                bisect_right(self.point_lines, line_nr))
+
+    def point_ranges(self, start, stop):
+        ''' Yields (path, first, last) for each path that has points in the
+        range start:stop. first and last are indices in the path's lists. '''
+        k = max(bisect_right(self.offsets, start) - 1, 0)
+        while k < len(self.paths) and self.offsets[k] < stop:
+            _path = self.paths[k]
+            first = max(start - self.offsets[k], 0)
+            last = min(stop - self.offsets[k], len(_path.points_x))
+            if first < last:
+                yield _path, first, last
+            k += 1
+
+    def checkpoint_before(self, line_nr):
+        ''' returns the last stored ModalState at or before line_nr '''
+        k = bisect_right(self.checkpoint_lines, line_nr) - 1
+        if k < 0:
+            return None
+        return self.checkpoints[k]
+
+
+@dataclass
+class Toolpath:
+    ''' Everything known of a gcode file after parsing it: the paths to
+    preview, the checkpoints to resume it, its bounds in mm and the estimated
+    duration in minutes. key is the version of the file that was parsed.
+    warnings are (line number, message) of the commands that were skipped,
+    error is set when the file can not be used at all. '''
+    filename: str = ''
+    key: tuple = ()
+    paths: list = field(default_factory=list)
+    checkpoints: list = field(default_factory=list)
+    lines: int = 0
+    job_duration: float = 0.0
+    max_x: float = 0.0
+    max_y: float = 0.0
+    min_x: float = 0.0
+    min_y: float = 0.0
+    warnings: list = field(default_factory=list)
+    error: str = ''
+
+    @cached_property
+    def index(self):
+        return ToolpathIndex(self.paths, self.checkpoints, self.filename)
+
+
+def keep_path(_path):
+    ''' A finished path is kept if it has a movement '''
+    if len(_path.points_x) == 2:
+        return not (_path.points_x[0] == _path.points_x[1]
+                    and _path.points_y[0] == _path.points_y[1])
+    return len(_path.points_x) >= 3
+
+
+def parse_file(filename):
+    ''' Parse a file without touching the state of the application, used by
+    the workers of the JobQueue '''
+    return GcodeReader().parse(filename)
 
 
 class GcodeReader:
@@ -41,6 +230,11 @@ class GcodeReader:
 
     job_duration = 0.0
 
+    # index of the last fully handled file. It is kept by reset(), so a
+    # running job can still be mapped after the preview memory is cleared
+    line_index = ToolpathIndex()
+    file_line = 0
+
     max_x = 0.0
     max_y = 0.0
     min_x = 0.0
@@ -51,10 +245,19 @@ class GcodeReader:
 
     def reset(self):
         self.complete_paths = []
-        self.current_path = Path([0], [0])
+        self.current_path = Path([0], [0], point_lines=[-1])
+        self.file_line = 0
+        self.checkpoints = []
+        self.warnings = []
 
+        self.unit_factor = 1.0
+        self.absolute_steps = True
         self.job_duration = 0
         self.feed_rate = 1000
+        self.feed = 0.0
+        self.power = 0.0
+        self.target = (0.0, 0.0)
+        self.spindle = 'M5'
         self.max_x = 0
         self.max_y = 0
         self.min_x = 0
@@ -65,43 +268,113 @@ class GcodeReader:
             self.new_job_callbacks.append(callback)
         return callable(callback)
 
+    @tracer.traced('gcode.handle_file')
     def handle_file(self, filename) -> list:
-        ''' Read all lines in a file and call the handling function
+        ''' Preview a file and make it the current job, a file parsed before
+        (or ahead by the JobQueue) is taken from the toolpath cache.
         returns list of paths'''
 
-        _log.info(f'gcode reader starting to handle {filename}')
-        try:
-            self.reset()
-            with open(filename) as f:
-                for line_number, fullString in enumerate(f):
-                    # strip comments
-                    fullString = re.sub(r'\(.*?\)|;.*', '', fullString)
-                    fullString = fullString.upper().strip()
-
-                    # skip lines without commands
-                    if fullString == '':
-                        continue
-
-                    # split lines containing multiple commands
-                    listOfLines = fullString.split('G')
-                    if len(listOfLines) > 1:  # if multiple commands found
-                        for line in listOfLines:
-                            if len(line) > 0:  # If the line is not blank
-                                self._handle_command('G'+line, line_number)
-                                line_number += 1
-                    else:
-                        self._handle_command(fullString, line_number)
-                        line_number += 1
+        toolpath = toolpath_cache.get(filename)
+        if toolpath is None:
+            toolpath = self.parse(filename)
+            if toolpath.error:
+                _log.info(f'{filename}: {toolpath.error}')
+                return
+            toolpath_cache.put(toolpath)
+        else:
+            _log.info(f'using the parsed toolpath of {filename}')
+        return self.load(toolpath)
 
-            for callback in self.new_job_callbacks:
-                callback()
-            print(f'Complete list of paths takes up for {filename}'
-                  f' {sys.getsizeof(self.complete_paths)} bytes')
-            return self.complete_paths
+    def load(self, toolpath):
+        ''' Make a parsed toolpath the current job, returns its paths '''
+        self.reset()
+        self.complete_paths = toolpath.paths
+        self.checkpoints = toolpath.checkpoints
+        self.file_line = toolpath.lines
+        self.job_duration = toolpath.job_duration
+        self.max_x, self.max_y = toolpath.max_x, toolpath.max_y
+        self.min_x, self.min_y = toolpath.min_x, toolpath.min_y
+        self.line_index = toolpath.index
+
+        for callback in self.new_job_callbacks:
+            callback()
+        return self.complete_paths
+
+    def parse(self, filename):
+        ''' Read all lines in a file and call the handling function, returns
+        the Toolpath of the file. Does not change the current job. '''
 
+        _log.info(f'gcode reader starting to handle {filename}')
+        filename = os.path.abspath(filename)
+        self.reset()
+        toolpath = Toolpath(filename=filename)
+        try:
+            toolpath.key = file_key(filename)
+            with open(filename, 'rb') as f:
+                self._handle_lines(f)
+                toolpath.lines = self.file_line + 1
         except UnicodeDecodeError:
-            _log.info(f'{filename} can not be decoded as text')
-            return
+            toolpath.error = 'can not be decoded as text'
+        except OSError as e:
+            toolpath.error = f'can not be read ({e.strerror})'
+
+        toolpath.paths = self.complete_paths
+        toolpath.checkpoints = self.checkpoints
+        toolpath.job_duration = self.job_duration
+        toolpath.max_x, toolpath.max_y = self.max_x, self.max_y
+        toolpath.min_x, toolpath.min_y = self.min_x, self.min_y
+        toolpath.warnings = self.warnings
+        _log.debug(f'{filename}: {len(toolpath.paths)} paths, '
+                   f'{len(toolpath.warnings)} warnings')
+        return toolpath
+
+    def _handle_lines(self, lines, first_line=0, offset=0):
+        ''' Handle the lines (bytes) of a file, starting at line number
+        first_line, which starts at byte offset in the file '''
+        for line_number, fullString in enumerate(lines, first_line):
+            self.file_line = line_number
+            if line_number % CHECKPOINT_INTERVAL == 0:
+                self.checkpoints.append(
+                    self._modal_state(line_number, offset))
+            offset += len(fullString)
+            fullString = fullString.decode()
+
+            # strip comments
+            fullString = re.sub(r'\(.*?\)|;.*', '', fullString)
+            fullString = fullString.upper().strip()
+
+            # skip lines without commands
+            if fullString == '':
+                continue
+
+            # split lines containing multiple commands
+            listOfLines = fullString.split('G')
+            if len(listOfLines) > 1:  # if multiple commands found
+                for line in listOfLines:
+                    if len(line) > 0:  # If the line is not blank
+                        self._handle_command('G'+line, line_number)
+                        line_number += 1
+            else:
+                self._handle_command(fullString, line_number)
+                line_number += 1
+
+    def _modal_state(self, line_number, offset):
+        ''' Store the current state of the reader as a ModalState '''
+        inches = (self.unit_factor != 1.0)
+        # points are stored multiplied by the unit factor
+        scale = (INCH if inches else 1.0)/self.unit_factor
+        return ModalState(
+            line=line_number,
+            offset=offset,
+            inches=inches,
+            absolute=self.absolute_steps,
+            motion=f'G{self.current_path.move_type}',
+            spindle=self.spindle,
+            feed=self.feed,
+            power=self.power,
+            x=self.target[0]*scale,
+            y=self.target[1]*scale,
+        )
 
     def _handle_command(self, command, line_number=0):
         ''' Check the command and call the path handling functions, or set the
@@ -140,7 +413,8 @@ class GcodeReader:
         elif command.startswith(('G03', 'G3')):
             params['move_type'] = MOVE_TYPE['ARC_CCW']
         elif command.startswith('G'):
-            print('No recognized movement type', command)
+            self.warnings.append(
+                (self.file_line, f'unknown command {command}'))
             return
         else:
             params['move_type'] = self.current_path.move_type
@@ -148,8 +422,10 @@ class GcodeReader:
         # Switching laser on or off
         if command.startswith(('M03', 'M3', 'M04', 'M4')):
             params['laser_on'] = True
+            self.spindle = 'M4' if command.startswith(('M04', 'M4')) else 'M3'
         elif command.startswith(('M05', 'M5')):
             params['laser_on'] = False
+            self.spindle = 'M5'
         else:
             params['laser_on'] = self.current_path.laser_on
 
@@ -160,23 +436,19 @@ class GcodeReader:
             # commands changed: create new path
             params['points_x'] = [self.current_path.points_x[-1]]
             params['points_y'] = [self.current_path.points_y[-1]]
+            params['point_lines'] = [self.current_path.point_lines[-1]]
             params['start_line'] = line_number
             self.current_path.end_line = line_number - 1
-            print('finished calculating a path with',
-                  len(self.current_path.points_x), 'points')
-            if len(self.current_path.points_x) == 2:
-                if not (self.current_path.points_x[0]
-                        == self.current_path.points_x[1]
-                        and self.current_path.points_y[0]
-                        == self.current_path.points_y[1]):
-                    self.complete_paths.append(self.current_path)
-            if len(self.current_path.points_x) >= 3:
-                self.complete_paths.append(self.current_path)
+            self._complete_path(self.current_path)
             self.current_path = Path(**params)
 
         f = re.search(r"F(?=.)(([ ]*)?[+-]?(\d*)(\.(\d+))?)", command)
         if f:
-            self.feed_rate = float(f.groups()[0])*self.unit_factor
+            self.feed = float(f.groups()[0])
+            self.feed_rate = self.feed*self.unit_factor
+        s = re.search(r"S(?=.)(([ ]*)?[+-]?(\d*)(\.(\d+))?)", command)
+        if s:
+            self.power = float(s.groups()[0])
 
         # call the correct handling function to populate the path
         if self.current_path.move_type == MOVE_TYPE['RAPID']:
@@ -190,6 +462,11 @@ class GcodeReader:
 
         return self.current_path
 
+    def _complete_path(self, _path):
+        ''' Store a finished path, unless it does not move '''
+        if keep_path(_path):
+            self.complete_paths.append(_path)
+
     def _handle_line(self, command, rapid=True):
         try:
             last_x = self.current_path.points_x[-1]
@@ -208,6 +485,7 @@ class GcodeReader:
                 if not self.absolute_steps:
                     yTarget += last_y
 
+            self.target = (xTarget, yTarget)
             path_len = math.sqrt((xTarget-last_x)**2+(yTarget-last_y)**2)
             self.job_duration += path_len / self.feed_rate
             self.max_x = max(self.max_x, xTarget)
@@ -219,8 +497,10 @@ class GcodeReader:
                     self.current_path.points_y[-1] == yTarget):
                 self.current_path.points_x.append(xTarget)
                 self.current_path.points_y.append(yTarget)
+                self.current_path.point_lines.append(self.file_line)
         except ValueError:
             _log.error('could not plot -> '+command)
+            self.warnings.append((self.file_line, f'can not plot {command}'))
 
     def _handle_arc(self, command, clockwise=True):
         '''
@@ -255,6 +535,8 @@ class GcodeReader:
         if j:
             jTarget = float(j.groups()[0])*self.unit_factor
 
+        self.target = (xTarget, yTarget)
+
         # calculate required points
         radius = math.sqrt(iTarget**2 + jTarget**2)
         centerX = last_x + iTarget
@@ -305,6 +587,8 @@ class GcodeReader:
                         abs_tol=0.001)):
                     self.current_path.points_x.append(xPosOnLine)
                     self.current_path.points_y.append(yPosOnLine)
+                    self.current_path.point_lines.append(self.file_line)
             else:
                 self.current_path.points_x.append(xPosOnLine)
                 self.current_path.points_y.append(yPosOnLine)
+                self.current_path.point_lines.append(self.file_line)
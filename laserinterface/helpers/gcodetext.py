@@ -0,0 +1,114 @@
+# dependencies
+from array import array
+from bisect import bisect_left
+from threading import Lock
+import logging
+import mmap
+import os
+
+_log = logging.getLogger().getChild(__name__)
+
+BLOCK_SIZE = 1 << 16    # bytes per entry of the line index
+
+
+class GcodeText():
+    def __init__(self, filename):
+        # GcodeText reads lines of a gcode file of any size without loading
+        # it: the file is mapped in memory and the kernel reads (and drops)
+        # the pages that are used. The line index holds the number of lines
+        # before every block of BLOCK_SIZE bytes, a line is found with a
+        # binary search and a search for the newlines in one block. The
+        # index is extended as far as it is needed, 8 bytes per block
+        # (128kB for a 1GB file). Line numbers start at 0, like those of
+        # the GcodeReader. A file that is replaced (renamed over) stays
+        # readable, a file that is truncated is reported as changed.
+
+        self.filename = filename
+        with open(filename, 'rb') as file:
+            self.size = os.fstat(file.fileno()).st_size
+            # an empty file can not be mapped
+            self._data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) \
+                if self.size else b''
+        self._block_lines = array('Q', [0])  # lines before each block
+        self._lock = Lock()
+        self._lines = None
+
+    def changed(self):
+        ''' The file is smaller than when it was opened, reading the missing
+        part would crash '''
+        return bool(self.size) and self._data.size() < self.size
+
+    def _index_to(self, block=None, line=None):
+        ''' Extend the index up to block, or up to the block with the start
+        of line, or to the end of the file '''
+        with self._lock:
+            block_lines = self._block_lines
+            while (len(block_lines)-1)*BLOCK_SIZE < self.size:
+                if block is not None and len(block_lines) > block:
+                    break
+                if line is not None and block_lines[-1] >= line:
+                    break
+                start = (len(block_lines)-1)*BLOCK_SIZE
+                block_lines.append(block_lines[-1] + self._data[
+                    start:start+BLOCK_SIZE].count(b'\n'))
+
+    def __len__(self):
+        if self._lines is None:
+            self._index_to()
+            newlines = self._block_lines[-1]
+            # the last line does not need a newline
+            self._lines = newlines + (
+                self.size > 0 and self._data[self.size-1:] != b'\n')
+        return self._lines
+
+    def offset(self, line):
+        ''' The byte offset of the start of line '''
+        if line <= 0:
+            return 0
+        self._index_to(line=line)
+        # the block with the newline that ends the line before
+        block = bisect_left(self._block_lines, line) - 1
+        if block >= len(self._block_lines) - 1:
+            return self.size
+        position = block*BLOCK_SIZE
+        for _ in range(line - self._block_lines[block]):
+            position = self._data.find(b'\n', position) + 1
+        return position
+
+    def line_at(self, position):
+        ''' The number of the line with the byte at position '''
+        block = position // BLOCK_SIZE
+        self._index_to(block=block)
+        return self._block_lines[block] + self._data[
+            block*BLOCK_SIZE:position].count(b'\n')
+
+    def lines(self, first, count, errors='replace'):
+        ''' count lines from line first on, without their newline '''
+        if self.changed():
+            return []
+        lines = []
+        position = self.offset(first)
+        while len(lines) < count and position < self.size:
+            end = self._data.find(b'\n', position)
+            if end < 0:
+                end = self.size
+            lines.append(self._data[position:end].decode(
+                errors=errors).rstrip('\r'))
+            position = end + 1
+        return lines
+
+    def search(self, text, line=-1, backwards=False):
+        ''' The number of the first line after line (or before it) with text,
+        as written, in capitals or in lower case, or None. A search that
+        ignores case (re) is over 10 times slower. '''
+        if not text or self.changed():
+            return None
+        needles = {text.encode(), text.upper().encode(), text.lower().encode()}
+        if backwards:
+            end = self.offset(line) if line >= 0 else self.size
+            found = max(self._data.rfind(needle, 0, end) for needle in needles)
+        else:
+            start = self.offset(line+1)
+            found = [self._data.find(needle, start) for needle in needles]
+            found = min((k for k in found if k >= 0), default=-1)
+        return self.line_at(found) if found >= 0 else None
@@ -1,21 +1,17 @@
 
 # dependencies
-from threading import Thread
+from threading import Lock, Thread, Timer
 import time
-import os
-import glob
-import ruamel.yaml
 import logging
 
+from laserinterface.datamanager.config import config_manager
+from laserinterface.helpers.temperature import TemperatureService
+
 _log = logging.getLogger().getChild(__name__)
 
-yaml = ruamel.yaml.YAML()
-config_file = 'laserinterface/data/config.yaml'
-with open(config_file, 'r') as ymlfile:
-    config = yaml.load(ymlfile)
-    mimic_gpio = config['GENERAL']['MIMIC_GPIO_LIB']
-    mimic_gpio_change = config['GENERAL']['MIMIC_GPIO_CHANGE']
-    config = config['GPIO']
+mimic_gpio = config_manager['GENERAL']['MIMIC_GPIO_LIB']
+mimic_gpio_change = config_manager['GENERAL']['MIMIC_GPIO_CHANGE']
+config = config_manager['GPIO']
 
 if mimic_gpio:
     _log.error(' Will be mimicing the functions!')
@@ -34,12 +30,23 @@ class GpioInterface(Thread):
         self.callback = None
 
         self._quit = False
+        self._input_lock = Lock()
 
         self.last_update_time = 0
+        self.last_temp_state = ''
+        self.temperature = None     # TemperatureService
+        self.edge_detect = False
+        self.input_pins = {}    # pin number: input name
+        self.m_events = {}      # input name: event counter
+        self.poll_freq = config['POLL_FREQ']
 
         GPIO.setmode(getattr(GPIO, config['PINTYPE']))
         for name, dic in config['INPUTS'].items():
             GPIO.setup(dic['PIN'], GPIO.IN)
+            self.input_pins[dic['PIN']] = name
+            self.m_events[name] = machine.metrics.counter(
+                'gpio_input_events_total', 'Changes of the inputs',
+                input=name)
             self.machine.update_gpio(f'IN_{name}', GPIO.input(dic['PIN']))
             # self.on_change(f'IN_{name}', GPIO.input(dic['PIN']))
         for name, pin_nr in config['OUTPUTS'].items():
@@ -47,10 +54,58 @@ class GpioInterface(Thread):
             self.machine.update_gpio(f'OUT_{name}', False)
             # self.on_change(f'OUT_{name}', False)
 
+        if config.get('INPUT_MODE', 'POLL') == 'EDGE':
+            self.edge_detect = self.setup_edge_detect()
+        self.on_config_change()
+        config_manager.subscribe(self.on_config_change, ('GPIO',))
+
         if auto_start:
             self.start()
 
-    def pin_write(self, item, next_value=False):
+    def setup_edge_detect(self):
+        ''' Let the gpio library call on_edge when an input changes. Returns
+        False if edge detection is not available, then polling is used. '''
+        try:
+            for pin in self.input_pins:
+                GPIO.add_event_detect(pin, GPIO.BOTH, callback=self.on_edge,
+                                      bouncetime=config['DEBOUNCE_MS'])
+        except (RuntimeError, AttributeError) as e:
+            _log.error(f'edge detection failed ({e}), polling the inputs')
+            for pin in self.input_pins:
+                try:
+                    GPIO.remove_event_detect(pin)
+                except (RuntimeError, AttributeError):
+                    pass
+            return False
+        _log.info('using edge detection for the inputs')
+        return True
+
+    def on_edge(self, pin):
+        ''' Called by the gpio library when an input changes. The input is
+        checked again after the debounce time, edges during it are ignored. '''
+        name = self.input_pins[pin]
+        self.check_input(name)
+        Timer(config['DEBOUNCE_MS']/1000, self.check_input, (name,)).start()
+
+    def check_input(self, name):
+        ''' Read an input and start the callbacks if it changed '''
+        start = time.perf_counter()
+        with self._input_lock:
+            pin = config['INPUTS'][name]['PIN']
+            new_state = not GPIO.input(pin)
+            if self.machine.gpio_status[f'IN_{name}'] != new_state:
+                self.m_events[name].inc()
+                # trace the time until a resulting grbl command is send
+                self.machine.latency.begin(f'IN_{name}', start)
+                try:
+                    self.on_change(f'IN_{name}', new_state)
+                finally:
+                    self.machine.latency.discard()
+
+    def pin_write(self, item, next_value=False, callbacks=True):
+        ''' Set an output ('OUT_NAME'), '!' toggles it. Without callbacks
+        the rules of the change are not started, the CallbackHandler has
+        already resolved them. '''
         if self.machine.gpio_status[item] == next_value:
             # nothing changing
             return
@@ -62,34 +117,91 @@ class GpioInterface(Thread):
             next_value = not self.machine.gpio_status['OUT_'+item]
 
         GPIO.output(config['OUTPUTS'][item], not next_value)
-        self.on_change(f'OUT_{item}', next_value)
+        if callbacks:
+            self.on_change(f'OUT_{item}', next_value)
+        else:
+            self.machine.update_gpio(f'OUT_{item}', next_value)
 
-        _log.info('toggling ' + item + '. next value is ' + str(next_value))
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug('toggling %s. next value is %s', item, next_value)
         return next_value
 
+    def apply_outputs(self, changes):
+        ''' Set a batch of outputs ({'OUT_NAME': state}) without starting
+        their callbacks, those are already handled by the CallbackHandler. '''
+        for item, next_value in changes.items():
+            self.pin_write(item, next_value, callbacks=False)
+
+    def on_config_change(self, changed_sections=None):
+        ''' Apply the poll frequency of the (reloaded) config '''
+        # with edge detection the polling only catches missed edges
+        if self.edge_detect:
+            self.poll_freq = config['EDGE_POLL_FREQ']
+        else:
+            self.poll_freq = config['POLL_FREQ']
+        _log.info(f'polling frequency is {self.poll_freq}')
+
     def on_change(self, item, new_state):
         self.machine.update_gpio(item, new_state)
         self.callback.do_callback(f'{item}_{"ON" if new_state else "OFF"}')
 
     def close(self):
         self._quit = True
+        if self.temperature is not None:
+            self.temperature.close()
         GPIO.cleanup()
 
     def run(self):
         ''' Function runs when Thread.start() is called '''
-        _log.info(f'starting polling loop. frequency is {config["POLL_FREQ"]}')
+        _log.info(f'starting polling loop. frequency is {self.poll_freq}')
 
         temp_thread = Thread(target=self.temp_thread, daemon=True)
         temp_thread.start()
 
         while not self._quit:
             # get gpio inputs
-            for name, dic in config['INPUTS'].items():
-                new_state = not GPIO.input(dic['PIN'])
-                if self.machine.gpio_status[f'IN_{name}'] != new_state:
-                    self.on_change(f'IN_{name}', new_state)
-
-            time.sleep(1/config['POLL_FREQ'])
+            for name in config['INPUTS']:
+                self.check_input(name)
+
+            time.sleep(1/self.poll_freq)
+
+    def update_temp_state(self, temp_c, predicted=None):
+        ''' Show the temperature and start the TEMP callbacks when its range
+        changes. RED is also started when the predicted temperature reaches
+        it, so the machine holds before the threshold is crossed. '''
+        if temp_c is None:
+            temp_c = 99     # reading lost, handle as too hot
+        if predicted is None:
+            predicted = temp_c
+
+        # TEMP
+        if max(temp_c, predicted) >= config['TEMP_RANGE']['RED']:
+            state = 'RED'
+        elif temp_c >= config['TEMP_RANGE']['ORANGE']:
+            state = 'ORANGE'
+        else:
+            state = 'GREEN'
+
+        self.machine.update_temp(temp_c)
+        if state != self.last_temp_state:
+            if state == 'RED' and temp_c < config['TEMP_RANGE']['RED']:
+                _log.warning(f'temperature {temp_c:.2f} expected to reach '
+                             f'{predicted:.2f}, starting TEMP_RED callbacks')
+            self.machine.latency.begin(f'TEMP_{state}')
+            try:
+                self.callback.do_callback(f'TEMP_{state}')
+            finally:
+                self.machine.latency.discard()
+            self.last_temp_state = state
+
+    def on_temperature(self, service):
+        if not service.has_read:
+            # no sensor found yet, shown without starting the callbacks
+            if self.last_temp_state != 'NO_SENSOR':
+                self.machine.update_temp(None)
+                self.last_temp_state = 'NO_SENSOR'
+            return
+        self.update_temp_state(service.temperature, service.predicted)
 
     def temp_thread(self):
         if mimic_gpio:
@@ -97,67 +209,22 @@ class GpioInterface(Thread):
                 return
             temp_c = 20
             up = 1
-            last_state = ''
             while not self._quit:
                 if temp_c >= 25 or temp_c <= 17:
                     up = -up
                 temp_c += up/4
-                self.machine.update_temp(temp_c)
+                self.update_temp_state(temp_c)
                 time.sleep(0.2)
-                # TEMP
-                if temp_c >= config['TEMP_RANGE']['RED']:
-                    state = 'RED'
-                elif temp_c >= config['TEMP_RANGE']['ORANGE']:
-                    state = 'ORANGE'
-                else:
-                    state = 'GREEN'
-
-                self.machine.update_temp(temp_c)
-                if state != last_state:
-                    self.callback.do_callback(f'TEMP_{state}')
-                    last_state = state
             return
 
-        # find file url for the ds18b20 readings
-        thermometer_url = ""
-        while not thermometer_url:
-            try:
-                os.system('modprobe w1-gpio')
-                os.system('modprobe w1-therm')
-                device_folder = glob.glob('/sys/bus/w1/devices/28*')[0]
-                thermometer_url = device_folder + '/w1_slave'
-                _log.info("Found temperature file -> "+thermometer_url)
-            except IndexError:
-                thermometer_url = None
-
-        last_state = ''
-        while not self._quit:
-            temp_c = 99
-
-            # get laser tube temperature
-            with open(thermometer_url, 'r') as f:
-                lines = f.readlines()
-            while lines[0].strip()[-3:] != 'YES':
-                time.sleep(0.1)
-                with open(thermometer_url, 'r') as f:
-                    lines = f.readlines()
-
-            equals_pos = lines[1].find('t=')
-            if equals_pos != -1:
-                temp_string = lines[1][equals_pos+2:]
-                temp_c = float(temp_string) / 1000.0
-
-            # TEMP
-            if temp_c >= config['TEMP_RANGE']['RED']:
-                state = 'RED'
-            elif temp_c >= config['TEMP_RANGE']['ORANGE']:
-                state = 'ORANGE'
-            else:
-                state = 'GREEN'
-
-            self.machine.update_temp(temp_c)
-            if state != last_state:
-                self.callback.do_callback(f'TEMP_{state}')
-                last_state = state
-
-        return
+        # the sensors of the laser tube temperature are read by the service
+        sensors = config.get('TEMP_SENSORS', {})
+        self.temperature = TemperatureService(
+            self.on_temperature,
+            device_dir=sensors.get('DEVICE_DIR', '/sys/bus/w1/devices'),
+            read_interval=sensors.get('READ_INTERVAL', 1.0),
+            read_retries=sensors.get('READ_RETRIES', 3),
+            smoothing=sensors.get('SMOOTHING', 0.5),
+            rate_window=sensors.get('RATE_WINDOW', 20),
+            predict_seconds=sensors.get('PREDICT_SECONDS', 30),
+            stale_after=sensors.get('STALE_AFTER', 10))
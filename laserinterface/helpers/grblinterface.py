@@ -1,30 +1,38 @@
 # External Dependencies
-from threading import Thread
+from collections import deque
+from threading import Condition, Event, Thread
 import logging
 import queue
-import ruamel.yaml
 import serial
 import struct
 import time
 
 from laserinterface.data.grbl_doc import COMMANDS
+from laserinterface.datamanager.config import config_manager
+from laserinterface.datamanager.tracing import tracer
+from laserinterface.helpers.jobstreamer import JobStreamer
+from laserinterface.helpers.jogstreamer import JogStreamer
+from laserinterface.helpers.realtimelane import RealtimeLane
 
 _log = logging.getLogger().getChild(__name__)
 
-yaml = ruamel.yaml.YAML()
-config_file = 'laserinterface/data/config.yaml'
-with open(config_file, 'r') as ymlfile:
-    config = yaml.load(ymlfile, )['GRBL']
+config = config_manager['GRBL']
 
 
 class GrblInterface:
-    def __init__(self, terminal=None, machine=None):
+    def __init__(self, terminal=None, machine=None, port=None, name=None,
+                 poll_state=True):
         # Store or Create terminal and state instance
         self.terminal = terminal
         self.machine = machine
+        # the name of the machine, when several machines are controlled
+        self.name = name
+        # without poll_state, the states are requested by a MachinePool
+        self.poll_state = poll_state
 
+        # the port is any pyserial url, the configured port by default
         self.ser = serial.serial_for_url(
-            url=config['PORT'],
+            url=port or config['PORT'],
             baudrate=config['BAUDRATE'],
             timeout=20,
             write_timeout=0,
@@ -36,9 +44,65 @@ class GrblInterface:
         self.chars_in_buffer = queue.Queue()
         self.lines_to_sent = queue.Queue()
         self.lines_count = 0
+        self.lines_acked = 0    # ok and error responses
+        self.lines_failed = 0   # error responses
+        self.job = None         # the JobStreamer the sender pulls lines from
+        # wakes the sender and blocking sends when lines are queued, sent or
+        # acknowledged, or when the job changes
+        self.wakeup = Condition()
         self.connected = False
-        self.sending = False
+        # all writes go through the realtime lane, realtime commands are
+        # written between the writes of the sender
+        self.realtime = RealtimeLane(self, machine)
         self.requested_config = False
+        self.config_received = Event()
+        self.welcome = Event()  # set when grbl greets after a reset
+        self.status_requested = 0   # time the last '?' was send
+
+        # metrics of the streaming, updated without locks
+        metrics = machine.metrics
+        self.m_lines = metrics.counter(
+            'grbl_lines_sent_total', 'Lines written to grbl')
+        self.m_bytes = metrics.counter(
+            'grbl_bytes_sent_total', 'Bytes of lines written to grbl')
+        self.m_status_latency = metrics.histogram(
+            'grbl_status_latency_seconds',
+            'Time from a status request until the report is received')
+        metrics.rate('grbl_lines_per_second', self.m_lines,
+                     'Lines written per second since the last export')
+        metrics.rate('grbl_bytes_per_second', self.m_bytes,
+                     'Bytes written per second since the last export')
+        metrics.gauge('grbl_rx_buffer_fill_bytes',
+                      'Bytes of sent lines not yet acknowledged by grbl',
+                      lambda: self.buffer_fill)
+        metrics.gauge('grbl_send_queue_lines', 'Lines waiting to be sent',
+                      self.queued_lines)
+
+        # the planner monitor finds the cause of starvations from the queue
+        machine.planner.queued_lines = self.queued_lines
+
+        # time from a write until the next one, while lines were waiting
+        self.m_write_gap = metrics.histogram(
+            'grbl_write_gap_seconds',
+            'Time between writes while lines were waiting to be sent')
+        self.write_gaps = deque(maxlen=10000)   # the recent gaps in seconds
+        self._gap_start = None
+
+        # continuous jogging while a jog button is held
+        self.jogger = JogStreamer(self, machine)
+
+    @property
+    def port(self):
+        return self.ser.port
+
+    @property
+    def buffer_fill(self):
+        ''' Bytes of sent lines not yet acknowledged by grbl '''
+        return sum(self.chars_in_buffer.queue)
+
+    def job_streamer(self):
+        ''' Returns a JobStreamer sending jobs over this interface '''
+        return JobStreamer(self, self.terminal, self.machine)
 
     def set_port(self, port):
         if self.connected:
@@ -56,6 +120,8 @@ class GrblInterface:
         sending gcode, requesting state, and handling responses'''
 
         _log.info(f'connecting to {self.ser.port}')
+        self._quit = False
+        self.welcome.clear()
         try:
             self.ser.open()
         except serial.SerialException:
@@ -68,25 +134,33 @@ class GrblInterface:
         self.thread_receiver.start()
 
         self.connected = True
-        time.sleep(0.5)
         self.ser.write('\r\n\r\n'.encode('utf-8'))
-        time.sleep(0.5)
+        self.wait_for_welcome()
 
-        self.thread_poll_report = Thread(
-            target=self._request_state, daemon=True)
-        self.thread_poll_report.start()
+        if self.poll_state:
+            self.thread_poll_report = Thread(
+                target=self._request_state, daemon=True)
+            self.thread_poll_report.start()
 
         self.thread_send_gcode = Thread(target=self._gcode_sender, daemon=True)
         self.thread_send_gcode.start()
 
         self.get_config()
+        if not self.poll_state:
+            # the planner capacity is learned from a report while idle, after
+            # the buffer state is enabled
+            self.request_state()
 
         return True
 
     def disconnect(self):
         ''' set flag to stop the threads, then close the connection '''
-        self._quit = True
-        self.connected = False
+        self.jogger.stop()
+        with self.wakeup:
+            self._quit = True
+            self.connected = False
+            self.wakeup.notify_all()
+        self.cancel_job()
 
         # _log.info('Waiting for threads to finish')
         # self.thread_poll_report.join()
@@ -95,90 +169,282 @@ class GrblInterface:
 
         self.ser.close()
 
+    def wait_for_welcome(self, timeout=None):
+        ''' Opening the port resets the arduino, grbl is ready when it sends
+        its welcome message. If it does not arrive (no reset on open), a soft
+        reset makes grbl send it. '''
+        if timeout is None:
+            timeout = config.get('WELCOME_TIMEOUT', 2.5)
+        start_time = time.perf_counter()
+        if not self.welcome.wait(timeout):
+            _log.warning('no welcome message from grbl, sending a soft reset')
+            self.serial_send(COMMANDS['soft reset'])
+            if not self.welcome.wait(timeout):
+                _log.error('grbl did not send a welcome message')
+                return False
+        _log.info(f'grbl ready after '
+                  f'{(time.perf_counter()-start_time)*1000:.0f} ms')
+        return True
+
     def get_config(self, timeout=2):
+        self.config_received.clear()
         self.requested_config = True
         self.serial_send('$$')
-        start_time = time.time()
-        while self.requested_config:
-            if time.time()-start_time > timeout:
-                return False
-            time.sleep(0.1)
-        with open('laserinterface/data/grbl_config.txt', 'w') as file:
+        if not self.config_received.wait(timeout):
+            self.requested_config = False
+            return False
+        self.enable_buffer_report()
+        config_file = 'laserinterface/data/grbl_config.txt' \
+            if self.name is None \
+            else f'laserinterface/data/grbl_config_{self.name}.txt'
+        with open(config_file, 'w') as file:
             for key, value in self.machine.grbl_config.items():
                 file.write(f'{key}={value}\n')
-        print('received full config: ', self.machine.grbl_config)
+        _log.info(f'received full config: {self.machine.grbl_config}')
         return True
 
+    def enable_buffer_report(self):
+        ''' The planner is followed with the Bf field of the status report,
+        which is enabled by bit 1 (value 2) of the status report mask ($10).
+        $10 is stored in the eeprom of grbl, so it is only changed when the
+        operator enabled REPORT_BUFFER in the config. '''
+        mask = self.machine.grbl_config.get('$10')
+        if mask is None or int(mask) & 2:
+            return
+        if not config.get('REPORT_BUFFER'):
+            _log.info(f'the status report has no buffer state ($10={mask}), '
+                      f'set REPORT_BUFFER to follow the planner')
+            return
+        _log.warning(f'enabling the buffer state in the status report, '
+                     f'$10={mask} -> {int(mask) | 2}, send $10={mask} to '
+                     f'restore it')
+        self.serial_send(f'$10={int(mask) | 2}')
+        self.machine.grbl_config['$10'] = int(mask) | 2
+
     def soft_reset(self):
-        while not self.lines_to_sent.empty():
-            self.lines_to_sent.get()
-        while not self.chars_in_buffer.empty():
-            self.chars_in_buffer.get()
+        ''' Cancel the job and all waiting lines at once, then reset grbl '''
+        self.jogger.stop()
+        with self.wakeup:
+            if self.job is not None:
+                self.job.cancelled = True
+            with self.lines_to_sent.mutex:
+                self.lines_to_sent.queue.clear()
+            with self.chars_in_buffer.mutex:
+                self.chars_in_buffer.queue.clear()
+            self.wakeup.notify_all()
         self.serial_send(COMMANDS['soft reset'])
+        self.realtime.reset()
         self.terminal.clear_buffers()
 
-    def serial_send(self, line, blocking=False, queue_count=0):
+    def start_job(self, job):
+        ''' Let the sender pull the lines of a JobStreamer '''
+        with self.wakeup:
+            if self.job is not None and not self.job.cancelled:
+                raise RuntimeError('a job is already being sent')
+            if self.connected:
+                self.job = job
+                self.wakeup.notify_all()
+                return
+        _log.error('not connected, the job is not sent')
+        job.finish(completed=False)
+
+    def cancel_job(self, job=None):
+        ''' Stop pulling lines of the job, the sender finishes it '''
+        with self.wakeup:
+            job = job or self.job
+            if job is None:
+                return
+            job.cancelled = True
+            self.wakeup.notify_all()
+        if not self.connected:
+            job.finish(completed=False)
+
+    def jog(self, x, y, feed):
+        ''' Jog in the direction (x, y) at feed mm/min until stop_jog '''
+        self.jogger.start(x, y, feed)
+
+    def stop_jog(self):
+        ''' Cancel any jog at once '''
+        self.jogger.stop()
+
+    def override(self, kind, target):
+        ''' Change the override kind ('feed' or 'power') to target percent,
+        quick changes are coalesced '''
+        self.realtime.override(kind, target)
+        with self.wakeup:
+            self.wakeup.notify_all()    # the sender writes it when due
+
+    def queued_lines(self):
+        ''' Lines waiting to be sent, including the prepared job lines '''
+        job = self.job
+        return self.lines_to_sent.qsize() + (len(job.ahead) if job else 0)
+
+    def serial_send(self, line, blocking=False, queue_count=0, job_line=None):
         '''
         Send a string over the serial connection to grbl. If the line is an
         alarm or report request, it is send directly. Use blocking to wait
-        until the line is send.
+        until the line is send. job_line is the line number in the job file,
+        used to track the progress of a job.
         '''
         if not self.connected:
             return False
 
         # real-time commands do not wait in buffer, so they are send directly
         if (type(line) == int) or (line in ('!', '?', '~')):
+            self.machine.latency.mark('send')
             if (type(line) == int):
                 # 'extended ascii' commands
                 byte = struct.pack('>B', line)
             else:
                 byte = line.encode('ascii')
-
-            while self.sending:
-                time.sleep(0.001)
-            self.sending = True
-            self.ser.write(byte)
-            self.sending = False
+            self.realtime.send(byte)
             return True
 
         # if line is gcode etc. add it to the send queue
         else:
-            self.terminal.store_send(line)
-            self.lines_to_sent.put(line)
-            line_nr = self.lines_count + len(self.lines_to_sent.queue)
-            if blocking:
-                while self.lines_count < (line_nr - queue_count):
-                    time.sleep(0.001)
+            self.terminal.store_send(line, job_line)
+            with self.wakeup:
+                self.lines_to_sent.put(line)
+                line_nr = self.lines_count + self.lines_to_sent.qsize()
+                self.wakeup.notify_all()
+                if blocking:
+                    self.wakeup.wait_for(
+                        lambda: self.lines_count >= line_nr - queue_count
+                        or not self.connected)
         return True
 
-    def _gcode_sender(self):
-        while not self._quit:
-            line = self.lines_to_sent.get()
-            # _log.info(f'sending a command -> "{line}"')
-
-            while (sum(self.chars_in_buffer.queue)+len(line)+1 >=
-                    (config['RX_BUFFER_SIZE']-1)):
-                # other thread is handling the incoming messages
-                # all we have to do, is wait for the buffer to be handled
-                time.sleep(0.001)
+    def _take_lines(self):
+        ''' Returns the lines that fit in the buffer of grbl now, as
+        (line, job line, from the job). Waiting lines go first, then the
+        lines of the job. '''
+        room = config['RX_BUFFER_SIZE'] - 1 - self.buffer_fill
+        job = self.job
+        if job is not None and job.cancelled:
+            job = None
+        lines = []
+        while len(lines) < self.machine.planner.write_batch:
+            try:
+                line = self.lines_to_sent.queue[0]
+                from_job = False
+            except IndexError:
+                if job is None or not job.ahead:
+                    break
+                line, job_line = job.ahead[0]
+                from_job = True
+            if len(line)+1 >= room:
+                break
+            room -= len(line)+1
+            if from_job:
+                lines.append((line, job_line, True))
+                job.ahead.popleft()
+            else:
+                lines.append((self.lines_to_sent.get_nowait(), None, False))
+        return lines
+
+    def _job_state(self):
+        ''' Finish the job when it is cancelled, or when all its lines are
+        sent and acknowledged. Returns the job that is still active. '''
+        job = self.job
+        if job is None:
+            return None
+        if job.cancelled:
+            completed = False
+        elif job.exhausted and not job.ahead and self.chars_in_buffer.empty():
+            completed = True
+        else:
+            return job
+        self._end_job(job, completed)
+        return None
 
-            while self.sending:
-                time.sleep(0.001)
-            self.sending = True
-            # Send g-code block to grbl
-            self.ser.write((line + '\n').encode('ascii'))
-            self.sending = False
+    def _end_job(self, job, completed):
+        with self.wakeup:
+            if self.job is job:
+                self.job = None
+            self.wakeup.notify_all()
+        job.finish(completed)
 
-            # Track number of characters in grbl serial read buffer
-            self.chars_in_buffer.put(len(line)+1)
-            self.lines_count += 1
+    def _gcode_sender(self):
+        ''' Writes the waiting lines and pulls the lines of the job, when
+        they fit in the buffer of grbl. Sleeps until a line is queued, grbl
+        acknowledged a line or the job changed. '''
+        while not self._quit:
+            self.realtime.flush()
+            job = self._job_state()
+            if job is not None:
+                # prepare the next lines while waiting for room in the buffer
+                try:
+                    job.prefetch(self.machine.planner.lookahead)
+                except Exception:
+                    # like a file removed after the start, the sender keeps
+                    # sending the other lines
+                    _log.exception(f'reading {job.filename} failed, the job '
+                                   f'is stopped')
+                    self._end_job(job, completed=False)
+                    job = None
+
+            lines = self._take_lines()
+            if not lines:
+                with self.wakeup:
+                    if not self._quit and not self._take_ready(job):
+                        due = self.realtime.due()
+                        self.wakeup.wait(1 if due is None else due)
+                continue
+
+            with tracer.span('grbl.send_line'):
+                # Track number of characters in grbl serial read buffer,
+                # before writing, grbl can answer before write() returns
+                for line, job_line, from_job in lines:
+                    self.chars_in_buffer.put(len(line)+1)
+                    if from_job:
+                        self.terminal.store_sent(line, job_line)
+                        job.lines_sent += 1
+                    else:
+                        self.terminal.send_to_buffer()
+
+                # Send g-code block to grbl
+                data = ''.join(
+                    line + '\n' for line, _, _ in lines).encode('ascii')
+                write_time = time.perf_counter()
+                self.realtime.write(data)
+
+                if self._gap_start is not None:
+                    gap = write_time - self._gap_start
+                    self.m_write_gap.observe(gap)
+                    self.write_gaps.append(gap)
+                self._gap_start = time.perf_counter() \
+                    if self.queued_lines() else None
+
+                with self.wakeup:
+                    self.lines_count += len(lines)
+                    self.wakeup.notify_all()
+                self.m_lines.inc(len(lines))
+                self.m_bytes.inc(len(data))
+
+    def _take_ready(self, job):
+        ''' True if the sender has work: a line that fits in the buffer, or
+        a job to prepare or to finish '''
+        room = config['RX_BUFFER_SIZE'] - 1 - self.buffer_fill
+        if self.lines_to_sent.qsize():
+            return len(self.lines_to_sent.queue[0])+1 < room
+        if job is not self.job:
+            return True
+        if job is None:
+            return False
+        if job.cancelled or (job.exhausted and not job.ahead):
+            return job.cancelled or self.chars_in_buffer.empty()
+        if job.ahead:
+            return len(job.ahead[0][0])+1 < room
+        return True
 
-            self.terminal.send_to_buffer()
+    def request_state(self):
+        ''' Send '?' to request a new state '''
+        self.status_requested = time.perf_counter()
+        self.serial_send('?')
 
     def _request_state(self):
         ''' Periodically send '?' to request a new state. '''
         while not self._quit:
-            self.serial_send('?')
+            self.request_state()
             time.sleep(1/config['POLL_STATE_FREQ'])
 
     def _receive_continuously(self):
@@ -192,16 +458,32 @@ class GrblInterface:
                 buffer = buffer[i+1:]
                 s = line.decode('ascii').strip()
                 if s:
-                    self._handle_received(s)
+                    with tracer.span('grbl.handle_received'):
+                        self._handle_received(s)
             else:
                 # read more lines
-                waiting = max(1, min(2048, self.ser.in_waiting))
-                buffer.extend(self.ser.read(waiting))
+                try:
+                    waiting = max(1, min(2048, self.ser.in_waiting))
+                    buffer.extend(self.ser.read(waiting))
+                except (serial.SerialException, AttributeError, OSError):
+                    if self._quit:
+                        return  # the port was closed by disconnect()
+                    raise
 
     def _handle_received(self, out_temp):
         # if 'ok' or 'error' (finished a command from the buffer):
         if ('ok' in out_temp) or ('error' in out_temp):
-            self.chars_in_buffer.get()
+            try:
+                self.chars_in_buffer.get_nowait()
+            except queue.Empty:
+                # grbl also answers the empty lines send to wake it up
+                _log.debug(f'"{out_temp}" received without a line sent')
+                return
+            with self.wakeup:
+                self.lines_acked += 1
+                if 'error' in out_temp:
+                    self.lines_failed += 1
+                self.wakeup.notify_all()    # room for the next line
 
             if ('error' in out_temp):
                 self.terminal.received_ok(error=True)
@@ -211,13 +493,25 @@ class GrblInterface:
 
         # if it is a report message (for machine state manager):
         elif (out_temp[0] == '<' and out_temp[-1] == '>'):
+            if self.status_requested:
+                self.m_status_latency.observe(
+                    time.perf_counter()-self.status_requested)
+                self.status_requested = 0
             self.machine.handle_grbl_report(out_temp)
+            if '|Ov:' in out_temp:
+                self.realtime.confirm(self.machine.grbl_status['Ov'])
 
         elif (('ALARM' in out_temp) or ('Hold' in out_temp)
                 or ('Door' in out_temp)):
             _log.debug(f'Message received "{out_temp}"')
             self.terminal.store_received(out_temp, error=True)
 
+        elif out_temp.startswith('Grbl '):
+            _log.info(f'Welcome message received "{out_temp}"')
+            self.realtime.reset()
+            self.terminal.store_received(out_temp)
+            self.welcome.set()
+
         # if it is a message without ok or error (like after $$)
         else:
             if self.requested_config:
@@ -230,6 +524,7 @@ class GrblInterface:
                     self.machine.grbl_config[item] = value
                     if item == '$132':  # last item
                         self.requested_config = False
+                        self.config_received.set()
             else:
                 _log.debug(f'Message received "{out_temp}"')
                 self.terminal.store_received(out_temp)
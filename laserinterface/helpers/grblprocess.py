@@ -0,0 +1,419 @@
+# dependencies
+from collections import deque
+from itertools import count
+from os import path
+from threading import Event, Lock, RLock, Thread
+import logging
+import marshal
+import multiprocessing
+import signal
+import time
+
+from laserinterface.datamanager.config import config_manager
+from laserinterface.datamanager.machine import MachineStateManager
+from laserinterface.datamanager.terminal import TerminalManager
+from laserinterface.helpers.gcodereader import ToolpathIndex
+from laserinterface.helpers.sharedring import SharedRing
+
+_log = logging.getLogger().getChild(__name__)
+
+SNAPSHOT_INTERVAL = 0.05    # seconds between state snapshots of the child
+# the terminal methods used by the GrblInterface and the JobStreamer
+TERMINAL_EVENTS = ('store_send', 'store_sent', 'send_to_buffer', 'received_ok',
+                   'store_received', 'store_comment', 'clear_buffers',
+                   'start_job')
+
+
+class _Forwarder():
+    ''' Writes the events of the child to the ring. When the ring is full
+    (the parent does not read), events wait in a backlog, so the serial
+    threads never block. State snapshots are not added to the backlog, the
+    next one is sent after it. '''
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.backlog = deque()
+        self.lock = RLock()
+
+    def emit(self, *event):
+        with self.lock:
+            message = marshal.dumps(event)
+            if self.backlog or not self.ring.put(message):
+                self.backlog.append(message)
+
+    def emit_snapshot(self, state):
+        ''' Like emit, a snapshot is dropped when it has to wait '''
+        with self.lock:
+            if not self.backlog:
+                self.ring.put(marshal.dumps(('snapshot', state)))
+
+    def flush(self):
+        with self.lock:
+            while self.backlog and self.ring.put(self.backlog[0]):
+                self.backlog.popleft()
+
+
+class _ForwardingTerminal(TerminalManager):
+    def __init__(self, forwarder):
+        super().__init__()
+        self.forwarder = forwarder
+
+
+def _forward_terminal(name):
+    method = getattr(TerminalManager, name)
+
+    def forwarded(self, *args, **kwargs):
+        # the lock keeps the events in the order of the changes
+        with self.forwarder.lock:
+            result = method(self, *args, **kwargs)
+            self.forwarder.emit('terminal', name, args, kwargs)
+        return result
+    return forwarded
+
+
+for _name in TERMINAL_EVENTS:
+    setattr(_ForwardingTerminal, _name, _forward_terminal(_name))
+
+
+class _ForwardingMachine(MachineStateManager):
+    def __init__(self, forwarder, name=None):
+        super().__init__(name)
+        self.forwarder = forwarder
+
+    def handle_grbl_report(self, state_in):
+        super().handle_grbl_report(state_in)
+        self.forwarder.emit('report', state_in)
+
+
+def _child_main(ring_name, commands, port, log_level, name, metrics_port):
+    ''' Runs the GrblInterface and the JobStreamer in the grbl process '''
+    from laserinterface.datamanager.metrics import MetricsExporter
+    from laserinterface.helpers.grblinterface import GrblInterface
+
+    # a ctrl-c reaches the whole process group, the parent stops the job
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=log_level)
+    ring = SharedRing(ring_name)
+    forwarder = _Forwarder(ring)
+    terminal = _ForwardingTerminal(forwarder)
+    machine = _ForwardingMachine(forwarder, name)
+    grbl = GrblInterface(terminal=terminal, machine=machine, port=port,
+                         name=name)
+    streamer = grbl.job_streamer()
+    config_manager.watch()
+
+    # the streaming metrics are collected in this process
+    if metrics_port:
+        try:
+            MetricsExporter(machine.metrics, metrics_port)
+        except OSError as e:
+            _log.error(f'Could not serve the grbl metrics: {e}')
+
+    def snapshots():
+        while True:
+            forwarder.flush()
+            forwarder.emit_snapshot({
+                'connected': grbl.connected,
+                'port': grbl.port,
+                'buffer_fill': grbl.buffer_fill,
+                'lines_count': grbl.lines_count,
+                'filename': streamer.filename,
+                'progress': streamer.progress,
+                'duration': streamer.duration,
+                'lines_sent': streamer.lines_sent,
+                'active': streamer.active,
+            })
+            time.sleep(SNAPSHOT_INTERVAL)
+
+    def call(call_id, name, args):
+        try:
+            if name == 'write_gaps':
+                result = list(grbl.write_gaps)
+            else:
+                result = getattr(grbl, name)(*args)
+        except Exception as e:
+            _log.exception(f'{name} failed in the grbl process')
+            forwarder.emit('reply', call_id, False, repr(e))
+        else:
+            forwarder.emit('config', dict(machine.grbl_config))
+            forwarder.emit('reply', call_id, True, result)
+
+    def job_done(summary, error=None):
+        forwarder.emit('job_done', summary, error, {
+            'progress': streamer.progress,
+            'duration': streamer.duration,
+            'lines_sent': streamer.lines_sent,
+        })
+
+    def start(filename, repeat_count, start_line, checkpoint):
+        line_index = ToolpathIndex(
+            checkpoints=[checkpoint] if checkpoint else [], filename=filename)
+        try:
+            streamer.start(filename, repeat_count, start_line, line_index,
+                           on_done=job_done)
+        except Exception as e:
+            _log.exception(f'streaming {filename} failed')
+            job_done(None, repr(e))
+
+    Thread(target=snapshots, daemon=True).start()
+
+    while True:
+        try:
+            call_id, name, args = commands.recv()
+        except (EOFError, OSError):
+            break   # the parent is gone
+        if name == 'serial_send' and call_id is None:
+            grbl.serial_send(*args)     # realtime commands go straight out
+        elif name == 'soft_reset':
+            grbl.soft_reset()
+        elif name in ('jog', 'stop_jog', 'override'):
+            getattr(grbl, name)(*args)  # a release must not wait
+        elif name == 'stop_job':
+            streamer.stop()
+        elif name == 'start_job':
+            start(*args)    # the sender thread pulls the lines
+        elif name == 'close':
+            break
+        else:
+            # calls run in a thread of their own, so a connect or a blocking
+            # send never delays a realtime command
+            Thread(target=call, args=(call_id, name, args),
+                   daemon=True).start()
+
+    if grbl.connected:
+        grbl.disconnect()
+    forwarder.flush()
+    ring.close()
+
+
+class _StreamerProxy():
+    ''' Has the interface of the JobStreamer, the job is streamed in the
+    grbl process '''
+
+    def __init__(self, process):
+        self.process = process
+        self.filename = ''
+        self.progress = 0.0
+        self.duration = 0.0
+        self.lines_sent = 0
+        self.active = False
+        self.summary = None
+        self.error = None
+        self.done = Event()
+        self._on_done = None
+
+    def start(self, filename, repeat_count=1, start_line=0, line_index=None,
+              on_done=None):
+        checkpoint = None
+        if line_index is not None and start_line > 0 and \
+                path.abspath(line_index.filename) == path.abspath(filename):
+            checkpoint = line_index.checkpoint_before(start_line)
+        if self.active:
+            raise RuntimeError('the job is already active')
+        self.done.clear()
+        self.error = None
+        self.active = True
+        self._on_done = on_done
+        self.process.machine.job_active = True
+        self.process.send('start_job', filename, repeat_count, start_line,
+                          checkpoint)
+
+    def stream(self, filename, repeat_count=1, start_line=0, line_index=None):
+        self.start(filename, repeat_count, start_line, line_index)
+        self.done.wait()
+        if self.error:
+            raise OSError(self.error)
+        return self.summary
+
+    def finish(self, summary, error, stats):
+        ''' Called by the reader thread when the job is done '''
+        self.summary, self.error = summary, error
+        for key, value in stats.items():
+            setattr(self, key, value)
+        self.active = False
+        self.process.machine.job_active = False
+        self.done.set()
+        if self._on_done is not None:
+            self._on_done(summary)
+
+    def stop(self):
+        self.process.send('stop_job')
+
+
+class GrblProcess():
+    def __init__(self, terminal=None, machine=None, port=None, name=None,
+                 metrics_port=None):
+        # GrblProcess runs the GrblInterface and the JobStreamer in a
+        # process of their own, so the ui and gcode parsing can not delay
+        # a serial write. It has the interface of the GrblInterface. The
+        # commands are send through a pipe, the child process writes its
+        # terminal changes, status reports and state snapshots to a shared
+        # memory ring. These are applied to the terminal and machine of this
+        # process by a reader thread, so all callbacks work as before.
+        # The metrics of the streaming are served at metrics_port, by
+        # default at METRICS_PORT + 1.
+
+        self.terminal = terminal
+        self.machine = machine
+        self.connected = False
+        self.port = port or config_manager['GRBL']['PORT']
+        self.name = name
+        if metrics_port is None:
+            metrics_port = config_manager['GENERAL'].get('METRICS_PORT')
+            metrics_port = metrics_port and metrics_port+1
+        self.buffer_fill = 0
+        self.lines_count = 0
+        self.streamer = _StreamerProxy(self)
+
+        self._ids = count()
+        self._calls = {}    # call id: [Event, ok, result]
+        self._send_lock = Lock()
+        self._quit = False
+
+        self.ring = SharedRing()
+        # spawn, forking a process with running threads (kivy) is unsafe
+        context = multiprocessing.get_context('spawn')
+        receiver, self.commands = context.Pipe(duplex=False)
+        self.process = context.Process(
+            target=_child_main, args=(
+                self.ring.name, receiver, port,
+                logging.getLogger().getEffectiveLevel(), name, metrics_port),
+            name=f'grbl {name}' if name else 'grbl', daemon=True)
+        self.process.start()
+        receiver.close()
+        _log.info(f'started the grbl process (pid {self.process.pid})')
+
+        self.reader = Thread(target=self._read_events, daemon=True)
+        self.reader.start()
+
+    def send(self, name, *args, call_id=None):
+        with self._send_lock:
+            try:
+                self.commands.send((call_id, name, args))
+            except (OSError, ValueError):
+                _log.error(f'grbl process is not running, {name} not sent')
+                return False
+        return True
+
+    def call(self, name, *args, timeout=30):
+        ''' Run a method of the GrblInterface in the grbl process and return
+        its result '''
+        call_id = next(self._ids)
+        waiter = self._calls[call_id] = [Event(), False, None]
+        if self.send(name, *args, call_id=call_id):
+            waiter[0].wait(timeout)
+        del self._calls[call_id]
+        if not waiter[1]:
+            _log.error(f'{name} failed in the grbl process: {waiter[2]}')
+            return None
+        return waiter[2]
+
+    def _read_events(self):
+        last_check = time.monotonic()
+        while not self._quit:
+            message = self.ring.get()
+            if message is None:
+                now = time.monotonic()
+                if now - last_check > 0.5:
+                    last_check = now
+                    if not self.process.is_alive():
+                        self._process_died()
+                        return
+                time.sleep(0.001)
+                continue
+            try:
+                self._apply(marshal.loads(message))
+            except Exception:
+                _log.exception('applying an event of the grbl process failed')
+
+    def _apply(self, event):
+        kind = event[0]
+        if kind == 'terminal':
+            _, name, args, kwargs = event
+            getattr(self.terminal, name)(*args, **kwargs)
+        elif kind == 'report':
+            self.machine.handle_grbl_report(event[1])
+        elif kind == 'snapshot':
+            state = event[1]
+            self.connected = state['connected']
+            self.port = state['port']
+            self.buffer_fill = state['buffer_fill']
+            self.lines_count = state['lines_count']
+            if state['active'] or self.streamer.active:
+                for key in ('filename', 'progress', 'duration', 'lines_sent'):
+                    setattr(self.streamer, key, state[key])
+        elif kind == 'config':
+            self.machine.grbl_config.update(event[1])
+        elif kind == 'reply':
+            _, call_id, ok, result = event
+            waiter = self._calls.get(call_id)
+            if waiter is not None:
+                waiter[1:] = [ok, result]
+                waiter[0].set()
+        elif kind == 'job_done':
+            self.streamer.finish(*event[1:])
+
+    def _process_died(self):
+        _log.error(f'grbl process stopped (exit code '
+                   f'{self.process.exitcode})')
+        self.connected = False
+        if self.streamer.active:
+            self.streamer.finish(None, 'the grbl process stopped', {})
+        for waiter in list(self._calls.values()):
+            waiter[0].set()
+
+    def job_streamer(self):
+        return self.streamer
+
+    def connect(self):
+        self.connected = bool(self.call('connect'))
+        return self.connected
+
+    def set_port(self, port):
+        self.connected = bool(self.call('set_port', port))
+        self.port = port
+        return self.connected
+
+    def get_config(self):
+        return self.call('get_config')
+
+    def soft_reset(self):
+        self.send('soft_reset')
+
+    def jog(self, x, y, feed):
+        self.send('jog', x, y, feed)
+
+    def stop_jog(self):
+        self.send('stop_jog')
+
+    def override(self, kind, target):
+        self.send('override', kind, target)
+
+    def serial_send(self, line, blocking=False, queue_count=0, job_line=None):
+        if not self.connected:
+            return False
+        if blocking:
+            return self.call('serial_send', line, True, queue_count, job_line)
+        if type(line) == int or line in ('!', '?', '~'):
+            # for realtime commands the latency ends at the pipe
+            self.machine.latency.mark('send')
+            sent = self.send('serial_send', line)
+            self.machine.latency.end()
+            return sent
+        return self.send('serial_send', line, False, queue_count, job_line)
+
+    @property
+    def write_gaps(self):
+        return self.call('write_gaps') or []
+
+    def disconnect(self):
+        ''' Disconnect and stop the grbl process '''
+        self.connected = False
+        self.send('close')
+        self.process.join(2)
+        if self.process.is_alive():
+            self.process.terminate()
+        self._quit = True
+        self.reader.join(1)
+        self.commands.close()
+        self.ring.close()
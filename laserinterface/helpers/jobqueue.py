@@ -0,0 +1,246 @@
+# dependencies
+from concurrent.futures import Future, ProcessPoolExecutor
+from threading import Lock, Thread
+import logging
+import multiprocessing
+import os
+import signal
+
+from laserinterface.datamanager.config import config_manager
+from laserinterface.helpers.gcodereader import parse_file
+from laserinterface.helpers.parallelreader import parse_parallel
+from laserinterface.helpers.toolpathcache import toolpath_cache
+
+_log = logging.getLogger().getChild(__name__)
+
+config = config_manager['GENERAL']
+
+_executor = None
+_pending = {}   # absolute filename: Future of a file being parsed
+_lock = Lock()
+
+
+def _init_worker(nice):
+    ''' Runs in every parse worker before its first file '''
+    # a ctrl-c reaches the whole process group, the parent shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # the workers yield the cpu to the streaming threads of the interface
+    try:
+        os.nice(nice)
+    except (AttributeError, OSError) as e:
+        _log.warning(f'could not lower the priority of the parser: {e}')
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            # spawn, forking a process with running threads (kivy) is unsafe
+            _executor = ProcessPoolExecutor(
+                max_workers=workers(),
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(max(config.get('PARSE_NICE', 10), 0),))
+        return _executor
+
+
+def workers():
+    ''' The number of parse workers '''
+    return max(config.get('PARSE_WORKERS', 1), 1)
+
+
+def _parse_parallel(filename, future):
+    ''' Runs in a thread, the chunks are parsed by all workers '''
+    try:
+        future.set_result(
+            parse_parallel(filename, _get_executor(), workers()))
+    except Exception as e:
+        future.set_exception(e)
+
+
+def _parsed(filename, future):
+    with _lock:
+        _pending.pop(filename, None)
+    if future.cancelled():
+        return
+    if future.exception() is not None:
+        _log.error(f'parsing {filename} failed: {future.exception()!r}')
+        return
+    toolpath = future.result()
+    if not toolpath.error:
+        toolpath_cache.put(toolpath)
+    _log.info(f'parsed {filename} ahead')
+
+
+def parse_ahead(filename):
+    ''' Parse a file in a worker process and store the toolpath in the
+    toolpath cache. Returns a Future of the Toolpath, which is already done
+    when the file is in the cache. '''
+    filename = os.path.abspath(filename)
+    toolpath = toolpath_cache.get(filename)
+    if toolpath is not None:
+        future = Future()
+        future.set_result(toolpath)
+        return future
+    with _lock:
+        future = _pending.get(filename)
+    if future is not None:
+        return future
+
+    try:
+        size = os.path.getsize(filename)
+    except OSError:
+        size = 0
+    if workers() > 1 and (os.cpu_count() or 1) > 1 and \
+            size >= config.get('PARALLEL_PARSE_SIZE', 1 << 24):
+        # large files are split over the workers, on a single core that is
+        # slower than parsing them in one worker
+        future = Future()
+        Thread(target=_parse_parallel, args=(filename, future),
+               daemon=True).start()
+    else:
+        future = _get_executor().submit(parse_file, filename)
+    with _lock:
+        _pending[filename] = future
+    future.add_done_callback(lambda future: _parsed(filename, future))
+    return future
+
+
+def submit(function, *args):
+    ''' Run function(*args) in a parse worker, returns its Future '''
+    return _get_executor().submit(function, *args)
+
+
+def shutdown():
+    ''' Stop the parse workers, files that are not started are dropped '''
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class QueuedJob():
+    def __init__(self, filename, repeat_count=1):
+        # QueuedJob is a file waiting in the JobQueue. The file is parsed
+        # by a worker while it waits, after that its toolpath (estimate,
+        # bounds, paths to preview) is known and it is validated.
+
+        self.filename = os.path.abspath(filename)
+        self.repeat_count = repeat_count
+        self.problems = []      # reasons the job can not run
+        self.validated = False  # the problems are known
+        self.future = parse_ahead(self.filename)
+
+    @property
+    def toolpath(self):
+        if not self.future.done() or self.future.cancelled() \
+                or self.future.exception() is not None:
+            return None
+        return self.future.result()
+
+    @property
+    def status(self):
+        if not self.future.done() or not self.validated:
+            return 'parsing'
+        if self.toolpath is None or self.problems:
+            return 'invalid'
+        return 'ready'
+
+    @property
+    def duration(self):
+        ''' estimated duration of all repeats in minutes '''
+        toolpath = self.toolpath
+        return toolpath.job_duration*self.repeat_count if toolpath else 0.0
+
+
+class JobQueue():
+    def __init__(self, machine=None):
+        # JobQueue holds the jobs the operator wants to run next. Every
+        # added file is parsed ahead in a ProcessPoolExecutor, while the
+        # current job runs, so the next job is previewed and started from
+        # the toolpath cache without waiting. A job is validated with the
+        # travel of the machine when its parsing is done. Callbacks are
+        # called with the job that changed (added, parsed or removed).
+
+        self.machine = machine
+        self.jobs = []
+        self.callbacks = []
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __iter__(self):
+        return iter(list(self.jobs))
+
+    def add(self, filename, repeat_count=1):
+        job = QueuedJob(filename, repeat_count)
+        with self._lock:
+            self.jobs.append(job)
+        _log.info(f'queued {job.filename}')
+        job.future.add_done_callback(lambda future: self._parsed(job))
+        self._changed(job)
+        return job
+
+    def remove(self, job):
+        with self._lock:
+            if job not in self.jobs:
+                return
+            self.jobs.remove(job)
+        self._changed(job)
+
+    def clear(self):
+        for job in list(self.jobs):
+            self.remove(job)
+
+    def next(self):
+        ''' The first waiting job, or None '''
+        with self._lock:
+            return self.jobs[0] if self.jobs else None
+
+    def pop_ready(self):
+        ''' Remove and return the first job if it is ready to run. Invalid
+        jobs in front of it are dropped. '''
+        while True:
+            job = self.next()
+            if job is None or job.status == 'parsing':
+                return None
+            self.remove(job)
+            if job.status == 'ready':
+                return job
+            _log.warning(f'skipped {job.filename}: {", ".join(job.problems)}')
+
+    def validate(self, job):
+        ''' Returns the reasons the job can not run on the machine '''
+        toolpath = job.toolpath
+        if toolpath is None:
+            return ['could not be parsed']
+        if toolpath.error:
+            return [toolpath.error]
+        problems = []
+        if not toolpath.paths:
+            problems.append('has no moves')
+        grbl_config = self.machine.grbl_config if self.machine else {}
+        for axis, setting in (('x', '$130'), ('y', '$131')):
+            travel = grbl_config.get(setting)
+            size = getattr(toolpath, f'max_{axis}') - \
+                getattr(toolpath, f'min_{axis}')
+            if travel and size > float(travel):
+                problems.append(f'is {size:.0f}mm in {axis}, the machine '
+                                f'travels {float(travel):.0f}mm')
+        return problems
+
+    def _parsed(self, job):
+        job.problems = self.validate(job)
+        job.validated = True
+        if job.problems:
+            _log.warning(f'{job.filename} {", ".join(job.problems)}')
+        self._changed(job)
+
+    def _changed(self, job):
+        for callback in list(self.callbacks):
+            try:
+                callback(job)
+            except Exception:
+                _log.exception('job queue callback failed')
@@ -0,0 +1,189 @@
+# dependencies
+from collections import deque
+from os import path
+from threading import Event, Lock
+import logging
+import re
+import time
+
+from laserinterface.datamanager.config import config_manager as config
+from laserinterface.helpers.gcodereader import seek_line
+
+_log = logging.getLogger().getChild(__name__)
+
+
+class JobStreamer():
+    def __init__(self, grbl, terminal, machine):
+        # JobStreamer prepares the lines of a gcode file for grbl. The lines
+        # are pulled by the sender thread of the GrblInterface when there is
+        # room in the buffer of grbl, so the file is read lazily and only a
+        # few prepared lines (ahead) are kept, whatever the size of the file.
+        # The progress is available in the attributes below.
+
+        self.grbl = grbl
+        self.terminal = terminal
+        self.machine = machine
+
+        self.filename = ''
+        self.repeat = 0
+        self.repeat_count = 1
+        self.size_total = 1
+        self.size_done = 0
+        self.lines_sent = 0
+        self.start_time = None
+        self.end_time = None
+        self.active = False
+
+        self.ahead = deque()    # prepared lines: (line, job line)
+        self.exhausted = False  # all lines of the file are prepared
+        self.cancelled = False  # stopped, the sender finishes the job
+        self.summary = None
+        self.done = Event()
+        self._finish_lock = Lock()
+        self._lines = None
+        self._on_done = None
+
+    @property
+    def progress(self):
+        ''' Progress of all repeats in percent '''
+        done = (self.repeat-1)*self.size_total + self.size_done
+        return min(100.0, max(
+            0.0, done*100/self.size_total/self.repeat_count))
+
+    @property
+    def duration(self):
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.time()) - self.start_time
+
+    def start(self, filename, repeat_count=1, start_line=0, line_index=None,
+              on_done=None):
+        ''' Let grbl pull the lines of the file, repeat_count times. Starts
+        at start_line in the first repeat, using the nearest checkpoint of
+        line_index if it belongs to the file. on_done(summary) is called
+        when grbl acknowledged all lines (the planner summary) or the job is
+        stopped (None). '''
+        if self.active:
+            raise RuntimeError('the job is already active')
+        self.filename = filename
+        self.repeat = 0
+        self.repeat_count = repeat_count
+        self.size_total = max(path.getsize(filename), 1)
+        self.size_done = 0
+        self.lines_sent = 0
+        self.start_time = time.time()
+        self.end_time = None
+        self.ahead.clear()
+        self.exhausted = False
+        self.cancelled = False
+        self.summary = None
+        self.done.clear()
+        self._on_done = on_done
+        self._lines = self._generate(filename, start_line, line_index)
+        self.terminal.start_job(start_line)
+
+        self.active = True
+        self.machine.job_active = True
+        self.machine.planner.start_job()
+        self.grbl.start_job(self)
+
+    def stream(self, filename, repeat_count=1, start_line=0, line_index=None):
+        ''' Like start, but waits until the job is done. Returns the planner
+        summary, or None if the job was stopped. '''
+        self.start(filename, repeat_count, start_line, line_index)
+        self.done.wait()
+        return self.summary
+
+    def stop(self):
+        ''' Stop sending lines, the lines in the buffer of grbl are still
+        executed '''
+        self.grbl.cancel_job(self)
+
+    def prefetch(self, count):
+        ''' Prepare lines until count lines are ahead. Called by the sender
+        while it waits for room in the buffer of grbl. '''
+        while len(self.ahead) < count and not self.exhausted:
+            try:
+                self.ahead.append(next(self._lines))
+            except StopIteration:
+                self.exhausted = True
+                self.machine.planner.stream_finished()
+
+    def finish(self, completed=True):
+        ''' Called by the GrblInterface when the job is done '''
+        with self._finish_lock:
+            if not self.active:
+                return
+            self.active = False
+        if self._lines is not None:
+            try:
+                self._lines.close()     # closes the file
+            except ValueError:
+                pass    # still preparing a line, it is closed when collected
+            self._lines = None
+        self.ahead.clear()
+        self.end_time = time.time()
+        self.machine.job_active = False
+        summary = self.machine.planner.end_job()
+        self.summary = summary if completed else None
+        self.done.set()
+        if self._on_done is not None:
+            self._on_done(self.summary)
+
+    def _generate(self, filename, start_line, line_index):
+        ''' Yields the lines to send as (line, job line) '''
+        # keep only the first x numbers of a decimal
+        trim_nr = config['GENERAL']['TRIM_DECIMALS_TO']
+        re_decimals = re.compile(r'(\w[+-]?\d+\.\d{'+str(trim_nr)+r'})\d+')
+        # spaces and comments (**) and ;**
+        re_comments = re.compile(r'\((.*?)\)|;(.*)')
+        re_redundant = re.compile(r'\+|\s|\(.*?\)|;.*')
+
+        while self.repeat < self.repeat_count:
+            self.repeat += 1
+            self.size_done = 0
+            line_nr = 0
+            with open(filename, 'rb') as file:
+                if self.repeat == 1 and start_line > 0:
+                    state = self.seek_start_line(
+                        file, filename, start_line, line_index)
+                    self.size_done = state.offset
+                    line_nr = state.line
+                    for line in state.preamble():
+                        yield line, None
+
+                for line in file:
+                    self.size_done += len(line)
+                    line_nr += 1
+                    line = line.decode('ascii', 'ignore').strip().upper()
+
+                    # trim decimals:
+                    if trim_nr:
+                        line = re_decimals.sub(r'\1', line)
+
+                    # store comments to terminal, then strip them
+                    comments = re_comments.search(line)
+                    if comments:
+                        self.terminal.store_comment(comments.group(0))
+                    line = re_redundant.sub('', line)
+
+                    if line == '':
+                        continue
+
+                    yield line, line_nr-1
+
+    def seek_start_line(self, file, filename, start_line, line_index=None):
+        ''' Move the file to the start line, starting at the nearest
+        checkpoint of the parsed file. Returns the modal state. '''
+        start_time = time.time()
+        checkpoint = None
+        if line_index is not None and \
+                path.abspath(line_index.filename) == path.abspath(filename):
+            checkpoint = line_index.checkpoint_before(start_line)
+        else:
+            _log.info('No checkpoints available, seeking from the start.')
+
+        state = seek_line(file, start_line, checkpoint)
+        _log.info(f'Resuming at line {state.line} with state {state}, '
+                  f'seeking took {time.time()-start_time:.3f} sec')
+        return state
@@ -0,0 +1,189 @@
+# dependencies
+from collections import deque
+from threading import Event, Lock, Thread
+import logging
+import math
+import time
+
+from laserinterface.data.grbl_doc import COMMANDS
+
+_log = logging.getLogger().getChild(__name__)
+
+SEGMENT_TIME = 0.025    # seconds of motion of a jog line, at least
+MIN_BLOCKS = 2          # jog lines kept in the planner, at least
+REPORT_INTERVAL = 0.05  # seconds between status requests while jogging
+REPORT_AGE = 0.2        # seconds a Bf field is used to correct the estimate
+DEFAULT_RTT = 0.02      # seconds from sending a jog line until its ok
+JITTER = 0.05           # seconds a thread of the interface may be delayed
+DEFAULT_ACCEL = 10.0    # mm/s^2, the grbl default of $120 and $121
+DEFAULT_BLOCKS = 15     # free planner blocks of grbl on an atmega328p
+STOP_TIMEOUT = 2.0      # seconds to wait for the machine to stop
+
+
+class JogStreamer():
+    def __init__(self, grbl, machine):
+        # JogStreamer moves the machine while a jog button is held, with the
+        # jogging model of grbl 1.1: short $J= lines are streamed and only
+        # as many are kept in the planner as needed to move at the full
+        # feed: the distance to decelerate (v^2/2a) plus the distance moved
+        # during two ok round trips and a delay of the thread. A line is
+        # SEGMENT_TIME of motion, or longer when the round trip is long or
+        # the planner is too small.
+        # The planned lines are estimated from the time of their ok and
+        # their duration, corrected with the Bf field of the status reports.
+        # At most one line is sent but not acknowledged. Releasing sends a
+        # jog cancel (0x85) at once: grbl decelerates and drops the planned
+        # jog lines. A line that was on its way is cancelled again.
+
+        self.grbl = grbl
+        self.machine = machine
+        self.rtt = DEFAULT_RTT
+        self.status = ''
+
+        self._lock = Lock()     # no line is sent after the stop
+        self._stop = Event()
+        self._stop.set()
+        self._stop_time = None
+        self._thread = None
+
+        self.m_stop = machine.metrics.histogram(
+            'grbl_jog_stop_seconds',
+            'Time from releasing a jog until the machine stopped')
+        self.m_rtt = machine.metrics.histogram(
+            'grbl_jog_ok_seconds', 'Time from sending a jog line until its ok')
+
+    @property
+    def active(self):
+        return not self._stop.is_set()
+
+    def plan(self, feed, accel, capacity):
+        ''' Returns the length in mm of a jog line at feed (mm/min) and the
+        lines to keep in the planner '''
+        speed = feed/60
+        needed = speed*speed/(2*accel) + speed*(2*self.rtt + JITTER)
+        length = speed*max(SEGMENT_TIME, 1.5*self.rtt)
+        blocks = max(math.ceil(needed/length), MIN_BLOCKS)
+        if blocks > capacity:
+            # longer lines, so the next line always finds a free block
+            blocks = capacity
+            length = needed/blocks
+        return length, blocks
+
+    def start(self, x, y, feed):
+        ''' Jog in the direction (x, y) at feed mm/min until stop '''
+        self.stop()
+        if self._thread is not None:
+            self._thread.join(STOP_TIMEOUT)
+        norm = math.hypot(x, y)
+        if not norm:
+            return
+        if self.machine.job_active:
+            self.status = 'no jogging while a job runs'
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._run, daemon=True,
+                              args=(x/norm, y/norm, feed))
+        self._thread.start()
+
+    def stop(self):
+        ''' Cancel the jog, grbl stops with its deceleration '''
+        with self._lock:
+            if self._stop.is_set() and self._stop_time is not None:
+                return
+            self._stop.set()
+            self._stop_time = time.monotonic()
+        self.grbl.serial_send(COMMANDS['cancel jog'])
+        with self.grbl.wakeup:
+            self.grbl.wakeup.notify_all()
+
+    def _run(self, x, y, feed):
+        grbl = self.grbl
+        config = self.machine.grbl_config
+        self._stop_time = None
+
+        # the limits of the slowest axis that moves
+        axes = [axis for axis, part in enumerate((x, y)) if part]
+        feed = min([feed] + [config.get(f'$11{axis}', feed) for axis in axes])
+        accel = min(config.get(f'$12{axis}', DEFAULT_ACCEL) for axis in axes)
+        capacity = self.machine.planner.block_capacity or DEFAULT_BLOCKS
+        speed = feed/60
+
+        acked, failed = grbl.lines_acked, grbl.lines_failed
+        pending = deque()   # send times of the lines without an ok
+        planned = deque()   # estimated end times of the planned lines
+        requested = 0
+        length, blocks = self.plan(feed, accel, capacity)
+        self.status = ''
+        _log.info(f'jogging at {feed:g}mm/min, lines of {length:.2f}mm, '
+                  f'{blocks} planned')
+
+        while not self._stop.is_set():
+            now = time.monotonic()
+            new, acked = grbl.lines_acked - acked, grbl.lines_acked
+            for _ in range(min(new, len(pending))):
+                rtt = now - pending.popleft()
+                self.m_rtt.observe(rtt)
+                self.rtt += (rtt - self.rtt)*0.2
+                planned.append(max(planned[-1] if planned else now, now)
+                               + length/speed)
+            if grbl.lines_failed != failed:
+                self.status = 'jog rejected by grbl (soft limits?)'
+                _log.warning(self.status)
+                break
+            while planned and planned[0] <= now:
+                planned.popleft()
+
+            # the report shows the lines still planned while accelerating
+            queued = len(planned)
+            used = self.machine.planner.blocks_used
+            age = now - self.machine.last_report_time
+            if used is not None and age < REPORT_AGE:
+                queued = max(queued, used - int(age*speed/length))
+
+            length, blocks = self.plan(feed, accel, capacity)
+            if not pending and queued < blocks:
+                line = '$J=G91G21' + ''.join(
+                    f'{axis}{part*length:.3f}'
+                    for axis, part in zip('XY', (x, y)) if part)
+                line += f'F{feed:g}'
+                with self._lock:
+                    if self._stop.is_set():
+                        break
+                    pending.append(time.monotonic())
+                    grbl.serial_send(line)
+                continue
+
+            if now - requested > REPORT_INTERVAL:
+                grbl.request_state()
+                requested = now
+            timeout = min(planned[0]-now if planned else length/speed,
+                          REPORT_INTERVAL)
+            with grbl.wakeup:
+                grbl.wakeup.wait_for(
+                    lambda: grbl.lines_acked != acked or self._stop.is_set(),
+                    max(timeout, 0.001))
+
+        self.stop()     # after a rejected line
+        self._stopped(pending, acked)
+
+    def _stopped(self, pending, acked):
+        ''' A line on its way is planned after the cancel, it is cancelled
+        again. Measures the time until the machine stopped. '''
+        grbl = self.grbl
+        if pending:
+            with grbl.wakeup:
+                grbl.wakeup.wait_for(
+                    lambda: grbl.lines_acked - acked >= len(pending)
+                    or not grbl.connected, 0.5)
+            grbl.serial_send(COMMANDS['cancel jog'])
+
+        deadline = self._stop_time + STOP_TIMEOUT
+        while time.monotonic() < deadline and grbl.connected:
+            grbl.request_state()
+            time.sleep(0.01)
+            if self.machine.last_report_time > self._stop_time and \
+                    self.machine.grbl_status.get('state') != 'Jog':
+                stopped = self.machine.last_report_time - self._stop_time
+                self.m_stop.observe(stopped)
+                _log.info(f'jog stopped after {stopped*1000:.0f}ms')
+                return
@@ -0,0 +1,274 @@
+# dependencies
+from collections import deque
+from threading import Lock, Thread
+import logging
+import time
+
+from laserinterface.datamanager.config import config_manager
+from laserinterface.datamanager.machine import MachineStateManager
+from laserinterface.datamanager.metrics import export_registries
+from laserinterface.datamanager.terminal import TerminalManager
+from laserinterface.helpers.grblinterface import GrblInterface
+from laserinterface.helpers.grblprocess import GrblProcess
+
+_log = logging.getLogger().getChild(__name__)
+
+config = config_manager['GRBL']
+
+
+class Station():
+    def __init__(self, name, port=None, process=False, pooled=True,
+                 labeled=True, metrics_port=None, interlocked=False):
+        # Station is one grbl device: its connection, terminal, state and a
+        # queue of jobs. The job screen starts the jobs of the primary
+        # station with start_job, the queue is filled from the machines
+        # screen. A queued job only starts when the operator confirms it
+        # with start_next, a laser never starts on its own. Only stations
+        # with interlocked (their laser is stopped by the safety inputs of
+        # the gpio) stream jobs. With process, the connection and
+        # streaming run in a process of their own (GrblProcess). When
+        # pooled, the states are requested by the MachinePool. When
+        # labeled, the metrics and the stored grbl config carry the name of
+        # the station.
+
+        self.name = name
+        label = name if labeled else None
+        self.terminal = TerminalManager()
+        self.machine = MachineStateManager(label)
+        if process:
+            self.grbl = GrblProcess(
+                terminal=self.terminal, machine=self.machine, port=port,
+                name=label, metrics_port=metrics_port)
+        else:
+            self.grbl = GrblInterface(
+                terminal=self.terminal, machine=self.machine, port=port,
+                name=label, poll_state=not pooled)
+        self.process = process
+        self.interlocked = interlocked
+        self.streamer = self.grbl.job_streamer()
+
+        self.jobs = deque()     # waiting jobs: (filename, repeat count)
+        self.results = []       # finished jobs, newest last
+        self.callbacks = []     # called with the result of a finished job
+        self._lock = Lock()
+        self._job = None
+
+    @property
+    def busy(self):
+        return self._job is not None
+
+    def _check_interlock(self):
+        if not self.interlocked:
+            raise RuntimeError(f'{self.name} has no safety interlock')
+
+    def queue_job(self, filename, repeat_count=1):
+        ''' Add a job, it waits until the operator starts it with
+        start_next. Raises a RuntimeError without an interlock. '''
+        self._check_interlock()
+        with self._lock:
+            self.jobs.append((filename, repeat_count))
+
+    def start_job(self, filename, repeat_count=1, start_line=0,
+                  line_index=None, on_done=None):
+        ''' Start a job at once, like JobStreamer.start. Raises a
+        RuntimeError when a job of the station runs or without an
+        interlock. on_done(summary) is called after the callbacks of the
+        station. '''
+        self._check_interlock()
+        with self._lock:
+            if self._job is not None:
+                raise RuntimeError(f'{self.name} runs {self._job[0]}')
+            self._job = (filename, repeat_count)
+        try:
+            self._start(start_line, line_index, on_done)
+        except Exception:
+            with self._lock:
+                self._job = None
+            raise
+
+    @property
+    def next_job(self):
+        ''' The filename of the job start_next would start, or None '''
+        jobs = self.jobs
+        return jobs[0][0] if jobs else None
+
+    def start_next(self):
+        ''' Start the first queued job, called when the operator confirms
+        it. Returns the filename, raises a RuntimeError when the station is
+        busy, not connected, has no interlock or nothing is queued. A job
+        that fails to start is recorded in the results. '''
+        self._check_interlock()
+        with self._lock:
+            if self._job is not None:
+                raise RuntimeError(f'{self.name} runs {self._job[0]}')
+            if not self.grbl.connected:
+                raise RuntimeError(f'{self.name} is not connected')
+            if not self.jobs:
+                raise RuntimeError(f'{self.name} has no queued job')
+            self._job = self.jobs.popleft()
+        filename = self._job[0]
+        try:
+            self._start()
+        except (OSError, RuntimeError) as e:
+            _log.error(f'{self.name}: could not start {filename}: {e}')
+            self._finish({'status': 'error', 'message': str(e)})
+            raise RuntimeError(f'could not start {filename}: {e}') from e
+        return filename
+
+    def _start(self, start_line=0, line_index=None, on_done=None):
+        filename, repeat_count = self._job
+        _log.info(f'{self.name}: starting job {filename}')
+        self.streamer.start(
+            filename, repeat_count, start_line, line_index,
+            on_done=lambda summary: self._job_done(summary, on_done))
+
+    def _job_done(self, summary, on_done=None):
+        self._finish({'status': 'stopped' if summary is None else 'done',
+                      'summary': summary or ''})
+        if on_done is not None:
+            on_done(summary)
+
+    def _finish(self, result):
+        filename, repeat_count = self._job
+        result.update({
+            'station': self.name,
+            'file': filename,
+            'repeat': repeat_count,
+            'lines': self.streamer.lines_sent,
+            'duration': self.streamer.duration,
+        })
+        with self._lock:
+            self.results.append(result)
+            self._job = None
+        for callback in list(self.callbacks):
+            try:
+                callback(result)
+            except Exception:
+                _log.exception(f'{self.name}: job callback failed')
+
+    def stop(self):
+        ''' Clear the waiting jobs and stop the running one '''
+        _log.warning(f'{self.name}: stopping the jobs')
+        with self._lock:
+            self.jobs.clear()
+        if self._job is not None:
+            self.streamer.stop()
+            self.grbl.serial_send('M5')
+
+    def status(self):
+        ''' State of the station for the dashboard '''
+        job = self._job
+        return {
+            'name': self.name,
+            'port': self.grbl.port,
+            'connected': self.grbl.connected,
+            'state': self.machine.grbl_status.get('state', '???'),
+            'buffer_fill': self.grbl.buffer_fill,
+            'file': job[0] if job else '',
+            'progress': self.streamer.progress if job else 0.0,
+            'lines': self.streamer.lines_sent if job else 0,
+            'duration': self.streamer.duration if job else 0.0,
+            'queued': len(self.jobs),
+            'interlocked': self.interlocked,
+        }
+
+
+class MachinePool():
+    def __init__(self, machines=None):
+        # MachinePool controls several grbl devices from one interface, as
+        # configured in the MACHINES section (name: settings), by default
+        # the single machine of the GRBL section. The status reports of the
+        # stations connected in this process are requested by one thread,
+        # evenly spread over the poll period. Stations with PROCESS run in
+        # processes of their own, which spreads the serial io and the
+        # preparation of the lines over the cores. The first station is the
+        # primary one, used by the main screens and the gpio. The other
+        # stations are only interlocked with INTERLOCK (their laser is
+        # switched by the laser output of the gpio), the grbl commands of
+        # the safety callbacks are sent to all interlocked stations. The
+        # stations without an interlock do not stream jobs.
+
+        if machines is None:
+            machines = config_manager.data.get('MACHINES') or {}
+        if not machines:
+            machines = {'grbl': {}}
+        single = len(machines) == 1
+
+        metrics_port = config_manager['GENERAL'].get('METRICS_PORT')
+        self.stations = []
+        for nr, (name, settings) in enumerate(machines.items()):
+            process = settings.get('PROCESS', config.get('PROCESS', False))
+            # every grbl process serves its metrics at a port of its own
+            self.stations.append(Station(
+                name, port=settings.get('PORT'), process=process,
+                labeled=not single,
+                metrics_port=metrics_port and metrics_port+1+nr,
+                interlocked=nr == 0 or settings.get('INTERLOCK', False)))
+        self.primary = self.stations[0]
+
+        self._quit = False
+        self._poller = Thread(target=self._request_states, daemon=True)
+        self._poller.start()
+
+    def __iter__(self):
+        return iter(self.stations)
+
+    def __len__(self):
+        return len(self.stations)
+
+    def __getitem__(self, name):
+        for station in self.stations:
+            if station.name == name:
+                return station
+        raise KeyError(name)
+
+    def connect(self):
+        ''' Connect all stations at once, grbl resets when connecting and
+        is only ready after its welcome message. Returns the stations that
+        failed to connect. '''
+        threads = [Thread(target=station.grbl.connect, daemon=True)
+                   for station in self.stations]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        failed = [station for station in self.stations
+                  if not station.grbl.connected]
+        for station in failed:
+            _log.error(f'{station.name} is not connected '
+                       f'({station.grbl.port})')
+        return failed
+
+    def disconnect(self):
+        self._quit = True
+        for station in self.stations:
+            if station.grbl.connected or station.process:
+                station.grbl.disconnect()
+
+    def _request_states(self):
+        ''' Request the states of the stations one after another, so the
+        reports do not arrive all at once '''
+        while not self._quit:
+            period = 1/config['POLL_STATE_FREQ']
+            polled = [station.grbl for station in self.stations
+                      if not station.process]
+            if not polled:
+                return
+            for grbl in polled:
+                if grbl.connected:
+                    grbl.request_state()
+                time.sleep(period/len(polled))
+
+    @property
+    def interlocked(self):
+        ''' The stations stopped by the safety inputs, primary first '''
+        return [station for station in self.stations if station.interlocked]
+
+    def status(self):
+        return [dict(station.status(), primary=station is self.primary)
+                for station in self.stations]
+
+    def export(self):
+        ''' The metrics of all stations in the prometheus text format '''
+        return export_registries(
+            [station.machine.metrics for station in self.stations])
@@ -0,0 +1,286 @@
+# dependencies
+from array import array
+from collections import deque
+from dataclasses import dataclass, field
+from itertools import accumulate
+import io
+import logging
+import mmap
+import os
+
+from laserinterface.helpers.gcodereader import GcodeReader, Path, Toolpath
+from laserinterface.helpers.gcodereader import keep_path
+from laserinterface.helpers.toolpathcache import file_key
+
+_log = logging.getLogger().getChild(__name__)
+
+MIN_CHUNK_SIZE = 1 << 20    # bytes, smaller files are not split
+WARMUP_LINES = 200          # lines before a chunk used to guess its state
+COUNT_BLOCK = 1 << 24       # bytes read at once to count the lines
+SEARCH_SIZE = 1 << 22       # bytes before a chunk searched for modal words
+HEADER_SIZE = 1 << 16       # and at the start of the file, the setup lines
+# the last line with one of these words sets a part of the state, X and Y
+# for the position in absolute mode
+MODAL_WORDS = (
+    (b'G20', b'G21'),
+    (b'G90', b'G91'),
+    (b'G0', b'G1', b'G2', b'G3'),
+    (b'M3', b'M4', b'M5', b'M03', b'M04', b'M05'),
+    (b'F',),
+    (b'S',),
+    (b'X',),
+    (b'Y',),
+)
+
+
+def reader_state(reader):
+    ''' Everything of the reader that changes how the next lines are
+    handled '''
+    _path = reader.current_path
+    return (reader.unit_factor, reader.absolute_steps, reader.feed_rate,
+            reader.feed, reader.power, reader.target, reader.spindle,
+            _path.move_type, _path.laser_on, _path.points_x[-1],
+            _path.points_y[-1], _path.point_lines[-1])
+
+
+def apply_state(reader, state):
+    ''' Continue with the state of reader_state, the current path only has
+    its last point '''
+    (reader.unit_factor, reader.absolute_steps, reader.feed_rate,
+     reader.feed, reader.power, reader.target, reader.spindle,
+     move_type, laser_on, x, y, point_line) = state
+    reader.current_path = Path([x], [y], move_type=move_type,
+                               laser_on=laser_on, point_lines=[point_line])
+
+
+class _ChunkReader(GcodeReader):
+    ''' Parses a part of a file, continuing the current path of the lines
+    before. That path (the head) is not finished here, it is finished after
+    joining it with its start. The duration is not summed but kept per move,
+    so the total is summed in the order of the whole file. '''
+
+    def __init__(self):
+        self.durations = array('d')
+        super().__init__()
+        del self.durations[:]
+        self.head = self.current_path
+        self.head_finished = False
+
+    @property
+    def job_duration(self):
+        return 0
+
+    @job_duration.setter
+    def job_duration(self, duration):
+        # the reader adds the duration of a move to job_duration
+        self.durations.append(duration)
+
+    def start(self, state):
+        apply_state(self, state)
+        self.head = self.current_path
+
+    def _complete_path(self, _path):
+        if _path is self.head:
+            self.head_finished = True
+        else:
+            super()._complete_path(_path)
+
+
+@dataclass
+class Chunk:
+    ''' The result of parsing the lines from start to end of a file '''
+    start: int = 0
+    end: int = 0
+    first_line: int = 0
+    start_state: tuple = ()
+    end_state: tuple = ()
+    head: Path = None
+    head_finished: bool = False
+    paths: list = field(default_factory=list)
+    tail: Path = None
+    checkpoints: list = field(default_factory=list)
+    warnings: list = field(default_factory=list)
+    durations: array = None
+    max_x: float = 0.0
+    max_y: float = 0.0
+    min_x: float = 0.0
+    min_y: float = 0.0
+    error: str = ''
+
+
+def _line_at(data, position, end):
+    start = data.rfind(b'\n', 0, position) + 1
+    stop = data.find(b'\n', position, end)
+    return start, data[start:end if stop < 0 else stop+1]
+
+
+def guess_state(data, start, first_line):
+    ''' Guess the reader state at byte start, quick: the lines with the last
+    modal words are handled, followed by the lines just before start. The
+    guess is checked with the exact state when the chunks are joined. '''
+    reader = GcodeReader()
+    if start == 0:
+        return reader_state(reader)
+
+    warmup = start
+    for _ in range(WARMUP_LINES):
+        if warmup == 0:
+            break
+        warmup = data.rfind(b'\n', 0, warmup-1) + 1
+
+    def last(words, start, end):
+        return max(data.rfind(word_case, start, end)
+                   for word in words
+                   for word_case in (word, word.lower()))
+
+    lines = {}
+    for words in MODAL_WORDS:
+        # a full search would read the whole file for a missing word
+        found = last(words, max(warmup-SEARCH_SIZE, 0), warmup)
+        if found < 0:
+            found = last(words, 0, min(HEADER_SIZE, warmup))
+        if found >= 0:
+            line_start, line = _line_at(data, found, warmup)
+            lines[line_start] = line
+    warmup_lines = data[warmup:start].splitlines(keepends=True)
+
+    # the line numbers only matter for the point of the last moves
+    reader._handle_lines([lines[key] for key in sorted(lines)],
+                         first_line - len(warmup_lines) - len(lines))
+    reader._handle_lines(warmup_lines, first_line - len(warmup_lines))
+    return reader_state(reader)
+
+
+def parse_chunk(filename, start, end, first_line, state=None):
+    ''' Parse the lines from byte start up to end, starting with the
+    reader state, or a guessed state. Runs in a worker process. '''
+    chunk = Chunk(start=start, end=end, first_line=first_line)
+    reader = _ChunkReader()
+    with open(filename, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if state is None:
+                state = guess_state(data, start, first_line)
+            reader.start(state)
+            reader._handle_lines(io.BytesIO(data[start:end]),
+                                 first_line, start)
+        except UnicodeDecodeError:
+            chunk.error = 'can not be decoded as text'
+        finally:
+            data.close()
+
+    chunk.start_state = state
+    chunk.end_state = reader_state(reader)
+    chunk.head = reader.head
+    chunk.head_finished = reader.head_finished
+    chunk.paths = reader.complete_paths
+    chunk.tail = reader.current_path
+    chunk.checkpoints = reader.checkpoints
+    chunk.warnings = reader.warnings
+    chunk.durations = reader.durations
+    chunk.max_x, chunk.max_y = reader.max_x, reader.max_y
+    chunk.min_x, chunk.min_y = reader.min_x, reader.min_y
+    return chunk
+
+
+def split_lines(filename, count):
+    ''' Split a file in count parts at line boundaries. Returns the parts as
+    (start, end, first line number), and the number of lines '''
+    size = os.path.getsize(filename)
+    count = max(min(count, size // MIN_CHUNK_SIZE), 1)
+    targets = [size*k // count for k in range(1, count)]
+
+    parts = []
+    start = first_line = lines = 0
+    position = 0
+    last = b''
+    with open(filename, 'rb') as file:
+        while True:
+            block = file.read(COUNT_BLOCK)
+            if not block:
+                break
+            # parts end after the first newline at or after their target
+            while targets and targets[0] < position + len(block):
+                newline = block.find(b'\n', max(targets[0]-position, 0))
+                if newline < 0:
+                    break
+                end = position + newline + 1
+                targets.pop(0)
+                if end <= start:
+                    continue
+                lines_before = lines + block.count(b'\n', 0, newline+1)
+                parts.append((start, end, first_line))
+                start, first_line = end, lines_before
+            lines += block.count(b'\n')
+            position += len(block)
+            last = block[-1:]
+    if position > start:
+        parts.append((start, position, first_line))
+    if last and last != b'\n':
+        lines += 1   # the last line has no newline
+    return parts, lines
+
+
+def join_chunks(filename, key, chunks, lines):
+    ''' Join the chunks of a file to the Toolpath of the sequential parse '''
+    toolpath = Toolpath(filename=filename, key=key, lines=max(lines, 1))
+    current_path = GcodeReader().current_path
+    job_duration = 0
+    for chunk in chunks:
+        # the head continues the current path, its first point is the last
+        # point of the current path
+        current_path.points_x.extend(chunk.head.points_x[1:])
+        current_path.points_y.extend(chunk.head.points_y[1:])
+        current_path.point_lines.extend(chunk.head.point_lines[1:])
+        if chunk.head_finished:
+            current_path.end_line = chunk.head.end_line
+            if keep_path(current_path):
+                toolpath.paths.append(current_path)
+            toolpath.paths.extend(chunk.paths)
+            current_path = chunk.tail
+
+        toolpath.checkpoints.extend(chunk.checkpoints)
+        toolpath.warnings.extend(chunk.warnings)
+        if chunk.durations:
+            # summed in the order of the file, like the reader does
+            job_duration = deque(accumulate(
+                chunk.durations, initial=job_duration), maxlen=1)[0]
+        toolpath.max_x = max(toolpath.max_x, chunk.max_x)
+        toolpath.max_y = max(toolpath.max_y, chunk.max_y)
+        toolpath.min_x = min(toolpath.min_x, chunk.min_x)
+        toolpath.min_y = min(toolpath.min_y, chunk.min_y)
+    toolpath.job_duration = job_duration
+    return toolpath
+
+
+def parse_parallel(filename, executor, count):
+    ''' Parse a file in count parts on the executor, the Toolpath is the same
+    as that of GcodeReader.parse. The state at the start of every part is
+    guessed by its worker, a part with a wrong guess is parsed again with the
+    end state of the part before it. '''
+    filename = os.path.abspath(filename)
+    try:
+        key = file_key(filename)
+        parts, lines = split_lines(filename, count)
+    except OSError:
+        return GcodeReader().parse(filename)
+    if len(parts) < 2:
+        return GcodeReader().parse(filename)
+
+    futures = [executor.submit(parse_chunk, filename, *part)
+               for part in parts]
+    chunks = []
+    state = reader_state(GcodeReader())
+    for part, future in zip(parts, futures):
+        chunk = future.result()
+        if chunk.start_state != state:
+            _log.debug(f'{filename}: wrong state guess at line {part[2]}')
+            chunk = executor.submit(
+                parse_chunk, filename, *part, state).result()
+        if chunk.error:
+            # same result as the reader, which stops at the error
+            return GcodeReader().parse(filename)
+        chunks.append(chunk)
+        state = chunk.end_state
+
+    return join_chunks(filename, key, chunks, lines)
@@ -0,0 +1,492 @@
+
+# dependencies
+from dataclasses import dataclass, field, replace
+import logging
+import math
+import re
+import time
+
+from laserinterface.helpers.gcodereader import MOVE_TYPE, ModalState
+
+_log = logging.getLogger().getChild(__name__)
+
+# rate of rapid moves in mm/min, used when the grbl config is unknown
+RAPID_RATE = 5000
+
+# number of neighbouring cuts that are tried by the 2-opt refinement
+TWO_OPT_WINDOW = 25
+
+# Words of the lines between the cuts. The modal words and laser-off moves
+# are dropped, the preamble of every cut restores them. The coolant (air
+# assist) is restored for every cut, the dwells and pauses are written before
+# the cut that follows them. Other words refuse the optimization.
+TRAVEL_WORDS = {'G0', 'G1', 'G2', 'G3', 'G17', 'G20', 'G21', 'G90', 'G91',
+                'G94', 'M3', 'M4', 'M5', 'F', 'I', 'J', 'N', 'S', 'X', 'Y'}
+COOLANT_WORDS = {'M7', 'M8', 'M9'}
+CARRIED_WORDS = {'G4', 'M0', 'M1', 'P'}
+
+re_comment = re.compile(r'\(.*?\)|;.*')
+
+
+@dataclass
+class Cut:
+    ''' A series of connected laser-on paths. Cuts can be reordered without
+    changing the result of the job. '''
+    first_line: int         # first line of the file belonging to the cut
+    last_line: int          # last line of the file belonging to the cut
+    points_x: list = field(default_factory=list)
+    points_y: list = field(default_factory=list)
+    reversible: bool = True     # only cuts of straight lines can be reversed
+    reversed: bool = False
+    state: ModalState = None    # modal state at the first line
+    laser: tuple = ('M5', 0.0)  # spindle command and power while cutting
+    feed: float = 0.0           # feed while cutting, in the units of the file
+    coolant: tuple = ((), ())   # M7 and M8 on at the first and last line
+    carried: list = field(default_factory=list)     # lines before the cut
+    start_offset: int = 0       # byte offset of the first line
+    end_offset: int = 0         # byte offset after the last line
+    inner: list = field(default_factory=list)   # cuts inside this contour
+    outer: list = field(default_factory=list)   # contours around this cut
+
+    @property
+    def start(self):
+        if self.reversed:
+            return self.points_x[-1], self.points_y[-1]
+        return self.points_x[0], self.points_y[0]
+
+    @property
+    def end(self):
+        if self.reversed:
+            return self.points_x[0], self.points_y[0]
+        return self.points_x[-1], self.points_y[-1]
+
+    @property
+    def closed(self):
+        return (math.isclose(self.points_x[0], self.points_x[-1],
+                             abs_tol=0.01) and
+                math.isclose(self.points_y[0], self.points_y[-1],
+                             abs_tol=0.01))
+
+    @property
+    def bbox(self):
+        return (min(self.points_x), min(self.points_y),
+                max(self.points_x), max(self.points_y))
+
+
+def find_cuts(paths):
+    ''' Combine connected laser-on paths (as made by the GcodeReader) to a
+    list of cuts. Rapid moves and laser-off moves separate the cuts. '''
+    cuts = []
+    current = None
+    for _path in paths:
+        if (not _path.laser_on or _path.move_type == MOVE_TYPE['RAPID']
+                or len(_path.points_x) < 2):
+            current = None
+            continue
+
+        if current is None:
+            # the first point is the end of the previous move
+            current = Cut(
+                first_line=_path.point_lines[0]+1,
+                last_line=_path.point_lines[-1],
+                points_x=list(_path.points_x),
+                points_y=list(_path.points_y),
+            )
+            cuts.append(current)
+        else:
+            current.points_x.extend(_path.points_x[1:])
+            current.points_y.extend(_path.points_y[1:])
+            current.last_line = _path.point_lines[-1]
+
+        if _path.move_type != MOVE_TYPE['LINEAR']:
+            current.reversible = False
+
+    return cuts
+
+
+class PointGrid:
+    ''' Uniform grid of cut endpoints, used to find the nearest cut. '''
+
+    def __init__(self, cuts, cell_size):
+        self.cuts = cuts
+        self.cell_size = cell_size
+        self.cells = {}
+        self.count = 0
+
+    def _cell(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def add(self, k):
+        cut = self.cuts[k]
+        ends = [(cut.points_x[0], cut.points_y[0])]
+        if cut.reversible:
+            ends.append((cut.points_x[-1], cut.points_y[-1]))
+        for x, y in ends:
+            self.cells.setdefault(self._cell(x, y), set()).add(k)
+        self.count += 1
+
+    def remove(self, k):
+        cut = self.cuts[k]
+        for x, y in ((cut.points_x[0], cut.points_y[0]),
+                     (cut.points_x[-1], cut.points_y[-1])):
+            cell = self._cell(x, y)
+            if cell in self.cells:
+                self.cells[cell].discard(k)
+                if not self.cells[cell]:
+                    del self.cells[cell]
+        self.count -= 1
+
+    def _distance(self, k, x, y):
+        ''' returns the distance to the closest end of a cut and if the cut
+        should be reversed to start there '''
+        cut = self.cuts[k]
+        dist = math.hypot(cut.points_x[0]-x, cut.points_y[0]-y)
+        if cut.reversible:
+            dist_rev = math.hypot(cut.points_x[-1]-x, cut.points_y[-1]-y)
+            if dist_rev < dist:
+                return dist_rev, True
+        return dist, False
+
+    def nearest(self, x, y):
+        ''' Returns (index, reversed) of the cut that starts closest to x, y
+        by searching rings of cells around the position. '''
+        cx, cy = self._cell(x, y)
+        best = (None, False)
+        best_dist = math.inf
+        ring = 0
+        while self.count > 0:
+            if 8*ring > len(self.cells):
+                # the grid is almost empty, check all remaining cells
+                for cell in self.cells.values():
+                    for k in cell:
+                        dist, reverse = self._distance(k, x, y)
+                        if dist < best_dist:
+                            best, best_dist = (k, reverse), dist
+                break
+
+            for i in range(cx-ring, cx+ring+1):
+                for j in range(cy-ring, cy+ring+1):
+                    if max(abs(i-cx), abs(j-cy)) != ring:
+                        continue
+                    for k in self.cells.get((i, j), ()):
+                        dist, reverse = self._distance(k, x, y)
+                        if dist < best_dist:
+                            best, best_dist = (k, reverse), dist
+            # points outside of the searched rings are at least this far
+            if best[0] is not None and best_dist <= ring*self.cell_size:
+                break
+            ring += 1
+        return best
+
+
+class PathOptimizer:
+    ''' Reorders (and reverses) the cuts of a gcode file to minimize the
+    distance traveled with the laser off. Contours are only cut after all
+    the cuts inside of them. '''
+
+    def __init__(self, filename, paths, rapid_rate=RAPID_RATE,
+                 allow_reverse=True):
+        self.filename = filename
+        self.rapid_rate = rapid_rate
+        self.cuts = find_cuts(paths)
+        if not allow_reverse:
+            for cut in self.cuts:
+                cut.reversible = False
+
+        self.order = list(range(len(self.cuts)))
+        self._scanned = None    # (header end, footer start, footer state)
+        self.travel_before = self.travel_distance()
+        self.travel_after = self.travel_before
+
+    @property
+    def time_saved(self):
+        ''' machine time saved in minutes, like GcodeReader.job_duration '''
+        return (self.travel_before - self.travel_after)/self.rapid_rate
+
+    def travel_distance(self):
+        x, y = 0.0, 0.0
+        distance = 0.0
+        for k in self.order:
+            start_x, start_y = self.cuts[k].start
+            distance += math.hypot(start_x-x, start_y-y)
+            x, y = self.cuts[k].end
+        return distance
+
+    def optimize(self, time_limit=5.0):
+        ''' Order the cuts by nearest neighbour, then refine the order with
+        2-opt until no improvement is found or time_limit is reached. '''
+        if not self.cuts:
+            return self.order
+        start_time = time.time()
+
+        self._scan_file()
+        self._find_contours()
+        self._nearest_neighbour()
+        while time.time()-start_time < time_limit:
+            if not self._two_opt(start_time+time_limit):
+                break
+
+        self.travel_after = self.travel_distance()
+        _log.info(f'Optimized {len(self.cuts)} cuts in '
+                  f'{time.time()-start_time:.2f} sec. Travel reduced from '
+                  f'{self.travel_before:.0f}mm to {self.travel_after:.0f}mm, '
+                  f'saving {self.time_saved:.2f} min')
+        return self.order
+
+    def _cell_size(self):
+        min_x = min(min(cut.points_x) for cut in self.cuts)
+        max_x = max(max(cut.points_x) for cut in self.cuts)
+        min_y = min(min(cut.points_y) for cut in self.cuts)
+        max_y = max(max(cut.points_y) for cut in self.cuts)
+        area = max((max_x-min_x)*(max_y-min_y), 1.0)
+        return max(math.sqrt(area/len(self.cuts)), 0.1)
+
+    def _find_contours(self):
+        ''' Store which cuts are inside of a closed cut. Only the bounding
+        boxes are compared. '''
+        cell_size = self._cell_size()
+        centers = {}
+        bboxes = [cut.bbox for cut in self.cuts]
+        for k, (x0, y0, x1, y1) in enumerate(bboxes):
+            cell = (int((x0+x1)/2 // cell_size), int((y0+y1)/2 // cell_size))
+            centers.setdefault(cell, []).append(k)
+
+        for k, cut in enumerate(self.cuts):
+            if not cut.closed:
+                continue
+            x0, y0, x1, y1 = bboxes[k]
+            for i in range(int(x0 // cell_size), int(x1 // cell_size)+1):
+                for j in range(int(y0 // cell_size), int(y1 // cell_size)+1):
+                    for n in centers.get((i, j), ()):
+                        bx0, by0, bx1, by1 = bboxes[n]
+                        if n != k and (x0 <= bx0 and bx1 <= x1 and
+                                       y0 <= by0 and by1 <= y1 and
+                                       (bx1-bx0)*(by1-by0) < (x1-x0)*(y1-y0)):
+                            cut.inner.append(n)
+                            self.cuts[n].outer.append(k)
+
+    def _nearest_neighbour(self):
+        grid = PointGrid(self.cuts, self._cell_size())
+        waiting = [len(cut.inner) for cut in self.cuts]
+        for k in range(len(self.cuts)):
+            if not waiting[k]:
+                grid.add(k)
+
+        order = []
+        x, y = 0.0, 0.0
+        while grid.count > 0:
+            k, reverse = grid.nearest(x, y)
+            grid.remove(k)
+            cut = self.cuts[k]
+            cut.reversed = reverse
+            order.append(k)
+            x, y = cut.end
+
+            # contours become available when all inner cuts are done
+            for n in cut.outer:
+                waiting[n] -= 1
+                if not waiting[n]:
+                    grid.add(n)
+
+        self.order = order
+
+    def _two_opt(self, deadline):
+        ''' Reverse sections of the order when that shortens the travel.
+        Returns True if the order was improved. '''
+        def dist(a, b):
+            return math.hypot(a[0]-b[0], a[1]-b[1])
+
+        cuts = self.cuts
+        order = self.order
+        improved = False
+        for i in range(1, len(order)-1):
+            if time.time() > deadline:
+                break
+            if not cuts[order[i]].reversible:
+                continue
+            prev_end = cuts[order[i-1]].end
+            for j in range(i+1, min(i+TWO_OPT_WINDOW, len(order)-1)):
+                if not cuts[order[j]].reversible:
+                    break
+                next_start = cuts[order[j+1]].start
+                old = (dist(prev_end, cuts[order[i]].start)
+                       + dist(cuts[order[j]].end, next_start))
+                new = (dist(prev_end, cuts[order[j]].end)
+                       + dist(cuts[order[i]].start, next_start))
+                if new >= old - 1e-6:
+                    continue
+
+                # do not swap a contour with a cut inside of it
+                section = set(order[i:j+1])
+                if any(n in section for k in section for n in cuts[k].inner):
+                    continue
+
+                order[i:j+1] = order[i:j+1][::-1]
+                for k in order[i:j+1]:
+                    cuts[k].reversed = not cuts[k].reversed
+                improved = True
+                break
+        return improved
+
+    def _words(self, line_nr, text):
+        ''' The words of a line between the cuts, like G4 or X '''
+        words = set()
+        for letter, value in ModalState.re_words.findall(text):
+            if letter in 'GM':
+                try:
+                    number = float(value)
+                except ValueError:
+                    number = math.nan
+                if number != int(number):
+                    self._refuse(line_nr, f'{letter}{value} between the cuts')
+                words.add(f'{letter}{int(number)}')
+            else:
+                words.add(letter)
+        unknown = words - TRAVEL_WORDS - COOLANT_WORDS - CARRIED_WORDS
+        if unknown:
+            self._refuse(line_nr, f'{" ".join(sorted(unknown))} between the '
+                                  f'cuts can not be moved')
+        if words & CARRIED_WORDS and words & (TRAVEL_WORDS - {'N'}):
+            self._refuse(line_nr, 'a dwell or pause on a line with a move')
+        return words
+
+    def _refuse(self, line_nr, reason):
+        message = f'line {line_nr+1}: {reason}'
+        _log.warning(f'Not optimizing {self.filename}, {message}')
+        raise ValueError(message)
+
+    def _scan_file(self):
+        ''' Find the modal state, byte offsets and the carried lines of
+        every cut with a single pass over the file. Cuts that change the
+        laser or feed on the way can not be reversed. Raises a ValueError
+        when a line between the cuts can not be moved with its cut. '''
+        by_first = {cut.first_line: cut for cut in self.cuts}
+        by_last = {cut.last_line: cut for cut in self.cuts}
+        last_first = max(by_first, default=-1)
+        state = ModalState()
+        coolant = set()
+        header_end = footer_start = footer_state = None
+        footer_coolant = ()
+        cut = None
+        carried = []
+        with open(self.filename, 'rb') as file:
+            for line_nr, raw in enumerate(file):
+                text = raw.decode('ascii', 'ignore')
+                code = re_comment.sub('', text).upper().strip()
+                if line_nr in by_first:
+                    cut = by_first[line_nr]
+                    cut.state = replace(state)
+                    cut.start_offset = state.offset
+                    cut.coolant = (tuple(sorted(coolant)), ())
+                    cut.carried, carried = carried, []
+                    if header_end is None:
+                        header_end = state.offset
+                elif cut is None and header_end is not None and \
+                        line_nr < last_first:
+                    # a line between two cuts
+                    if code.startswith('$'):
+                        self._refuse(line_nr, f'{code} between the cuts')
+                    words = self._words(line_nr, code)
+                    if words & CARRIED_WORDS or (not code and text.strip()):
+                        carried.append(raw if raw.endswith(b'\n')
+                                       else raw+b'\n')
+
+                if 'M' in code:
+                    codes = {f'M{value.lstrip("0")}' for letter, value
+                             in ModalState.re_words.findall(code)
+                             if letter == 'M'}
+                    if 'M9' in codes:
+                        coolant.clear()
+                    coolant |= codes & {'M7', 'M8'}
+                state.update(text)
+                state.offset += len(raw)
+                state.line += 1
+
+                if cut is not None:
+                    # the first line of a cut turns the laser on, a reversed
+                    # cut is written with the laser and feed after it
+                    laser = (state.spindle, state.power, state.feed,
+                             tuple(sorted(coolant)))
+                    if line_nr == cut.first_line:
+                        cut.laser = laser[:2]
+                        cut.feed = laser[2]
+                        first = laser
+                    elif laser != first:
+                        cut.reversible = False
+                if line_nr in by_last:
+                    cut = None
+                    by_last[line_nr].end_offset = state.offset
+                    by_last[line_nr].coolant = (
+                        by_last[line_nr].coolant[0], tuple(sorted(coolant)))
+                    footer_start = state.offset
+                    footer_state = replace(state, spindle='M5')
+                    footer_coolant = tuple(sorted(coolant))
+        self._scanned = (header_end or 0, footer_start or 0,
+                         footer_state, footer_coolant)
+        return self._scanned
+
+    @staticmethod
+    def _coolant_lines(current, coolant):
+        ''' The lines that change the coolant from current to coolant '''
+        if current == coolant:
+            return []
+        if set(current) - set(coolant):
+            return ['M9'] + list(coolant)
+        return [code for code in coolant if code not in current]
+
+    def write(self, out_filename):
+        ''' Write the reordered program. Cuts that are not reversed are copied
+        from the original file, reversed cuts are written as G1 moves. Every
+        cut is preceded by the comments, dwells and pauses before it in the
+        original file. Raises a ValueError when the file can not be
+        reordered. '''
+        if self._scanned is None:
+            self._scan_file()
+        header_end, footer_start, footer_state, footer_coolant = self._scanned
+        # the coolant after the header
+        coolant = self.cuts[0].coolant[0] if self.cuts else ()
+        with open(self.filename, 'rb') as src, open(out_filename, 'wb') as out:
+            out.write(src.read(header_end))
+
+            for k in self.order:
+                cut = self.cuts[k]
+                x, y = cut.start
+                state = replace(cut.state, x=x, y=y)
+                if not cut.reversed:
+                    lines = state.preamble()
+                    src.seek(cut.start_offset)
+                    body = src.read(cut.end_offset-cut.start_offset)
+                else:
+                    # reversed cuts are written in mm and absolute distances
+                    feed = cut.feed*(25.4 if state.inches else 1.0)
+                    spindle, power = cut.laser
+                    state = replace(state, inches=False, absolute=True,
+                                    motion='G1', feed=feed, spindle=spindle,
+                                    power=power)
+                    lines = state.preamble()
+                    body = ''.join(
+                        f'X{px:.3f}Y{py:.3f}\n' for px, py in zip(
+                            reversed(cut.points_x[:-1]),
+                            reversed(cut.points_y[:-1]))).encode('ascii')
+                # the air assist is on before the dwells before the cut
+                changes = self._coolant_lines(coolant, cut.coolant[0])
+                coolant = cut.coolant[1]
+                if changes:
+                    out.write(('\n'.join(changes)+'\n').encode('ascii'))
+                out.write(b''.join(cut.carried))
+                out.write(('\n'.join(lines)+'\n').encode('ascii'))
+                out.write(body)
+                if not body.endswith(b'\n'):
+                    out.write(b'\n')
+                out.write(b'M5\n')
+
+            # the footer continues from the end of the last cut of the file
+            if footer_state is not None:
+                lines = (footer_state.preamble()
+                         + self._coolant_lines(coolant, footer_coolant))
+                out.write(('\n'.join(lines)+'\n').encode('ascii'))
+            src.seek(footer_start)
+            out.write(src.read())
+
+        _log.info(f'Written the optimized program to {out_filename}')
+        return out_filename
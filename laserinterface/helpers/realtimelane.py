@@ -0,0 +1,188 @@
+# dependencies
+from collections import deque
+from threading import Lock
+import logging
+import time
+
+from laserinterface.data.grbl_doc import COMMANDS
+
+_log = logging.getLogger().getChild(__name__)
+
+# the overrides of grbl 1.1 and their index in the Ov field of the reports
+OVERRIDES = {'feed': 0, 'power': 2}
+OVERRIDE_STEPS = {'-10': -10, '-1': -1, '+1': 1, '+10': 10}
+OVERRIDE_MIN = 10       # percent, grbl keeps the overrides in this range
+OVERRIDE_MAX = 200
+OVERRIDE_INTERVAL = 0.02    # seconds changes are coalesced after a write
+
+
+def _clamp(value):
+    return min(max(int(round(value)), OVERRIDE_MIN), OVERRIDE_MAX)
+
+
+def override_bytes(kind, value, target):
+    ''' The shortest sequence of override commands that changes the
+    override kind ('feed' or 'power') from value to target percent '''
+    value, target = _clamp(value), _clamp(target)
+    moves = [(COMMANDS[f'{kind} reset'], lambda _: 100)] + [
+        (COMMANDS[f'{kind} {name}'], lambda v, step=step: _clamp(v+step))
+        for name, step in OVERRIDE_STEPS.items()]
+
+    # breadth first over the 191 values, the clamping can be a shortcut
+    previous = {value: None}
+    reached = [value]
+    while target not in previous:
+        reached, current = [], reached
+        for v in current:
+            for byte, move in moves:
+                after = move(v)
+                if after not in previous:
+                    previous[after] = (v, byte)
+                    reached.append(after)
+
+    sequence = []
+    while previous[target] is not None:
+        target, byte = previous[target]
+        sequence.append(byte)
+    return bytes(reversed(sequence))
+
+
+class RealtimeLane():
+    def __init__(self, grbl, machine):
+        # RealtimeLane writes the realtime commands of grbl (single bytes, like
+        # a feed hold or an override), which grbl handles as soon as they
+        # arrive. Every write to the port of grbl (a GrblInterface) goes
+        # through it: a realtime byte is written at once by the thread that
+        # sends it or, while the sender writes lines, right after that write,
+        # before the next lines. Overrides are kept as targets: changes within
+        # OVERRIDE_INTERVAL of the last override write are coalesced into the
+        # shortest sequence of override bytes, written by the sender when
+        # due(). The Ov field of the status reports confirms the overrides.
+        # grbl makes a report before it handles the overrides that arrived with
+        # the request, so a difference (a lost byte) is only corrected when two
+        # reports in a row show it.
+
+        self.grbl = grbl
+        self.latency = machine.latency
+        self.values = dict.fromkeys(OVERRIDES, 100)     # after the writes
+        self.targets = dict(self.values)
+
+        self._queue = deque()   # (byte, time queued, latency trace)
+        self._lock = Lock()     # held while writing to the port
+        self._written = 0.0     # time of the last override write
+        self._changed = {}      # kind: time of a change not yet confirmed
+        self._differs = {}      # kind: a reported value that differs
+
+        metrics = machine.metrics
+        self.m_latency = metrics.histogram(
+            'grbl_realtime_latency_seconds',
+            'Time from queueing a realtime command until it is written')
+        self.m_bytes = metrics.counter(
+            'grbl_realtime_bytes_total', 'Realtime bytes written to grbl')
+        self.m_changes = metrics.counter(
+            'grbl_override_changes_total', 'Override changes requested')
+        self.m_override_bytes = metrics.counter(
+            'grbl_override_bytes_total', 'Override bytes written to grbl')
+        self.m_confirm = metrics.histogram(
+            'grbl_override_confirm_seconds',
+            'Time from an override change until a report showed it')
+        self.m_mismatch = metrics.counter(
+            'grbl_override_mismatch_total',
+            'Reports with another override than was written')
+
+    def send(self, byte):
+        ''' Write a realtime command (bytes) as soon as possible '''
+        trace = self.latency.current()
+        if trace is not None:
+            self.latency.discard()  # it ends at the write
+        self._queue.append((byte, time.perf_counter(), trace))
+        self.flush()
+
+    def override(self, kind, target):
+        ''' Change the override kind ('feed' or 'power') to target percent '''
+        self.m_changes.inc()
+        self.targets[kind] = _clamp(target)
+        self._changed.setdefault(kind, time.perf_counter())
+        self.flush()
+
+    def due(self):
+        ''' Seconds until the changed overrides are written, None when
+        there are none '''
+        if self.targets == self.values:
+            return None
+        return max(self._written + OVERRIDE_INTERVAL - time.perf_counter(), 0)
+
+    def reset(self):
+        ''' grbl was reset, the overrides are 100% again '''
+        self.values = dict.fromkeys(OVERRIDES, 100)
+        self.targets = dict(self.values)
+        self._changed.clear()
+        self._differs.clear()
+
+    def write(self, data):
+        ''' Write lines (bytes), after the waiting realtime commands '''
+        with self._lock:
+            self._write_waiting()
+            self.grbl.ser.write(data)
+        self.flush()
+
+    def flush(self):
+        ''' Write the waiting realtime commands, unless another thread is
+        writing: it flushes after its write '''
+        while (self._queue or self.due() == 0) and \
+                self._lock.acquire(blocking=False):
+            try:
+                self._write_waiting()
+            finally:
+                self._lock.release()
+
+    def _write_waiting(self):
+        data = bytearray()
+        waited = []
+        while self._queue:
+            byte, queued, trace = self._queue.popleft()
+            data += byte
+            waited.append((queued, trace))
+        if self.due() == 0:
+            for kind, target in list(self.targets.items()):
+                sequence = override_bytes(kind, self.values[kind], target)
+                self.values[kind] = target
+                self.m_override_bytes.inc(len(sequence))
+                data += sequence
+            self._written = time.perf_counter()
+            self._differs.clear()
+        if not data:
+            return
+
+        for _, trace in waited:
+            if trace is not None:
+                trace.mark('wait')
+        self.grbl.ser.write(bytes(data))
+        written = time.perf_counter()
+        self.m_bytes.inc(len(data))
+        for queued, trace in waited:
+            self.m_latency.observe(written-queued)
+            if trace is not None:
+                self.latency.end(trace)
+
+    def confirm(self, ov):
+        ''' Compare the Ov field of a report with the written overrides '''
+        if self.due() is not None:
+            return  # not written yet
+        for kind, index in OVERRIDES.items():
+            reported = _clamp(ov[index])
+            if reported == self.values[kind]:
+                self._differs.pop(kind, None)
+                changed = self._changed.pop(kind, None)
+                if changed is not None:
+                    self.m_confirm.observe(time.perf_counter()-changed)
+                continue
+            if self._differs.get(kind) != reported:
+                self._differs[kind] = reported  # maybe made before
+                continue
+            self.m_mismatch.inc()
+            _log.warning(f'grbl reports a {kind} override of {reported}%, '
+                         f'{self.values[kind]}% was written, correcting')
+            self.values[kind] = reported
+            del self._differs[kind]
+        self.flush()
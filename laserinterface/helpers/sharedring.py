@@ -0,0 +1,93 @@
+# dependencies
+from multiprocessing import shared_memory
+import struct
+
+# capacity, write position, read position
+HEADER = struct.Struct('III')
+LENGTH = struct.Struct('I')
+POSITION_MASK = 0xFFFFFFFF
+
+
+class SharedRing():
+    def __init__(self, name=None, capacity=1 << 20):
+        # SharedRing is a ring buffer of messages (bytes) in shared memory,
+        # for a single writer and a single reader, which can be in different
+        # processes. The write position is only changed by the writer, the
+        # read position only by the reader, so no lock is needed. Positions
+        # only increase (modulo 2**32), the offset in the buffer is
+        # position % capacity, so the capacity is a power of two.
+        # Without a name a new ring is created, otherwise it is attached.
+
+        self.owner = name is None
+        if self.owner:
+            if capacity & (capacity-1) or capacity > 1 << 30:
+                raise ValueError('the capacity has to be a power of two')
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=HEADER.size + capacity)
+            HEADER.pack_into(self.shm.buf, 0, capacity, 0, 0)
+        else:
+            # processes started by multiprocessing share the resource
+            # tracker, it unlinks the memory if the owner does not
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        # the positions are set through a typed view, a single aligned store
+        # the other process never sees half written (pack_into first clears
+        # the bytes it writes)
+        self.header = self.buf[:HEADER.size].cast('I')
+        self.capacity = self.header[0]
+
+    def _copy_in(self, position, data):
+        offset = position % self.capacity
+        first = min(len(data), self.capacity - offset)
+        self.buf[HEADER.size+offset:HEADER.size+offset+first] = data[:first]
+        if first < len(data):
+            self.buf[HEADER.size:HEADER.size+len(data)-first] = data[first:]
+
+    def _copy_out(self, position, size):
+        offset = position % self.capacity
+        first = min(size, self.capacity - offset)
+        data = bytes(self.buf[HEADER.size+offset:HEADER.size+offset+first])
+        if first < size:
+            data += bytes(self.buf[HEADER.size:HEADER.size+size-first])
+        return data
+
+    def put(self, message):
+        ''' Add a message, returns False if the ring is full '''
+        write, read = self.header[1], self.header[2]
+        size = LENGTH.size + len(message)
+        if size > self.capacity - ((write - read) & POSITION_MASK):
+            return False
+        self._copy_in(write, LENGTH.pack(len(message)))
+        self._copy_in(write + LENGTH.size, message)
+        # the position is published after the data is written
+        self.header[1] = (write + size) & POSITION_MASK
+        return True
+
+    def get(self):
+        ''' Returns the oldest message, or None if the ring is empty '''
+        write, read = self.header[1], self.header[2]
+        if read == write:
+            return None
+        length = LENGTH.unpack(self._copy_out(read, LENGTH.size))[0]
+        message = self._copy_out(read + LENGTH.size, length)
+        self.header[2] = (read + LENGTH.size + length) & POSITION_MASK
+        return message
+
+    def __len__(self):
+        ''' Bytes in use '''
+        return (self.header[1] - self.header[2]) & POSITION_MASK
+
+    def __del__(self):
+        # the memory can not be unmapped while the view exists
+        self.header.release()
+
+    def close(self):
+        self.header.release()
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,238 @@
+# dependencies
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+import glob
+import logging
+import os
+import time
+
+_log = logging.getLogger().getChild(__name__)
+
+DEVICE_DIR = '/sys/bus/w1/devices'
+POWER_ON_VALUE = 85.0   # a ds18b20 reports 85 degrees before its first reading
+
+
+def parse_w1_slave(lines):
+    ''' Returns the temperature of the lines of a w1_slave file, or None if
+    the crc check failed or the reading is not valid. '''
+    if len(lines) < 2 or lines[0].strip()[-3:] != 'YES':
+        return None
+    equals_pos = lines[1].find('t=')
+    if equals_pos == -1:
+        return None
+    try:
+        temp_c = float(lines[1][equals_pos+2:]) / 1000.0
+    except ValueError:
+        return None
+    if temp_c == POWER_ON_VALUE:
+        return None
+    return temp_c
+
+
+class TemperatureSensor():
+    def __init__(self, device_folder, smoothing=0.5, rate_window=20):
+        # A single ds18b20 on the 1-wire bus. Keeps the last good reading
+        # with its timestamp, a smoothed value and the recent history to
+        # calculate how fast the temperature rises.
+
+        self.name = os.path.basename(device_folder)
+        self.url = os.path.join(device_folder, 'w1_slave')
+        self.smoothing = smoothing      # weight of a new reading (0-1]
+        self.rate_window = rate_window  # seconds of history used for the rate
+
+        self.raw = None         # last good reading
+        self.value = None       # smoothed temperature
+        self.timestamp = 0      # time.monotonic() of the last good reading
+        self.failures = 0       # failed reads in a row
+        self.history = deque()  # (timestamp, smoothed value)
+
+    def read(self, retries=3, retry_delay=0.1):
+        ''' Read the sensor, blocks about 750 ms per attempt. Failed reads are
+        retried with a delay that doubles every attempt. Returns None when
+        all attempts failed. '''
+        delay = retry_delay
+        for attempt in range(retries+1):
+            try:
+                with open(self.url, 'r') as f:
+                    temp_c = parse_w1_slave(f.readlines())
+                if temp_c is not None:
+                    return temp_c
+            except OSError as e:
+                _log.debug(f'reading {self.name} failed: {e}')
+            if attempt < retries:
+                time.sleep(delay)
+                delay *= 2
+        return None
+
+    def update(self, temp_c, timestamp):
+        ''' Store a good reading '''
+        self.raw = temp_c
+        self.failures = 0
+        if self.value is None:
+            self.value = temp_c
+        else:
+            self.value += self.smoothing*(temp_c-self.value)
+        self.timestamp = timestamp
+
+        self.history.append((timestamp, self.value))
+        while self.history[0][0] < timestamp-self.rate_window:
+            self.history.popleft()
+
+    @property
+    def rate(self):
+        ''' Slope of the smoothed temperature in degrees per second, using a
+        least squares fit over the history. '''
+        if len(self.history) < 2:
+            return 0.0
+        t0 = self.history[0][0]
+        n = len(self.history)
+        mean_t = sum(t-t0 for t, _ in self.history)/n
+        mean_v = sum(v for _, v in self.history)/n
+        var_t = sum((t-t0-mean_t)**2 for t, _ in self.history)
+        if not var_t:
+            return 0.0
+        cov = sum((t-t0-mean_t)*(v-mean_v) for t, v in self.history)
+        return cov/var_t
+
+    def predict(self, seconds):
+        ''' Expected temperature after some seconds if it keeps rising. A
+        falling temperature is not extrapolated. '''
+        if self.value is None:
+            return None
+        return self.value + max(self.rate, 0.0)*seconds
+
+
+class TemperatureService(Thread):
+    def __init__(self, on_update, device_dir=DEVICE_DIR, read_interval=1.0,
+                 read_retries=3, retry_delay=0.1, scan_delay_max=60,
+                 smoothing=0.5, rate_window=20, predict_seconds=30,
+                 stale_after=10, load_modules=True, auto_start=True):
+        # TemperatureService reads all ds18b20 sensors in device_dir in
+        # parallel, so a cycle takes a single conversion time regardless of
+        # the sensor count. on_update(service) is called after every cycle.
+        # device_dir can point to a fake sysfs tree for testing.
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.on_update = on_update
+        self.device_dir = device_dir
+        self.read_interval = read_interval
+        self.read_retries = read_retries
+        self.retry_delay = retry_delay
+        self.scan_delay_max = scan_delay_max
+        self.smoothing = smoothing
+        self.rate_window = rate_window
+        self.predict_seconds = predict_seconds
+        self.stale_after = stale_after
+        self.load_modules = load_modules
+
+        self.sensors = {}       # name: TemperatureSensor
+        self.has_read = False   # a sensor gave a good reading since the start
+        self._lock = Lock()
+        self._quit = Event()
+        self._pool = ThreadPoolExecutor(thread_name_prefix='w1')
+
+        if auto_start:
+            self.start()
+
+    def close(self):
+        self._quit.set()
+
+    def scan(self):
+        ''' Update the list of sensors, returns the number of sensors '''
+        folders = glob.glob(os.path.join(self.device_dir, '28*'))
+        names = {os.path.basename(folder): folder for folder in folders}
+        with self._lock:
+            for name in list(self.sensors):
+                if name not in names:
+                    _log.warning(f'Temperature sensor {name} disappeared')
+                    del self.sensors[name]
+            for name, folder in names.items():
+                if name not in self.sensors:
+                    _log.info(f'Found temperature sensor -> {folder}')
+                    self.sensors[name] = TemperatureSensor(
+                        folder, self.smoothing, self.rate_window)
+            return len(self.sensors)
+
+    def read_all(self):
+        ''' Read all sensors in parallel and update the cached values '''
+        with self._lock:
+            sensors = list(self.sensors.values())
+        futures = [(sensor, self._pool.submit(
+            sensor.read, self.read_retries, self.retry_delay))
+            for sensor in sensors]
+
+        missing = False
+        for sensor, future in futures:
+            temp_c = future.result()
+            if temp_c is None:
+                sensor.failures += 1
+                missing = True
+                _log.warning(f'No valid reading of {sensor.name} '
+                             f'({sensor.failures} times in a row)')
+            else:
+                sensor.update(temp_c, time.monotonic())
+                self.has_read = True
+        if missing:
+            # a sensor might be disconnected
+            self.scan()
+
+    def fresh_sensors(self):
+        now = time.monotonic()
+        with self._lock:
+            return [sensor for sensor in self.sensors.values()
+                    if sensor.value is not None
+                    and now-sensor.timestamp <= self.stale_after]
+
+    @property
+    def temperature(self):
+        ''' Highest smoothed temperature, None if there is no recent reading '''
+        values = [sensor.value for sensor in self.fresh_sensors()]
+        return max(values) if values else None
+
+    @property
+    def predicted(self):
+        ''' Highest temperature expected after predict_seconds '''
+        values = [sensor.predict(self.predict_seconds)
+                  for sensor in self.fresh_sensors()]
+        return max(values) if values else None
+
+    def cached(self):
+        ''' Returns {name: (last good reading, timestamp)} of all sensors '''
+        with self._lock:
+            return {name: (sensor.raw, sensor.timestamp)
+                    for name, sensor in self.sensors.items()}
+
+    def _load_modules(self):
+        _log.info('loading the 1-wire kernel modules')
+        os.system('modprobe w1-gpio')
+        os.system('modprobe w1-therm')
+
+    def run(self):
+        ''' Function runs when Thread.start() is called '''
+        scan_delay = self.read_interval
+        modules_loaded = not self.load_modules
+
+        while not self._quit.is_set():
+            if not self.sensors and not self.scan():
+                if not modules_loaded:
+                    self._load_modules()
+                    modules_loaded = True
+                    continue
+                # wait longer every time no sensor is found
+                _log.warning(f'No temperature sensor found in '
+                             f'{self.device_dir}, retry in {scan_delay}s')
+                self.on_update(self)
+                self._quit.wait(scan_delay)
+                scan_delay = min(scan_delay*2, self.scan_delay_max)
+                continue
+            scan_delay = self.read_interval
+
+            start_time = time.monotonic()
+            self.read_all()
+            self.on_update(self)
+            self._quit.wait(
+                max(self.read_interval-(time.monotonic()-start_time), 0))
+
+        self._pool.shutdown(wait=False)
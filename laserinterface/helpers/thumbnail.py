@@ -0,0 +1,193 @@
+# dependencies
+from itertools import chain
+import hashlib
+import json
+import logging
+import math
+import os
+import struct
+import time
+import zlib
+
+from laserinterface.helpers.gcodereader import MOVE_TYPE
+
+try:
+    import numpy
+except ImportError:     # the thumbnails are drawn point by point
+    numpy = None
+
+_log = logging.getLogger().getChild(__name__)
+
+THUMBNAIL_SIZE = 64     # pixels, thumbnails are square
+HASH_BLOCK = 1 << 20    # bytes read at once for the content hash
+PRUNE_AGE = 24*3600     # seconds an unused cache entry is kept at least
+
+
+def cutting_paths(paths):
+    ''' The paths where the laser cuts: laser on and not a rapid move '''
+    return [_path for _path in paths
+            if _path.laser_on and _path.move_type != MOVE_TYPE['RAPID']]
+
+
+def laser_length(paths):
+    ''' Length in mm moved with the laser on '''
+    length = 0.0
+    for _path in cutting_paths(paths):
+        xs, ys = _path.points_x, _path.points_y
+        for k in range(1, len(xs)):
+            length += math.hypot(xs[k]-xs[k-1], ys[k]-ys[k-1])
+    return length
+
+
+def render(paths, min_x, min_y, max_x, max_y, size=THUMBNAIL_SIZE):
+    ''' Draw the cutting paths in a square luminance image (one byte per
+    pixel, the first row at the bottom), white on black, scaled to fit.
+    Every segment is sampled once per pixel it crosses. '''
+    scale = (size-1) / max(max_x-min_x, max_y-min_y, 1e-9)
+    paths = cutting_paths(paths)
+    if numpy is not None:
+        return _render_arrays(paths, min_x, min_y, scale, size)
+    return _render_points(paths, min_x, min_y, scale, size)
+
+
+def _render_points(paths, min_x, min_y, scale, size):
+    image = bytearray(size*size)
+    for _path in paths:
+        xs, ys = _path.points_x, _path.points_y
+        x0, y0 = (xs[0]-min_x)*scale, (ys[0]-min_y)*scale
+        for k in range(1, len(xs)):
+            x1, y1 = (xs[k]-min_x)*scale, (ys[k]-min_y)*scale
+            steps = int(max(abs(x1-x0), abs(y1-y0))) + 1
+            for step in range(steps+1):
+                t = step/steps
+                col = int(x0 + (x1-x0)*t + 0.5)
+                row = int(y0 + (y1-y0)*t + 0.5)
+                if 0 <= col < size and 0 <= row < size:
+                    image[row*size + col] = 255
+            x0, y0 = x1, y1
+    return bytes(image)
+
+
+def _render_arrays(paths, min_x, min_y, scale, size):
+    ''' The same image as _render_points, all segments at once with numpy '''
+    image = numpy.zeros(size*size, numpy.uint8)
+    paths = [_path for _path in paths if len(_path.points_x) > 1]
+    if not paths:
+        return image.tobytes()
+    xs = (numpy.fromiter(chain.from_iterable(p.points_x for p in paths),
+                         float) - min_x)*scale
+    ys = (numpy.fromiter(chain.from_iterable(p.points_y for p in paths),
+                         float) - min_y)*scale
+
+    # segments between the points of a path, not from one path to the next
+    ends = numpy.cumsum([len(p.points_x) for p in paths]) - 1
+    starts = numpy.ones(len(xs)-1, bool)
+    starts[ends[:-1]] = False
+    x0, y0 = xs[:-1][starts], ys[:-1][starts]
+    dx, dy = xs[1:][starts] - x0, ys[1:][starts] - y0
+
+    # steps+1 samples per segment, at t = step/steps
+    steps = (numpy.maximum(numpy.abs(dx), numpy.abs(dy))).astype(
+        numpy.int64) + 1
+    segment = numpy.repeat(numpy.arange(len(steps)), steps+1)
+    first = numpy.cumsum(steps+1) - (steps+1)
+    t = (numpy.arange(len(segment)) - first[segment]) / steps[segment]
+    cols = (x0[segment] + dx[segment]*t + 0.5).astype(numpy.int64)
+    rows = (y0[segment] + dy[segment]*t + 0.5).astype(numpy.int64)
+
+    inside = (cols >= 0) & (cols < size) & (rows >= 0) & (rows < size)
+    image[rows[inside]*size + cols[inside]] = 255
+    return image.tobytes()
+
+
+def encode_png(pixels, size=THUMBNAIL_SIZE):
+    ''' A grayscale png of a luminance image with the first row at the
+    bottom '''
+    rows = b''.join(b'\0' + pixels[row*size:(row+1)*size]
+                    for row in reversed(range(size)))   # png starts on top
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data)))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 0, 0, 0,
+                                         0))
+            + chunk(b'IDAT', zlib.compress(rows, 9))
+            + chunk(b'IEND', b''))
+
+
+def content_hash(filename):
+    ''' Identifies the content of a file, the same for a copy or a renamed
+    file '''
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ThumbnailCache():
+    def __init__(self, directory):
+        # ThumbnailCache keeps the thumbnail (png) and the values describing
+        # a gcode file (json) by the hash of its content, so a file is only
+        # parsed once, even when it is copied, renamed or touched. It is a
+        # directory, shared by all processes: the files are replaced at
+        # once, a reader never sees a half written file.
+
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _file(self, digest, ext):
+        return os.path.join(self.directory, digest + ext)
+
+    def _write(self, filename, data):
+        tmp_file = f'{filename}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_file, filename)
+
+    def load(self, digest):
+        ''' The values stored for the content, or None '''
+        try:
+            with open(self._file(digest, '.json'), 'r') as file:
+                values = json.load(file)
+            # used again, not pruned
+            for ext in ('.json', '.png'):
+                if os.path.exists(self._file(digest, ext)):
+                    os.utime(self._file(digest, ext))
+            return values
+        except (OSError, ValueError):
+            return None
+
+    def thumbnail(self, digest):
+        ''' The png of the content, or None '''
+        try:
+            with open(self._file(digest, '.png'), 'rb') as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def store(self, digest, values, png=None):
+        # the png first, an entry with values always has its thumbnail
+        if png is not None:
+            self._write(self._file(digest, '.png'), png)
+        self._write(self._file(digest, '.json'), json.dumps(values).encode())
+
+    def prune(self, keep):
+        ''' Remove the entries of other contents than keep (hashes), that
+        were not used for a day '''
+        now = time.time()
+        removed = 0
+        for name in os.listdir(self.directory):
+            digest = name.split('.')[0]
+            path = os.path.join(self.directory, name)
+            try:
+                if digest not in keep and \
+                        now - os.stat(path).st_mtime > PRUNE_AGE:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                continue
+        if removed:
+            _log.info(f'removed {removed} unused thumbnail cache files')
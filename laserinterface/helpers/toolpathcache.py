@@ -0,0 +1,73 @@
+# dependencies
+from collections import OrderedDict
+from threading import Lock
+import logging
+import os
+
+from laserinterface.datamanager.config import config_manager
+
+_log = logging.getLogger().getChild(__name__)
+
+
+def file_key(filename):
+    ''' Identifies the version of a file: (modification time, size) '''
+    stat = os.stat(filename)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class ToolpathCache():
+    def __init__(self, size=None):
+        # ToolpathCache keeps the parsed toolpaths of the recently used gcode
+        # files, so a file that was parsed ahead (by the JobQueue) or before
+        # is previewed and started without parsing it again. A toolpath is
+        # only returned while its file is unchanged. Toolpaths are large,
+        # only the last size toolpaths are kept.
+
+        self.size = size
+        self.toolpaths = OrderedDict()  # absolute filename: Toolpath
+        self._lock = Lock()
+
+    def _max_size(self):
+        if self.size is not None:
+            return self.size
+        return config_manager['GENERAL'].get('TOOLPATH_CACHE_SIZE', 4)
+
+    def get(self, filename):
+        ''' Returns the toolpath of the file, or None if it is not parsed or
+        changed since '''
+        filename = os.path.abspath(filename)
+        with self._lock:
+            toolpath = self.toolpaths.get(filename)
+        if toolpath is None:
+            return None
+        try:
+            key = file_key(filename)
+        except OSError:
+            key = None
+        if toolpath.key != key:
+            self.discard(filename)
+            return None
+        with self._lock:
+            if filename in self.toolpaths:
+                self.toolpaths.move_to_end(filename)
+        return toolpath
+
+    def put(self, toolpath):
+        filename = os.path.abspath(toolpath.filename)
+        with self._lock:
+            self.toolpaths[filename] = toolpath
+            self.toolpaths.move_to_end(filename)
+            while len(self.toolpaths) > max(self._max_size(), 1):
+                dropped, _ = self.toolpaths.popitem(last=False)
+                _log.debug(f'dropped the toolpath of {dropped}')
+
+    def discard(self, filename):
+        with self._lock:
+            self.toolpaths.pop(os.path.abspath(filename), None)
+
+    def __contains__(self, filename):
+        return self.get(filename) is not None
+
+
+# the parsed toolpaths of the application, shared by all modules
+toolpath_cache = ToolpathCache()
@@ -0,0 +1,198 @@
+# dependencies
+from threading import Event, Thread
+import hashlib
+import logging
+import os
+import re
+import select
+import time
+
+from laserinterface.datamanager.config import config_manager
+from laserinterface.helpers.dirwatcher import snapshot
+from laserinterface.helpers.gcodelibrary import is_gcode
+from laserinterface.helpers.thumbnail import content_hash
+
+_log = logging.getLogger().getChild(__name__)
+
+config = config_manager['GENERAL']
+
+MOUNTS_FILE = '/proc/self/mounts'
+SYS_BLOCK = '/sys/class/block'
+COPY_BLOCK = 1 << 18    # bytes read and written at once
+
+
+def _unescape(field):
+    ''' The mount table writes spaces and tabs as octal escapes (\\040) '''
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+def usb_mounts(mounts_file=MOUNTS_FILE, sys_block=SYS_BLOCK):
+    ''' The mounted usb block devices: {mount point: device name}. A device
+    is on usb when its sysfs path passes a usb host controller (usb1). '''
+    sys_root = os.path.realpath(os.path.join(sys_block, '..', '..'))
+    mounts = {}
+    with open(mounts_file, 'r') as file:
+        for line in file:
+            fields = line.split()
+            if len(fields) < 2 or not fields[0].startswith('/dev/'):
+                continue
+            device = os.path.basename(os.path.realpath(fields[0]))
+            sys_path = os.path.relpath(os.path.realpath(
+                os.path.join(sys_block, device)), sys_root)
+            if any(re.fullmatch(r'usb\d+', part)
+                   for part in sys_path.split(os.sep)):
+                mounts[_unescape(fields[1])] = device
+    return mounts
+
+
+def _hash_from_disk(filename):
+    ''' The content hash of a written file, read from the disk, not from
+    the page cache '''
+    with open(filename, 'rb') as file:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return content_hash(filename)
+
+
+def _copy(source, target, rate, stop):
+    ''' Copy at most rate bytes per second, returns the content hash of
+    source, or None when stop was set '''
+    digest = hashlib.blake2b(digest_size=16)   # same as content_hash
+    start = time.monotonic()
+    copied = 0
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        for block in iter(lambda: src.read(COPY_BLOCK), b''):
+            digest.update(block)
+            dst.write(block)
+            copied += len(block)
+            ahead = copied/rate - (time.monotonic() - start)
+            if stop.wait(ahead) if ahead > 0 else stop.is_set():
+                return None
+        dst.flush()
+        os.fsync(dst.fileno())
+    return digest.hexdigest()
+
+
+def copy_file(source, target, rate, stop):
+    ''' Copy source to target, verified by its content hash. The target is
+    replaced at once, it is never seen half written. Returns False when
+    target already is a copy (same size and modification time), or stop
+    was set. '''
+    stat = os.stat(source)
+    try:
+        copied = os.stat(target)
+        if (copied.st_size, copied.st_mtime_ns) == \
+                (stat.st_size, stat.st_mtime_ns):
+            return False
+    except OSError:
+        pass
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    part = os.path.join(os.path.dirname(target),
+                        f'.{os.path.basename(target)}.part')
+    try:
+        for attempt in range(2):
+            digest = _copy(source, part, rate, stop)
+            if digest is None:
+                return False
+            if _hash_from_disk(part) == digest:
+                break
+            _log.warning(f'the copy of {source} is corrupt, copying again')
+        else:
+            raise OSError(f'could not copy {source} without errors')
+        os.utime(part, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(part, target)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+    return True
+
+
+class UsbImporter():
+    def __init__(self, directory=None, rate=None, mounts_file=MOUNTS_FILE,
+                 sys_block=SYS_BLOCK, interval=5.0):
+        # UsbImporter copies the gcode files of a usb stick to a directory
+        # with the name of the stick in GCODE_DIR, when it is mounted (by
+        # the system, usbmount or udisks). The kernel reports changes of the
+        # mount table (poll on /proc/self/mounts), a mount table that does
+        # not (a test file) is read every interval seconds. The files are
+        # copied by a thread at USB_COPY_RATE bytes per second, so the disk
+        # and the usb bus stay free for a running job, and verified with
+        # their content hash. Files already copied are skipped, a stick
+        # mounted in GCODE_DIR is not copied. Callbacks are called with the
+        # copied files, when a stick is done.
+
+        self.directory = os.path.abspath(directory or config['GCODE_DIR'])
+        self.rate = rate or config.get('USB_COPY_RATE', 4000000)
+        self.mounts_file = mounts_file
+        self.sys_block = sys_block
+        self.interval = interval
+        self.callbacks = []
+        self.status = ''
+
+        self._mounts = {}   # mount point: device, of the imported sticks
+        self._quit = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        ''' Stop watching, a copy in progress is stopped and removed '''
+        self._quit.set()
+
+    def _watch(self):
+        try:
+            mounts_file = open(self.mounts_file, 'r')
+        except OSError as e:
+            _log.error(f'can not watch the usb sticks: {e}')
+            return
+        poller = select.poll()
+        poller.register(mounts_file, select.POLLPRI | select.POLLERR)
+        with mounts_file:
+            while not self._quit.is_set():
+                try:
+                    mounts = usb_mounts(self.mounts_file, self.sys_block)
+                except OSError as e:
+                    _log.error(f'can not read the mounts: {e}')
+                    mounts = self._mounts
+                for mount in sorted(mounts.keys() - self._mounts.keys()):
+                    _log.info(f'usb stick {mounts[mount]} mounted at {mount}')
+                    if os.path.commonpath([mount, self.directory]) == \
+                            self.directory:
+                        continue    # in GCODE_DIR, indexed by the library
+                    self._import(mount)
+                self._mounts = mounts
+                poller.poll(self.interval*1000)
+
+    def _import(self, mount):
+        name = os.path.basename(mount.rstrip(os.sep)) or 'usb'
+        target = os.path.join(self.directory, name)
+        files = sorted(path for path in snapshot(mount) if is_gcode(path))
+        copied = []
+        start = time.monotonic()
+        for k, path in enumerate(files):
+            if self._quit.is_set():
+                return
+            self.status = f'copying {k+1}/{len(files)} from {name}'
+            copy = os.path.join(target, os.path.relpath(path, mount))
+            try:
+                if copy_file(path, copy, self.rate, self._quit):
+                    copied.append(copy)
+            except OSError as e:
+                _log.error(f'importing {path} failed: {e}')
+                if not os.path.isdir(mount):
+                    break   # the stick was removed
+        self.status = f'imported {len(copied)} files from {name}'
+        _log.info(f'{self.status} in {time.monotonic()-start:.1f}s, '
+                  f'{len(files)-len(copied)} already imported or failed')
+        if not copied:
+            return
+        for callback in list(self.callbacks):
+            try:
+                callback(copied)
+            except Exception:
+                _log.exception('usb import callback failed')
@@ -1,9 +1,11 @@
+# startup profiling, imported first to include the other imports
+from laserinterface.datamanager.startup import profiler
 
 # external dependencies
+from threading import Thread
 import os
 import sys
 import logging
-import ruamel.yaml
 
 # kivy imports
 from kivy.app import App
@@ -13,22 +15,27 @@ from kivy.core.window import Window
 from kivy.properties import ObjectProperty
 
 # Helping submodules
-from laserinterface.datamanager.machine import MachineStateManager
-from laserinterface.datamanager.terminal import TerminalManager
+from laserinterface.datamanager.config import config_manager
+from laserinterface.datamanager.metrics import MetricsExporter
+from laserinterface.datamanager.tracing import tracer
 from laserinterface.helpers.gpiointerface import GpioInterface
-from laserinterface.helpers.grblinterface import GrblInterface
 from laserinterface.helpers.gcodereader import GcodeReader
+from laserinterface.helpers import jobqueue
+from laserinterface.helpers.gcodelibrary import GcodeLibrary
+from laserinterface.helpers.usbimport import UsbImporter
+from laserinterface.helpers.machinepool import MachinePool
 from laserinterface.helpers.callbackhandler import CallbackHandler
 
 # import all modules for the ui
-from laserinterface.ui.mainlayout import MainLayout
+from laserinterface.ui.mainlayout import MainLayout, preload_screens
 
 _log = logging.getLogger().getChild(__name__)
+profiler.mark('imports')
 
-yaml = ruamel.yaml.YAML()
-config_file = 'laserinterface/data/config.yaml'
-with open(config_file, 'r') as ymlfile:
-    do_fullscreen = yaml.load(ymlfile)['GENERAL']['FULLSCREEN']
+if config_manager['GENERAL'].get('TRACE'):
+    tracer.enable(config_manager['GENERAL'].get('TRACE_BUFFER_SIZE'))
+
+do_fullscreen = config_manager['GENERAL']['FULLSCREEN']
 
 if do_fullscreen:
     Window.fullscreen = True
@@ -45,50 +52,120 @@ class MainLayoutApp(App):
     machine = ObjectProperty()
 
     # shared helpers
+    machines = ObjectProperty()
     grbl = ObjectProperty()
     gpio = ObjectProperty()
     gcode = ObjectProperty()
+    jobs = ObjectProperty()
+    library = ObjectProperty()
+    usb = ObjectProperty()
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self._shut_down = False
 
-        # initialize datamanagers
-        self.terminal = TerminalManager()
-        self.machine = MachineStateManager()
+        # initialize the machines, the main screens use the first one
+        with profiler.phase('init grbl'):
+            self.machines = MachinePool()
+            self.terminal = self.machines.primary.terminal
+            self.machine = self.machines.primary.machine
+            self.grbl = self.machines.primary.grbl
 
         # initialize backend helpers
-        self.grbl = GrblInterface(machine=self.machine, terminal=self.terminal)
-        self.gpio = GpioInterface(machine=self.machine)
+        with profiler.phase('init gpio'):
+            self.gpio = GpioInterface(machine=self.machine, auto_start=False)
         self.gcode = GcodeReader()
-
-        self.callback = CallbackHandler(grbl=self.grbl, gpio=self.gpio)
-        self.gpio.callback = self.callback
+        # upcoming jobs, parsed ahead while the current job runs
+        self.jobs = jobqueue.JobQueue(self.machine)
+        # index of the gcode files, scanned once the interface is shown
+        self.library = GcodeLibrary()
+        # gcode files of usb sticks are copied to GCODE_DIR, then indexed
+        # and the newest parsed ahead
+        self.usb = UsbImporter()
+        self.usb.callbacks.append(self.library.rescan)
+        self.usb.callbacks.append(self.parse_imported)
+
+        with profiler.phase('init callbacks'):
+            self.callback = CallbackHandler(
+                grbl=self.grbl, gpio=self.gpio, machines=self.machines)
+            self.gpio.callback = self.callback
+            # started once the callbacks can handle the inputs
+            self.gpio.start()
+
+        # apply changes of the config file while running
+        config_manager.watch()
+
+        metrics_port = config_manager['GENERAL'].get('METRICS_PORT')
+        if metrics_port:
+            try:
+                self.metrics_exporter = MetricsExporter(
+                    self.machines, metrics_port)
+            except OSError as e:
+                _log.error(f'Could not serve the metrics: {e}')
 
         Clock.schedule_once(
             lambda dt: self.gpio.pin_write('OUT_LIGHT', True), 2)
         Clock.schedule_once(
             lambda dt: self.gpio.pin_write('OUT_COOLING', True), 2)
 
+    def load_kv(self, filename=None):
+        with profiler.phase('load kv'):
+            return super().load_kv(filename)
+
     def build(self):
-        return MainLayout()
+        with profiler.phase('build main layout'):
+            return MainLayout()
 
-    def restart_program(self):
+    def on_start(self):
+        Window.bind(on_flip=self.on_first_frame)
+
+    def on_stop(self):
+        self.shutdown()
+
+    def shutdown(self):
+        ''' Close the connections and stop the threads and processes of the
+        backend, only the first call does something '''
+        if self._shut_down:
+            return
+        self._shut_down = True
         _log.warning('closing grbl connections and stopping threads')
-        self.grbl.disconnect()
-        _log.warning('Stopping gpio threads')
+        self.machines.disconnect()
+        _log.warning('Stopping gpio threads and the gcode parsers')
         self.gpio.close()
+        self.library.close()
+        self.usb.close()
+        jobqueue.shutdown()
+        self.callback.executor.close()
+        _log.info(f'callback actions:\n{self.callback.executor.summary()}')
+        if tracer.enabled:
+            tracer.dump(config_manager['GENERAL']['TRACE_FILE'])
+
+    def on_first_frame(self, window):
+        ''' The interface is usable once the first frame is shown '''
+        window.unbind(on_flip=self.on_first_frame)
+        profiler.interactive()
+        Thread(target=preload_screens, daemon=True).start()
+        self.library.start()
+        if config_manager['GENERAL'].get('USB_IMPORT', True):
+            self.usb.start()
+
+    def parse_imported(self, paths):
+        ''' Parse the newest files of a usb stick ahead, as many as the
+        toolpath cache keeps '''
+        paths = sorted(paths, key=os.path.getmtime, reverse=True)
+        for path in paths[:config_manager['GENERAL'].get(
+                'TOOLPATH_CACHE_SIZE', 4)]:
+            jobqueue.parse_ahead(path)
 
+    def restart_program(self):
+        self.shutdown()
         _log.warning('Stopping kivy application')
         self.stop()
 
         os.execl(sys.executable, f'"{sys.executable}"', *sys.argv)
 
     def reboot_controller(self):
-        _log.warning('closing grbl connections and stopping threads')
-        self.grbl.disconnect()
-        _log.warning('Stopping gpio threads')
-        self.gpio.close()
-
+        self.shutdown()
         _log.warning('Stopping kivy application')
         self.stop()
 
@@ -96,11 +173,7 @@ class MainLayoutApp(App):
         # os.system('sudo reboot')
 
     def poweroff_controller(self):
-        _log.warning('closing grbl connections and stopping threads')
-        self.grbl.disconnect()
-        _log.warning('Stopping gpio threads')
-        self.gpio.close()
-
+        self.shutdown()
         _log.warning('Stopping kivy application')
         self.stop()
 
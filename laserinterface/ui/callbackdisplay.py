@@ -1,25 +1,40 @@
 # dependencies
 import logging
-import ruamel.yaml
 
 # kivy imports
+from kivy.app import App
 from kivy.clock import Clock
+from kivy.properties import StringProperty
 
 # submodules
+from laserinterface.datamanager.config import config_manager as config
 from laserinterface.ui.themedwidgets import ShadedBoxLayout
 
 _log = logging.getLogger(__name__)
 
-yaml = ruamel.yaml.YAML()
-config_file = 'laserinterface/data/config.yaml'
-with open(config_file, 'r') as ymlfile:
-    config = yaml.load(ymlfile)
-
 
 class CallbackDisplay(ShadedBoxLayout):
+    latency = StringProperty('')
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.machine = App.get_running_app().machine
+        self.latency_count = 0
+
         Clock.schedule_once(lambda dt: self.setup(), 0)
+        config.subscribe(
+            lambda changed: Clock.schedule_once(lambda dt: self.setup(), 0),
+            ('CALLBACKS',))
+        Clock.schedule_interval(self.update_latency, 1)
+
+    def update_latency(self, dt):
+        ''' show the safety reaction latency, and write it to the dump file
+        when new events are measured '''
+        tracker = self.machine.latency
+        self.latency = tracker.summary()
+        if tracker.count != self.latency_count:
+            self.latency_count = tracker.count
+            tracker.dump(config['GENERAL']['LATENCY_FILE'])
 
     def setup(self):
         data = []
@@ -1,44 +1,118 @@
 
 # dependencies
-from glob import glob
-from subprocess import check_output
+from io import BytesIO
 from threading import Thread
 import logging
 import os
-import ruamel.yaml
 
 # Kivy imports
 from kivy.app import App
-from kivy.clock import Clock
+from kivy.clock import Clock, mainthread
+from kivy.core.image import Image as CoreImage
 from kivy.graphics import Color, Line
-from kivy.properties import StringProperty, NumericProperty
+from kivy.metrics import dp
+from kivy.properties import BooleanProperty, NumericProperty
+from kivy.properties import ObjectProperty, StringProperty
+from kivy.uix.behaviors import ButtonBehavior
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.relativelayout import RelativeLayout
 
 # submodules
+from laserinterface.datamanager.config import config_manager
+from laserinterface.datamanager.tracing import tracer
 from laserinterface.helpers.gcodereader import MOVE_TYPE
+from laserinterface.helpers.gcodetext import GcodeText
+from laserinterface.helpers.jobqueue import parse_ahead
+from laserinterface.helpers.pathoptimizer import PathOptimizer, RAPID_RATE
 
 
 _log = logging.getLogger().getChild(__name__)
 
-yaml = ruamel.yaml.YAML()
-config_file = 'laserinterface/data/config.yaml'
-with open(config_file, 'r') as ymlfile:
-    base_dir = yaml.load(ymlfile)['GENERAL']['GCODE_DIR']
+base_dir = config_manager['GENERAL']['GCODE_DIR']
+
+VIEWER_LINES = 200          # lines in the recycleview of the GcodeViewer
+VIEWER_LINE_HEIGHT = dp(22)
 
 
 class FileSelector(BoxLayout):
     selected_file = StringProperty('')
     base_dir = StringProperty(base_dir)
+    optimize_state = StringProperty('')
+
+    valid_gcode_selected = BooleanProperty(False)
 
-    valid_gcode_selected = False
+    # browsing the library
+    search = StringProperty('')
+    sort = StringProperty('name')
+    descending = BooleanProperty(False)
 
     def __init__(self, **kw):
         super().__init__(**kw)
         app = App.get_running_app()
         self.reader = app.gcode
-
-        # Clock.schedule_interval(self.find_usb, 1)
+        self.machine = app.machine
+        self.jobs = app.jobs
+        self.library = app.library
+        self.thumbnails = {}    # content hash: Texture
+
+        # the list follows the changes of the library, at most 3 times a
+        # second while files are scanned
+        self.refresh_library = Clock.create_trigger(self._refresh_library, 0.3)
+        self.library.callbacks.append(lambda paths: self.refresh_library())
+        self.bind(search=self.refresh_library, sort=self.refresh_library,
+                  descending=self.refresh_library)
+        self.refresh_library()
+        # report the files copied from a usb stick
+        app.usb.callbacks.append(self._imported)
+
+    @mainthread
+    def _imported(self, paths):
+        self.optimize_state = App.get_running_app().usb.status
+
+    def set_sort(self, sort):
+        ''' Sort by sort, again to reverse the order '''
+        if sort == self.sort:
+            self.descending = not self.descending
+        else:
+            self.sort = sort
+            # the newest, longest and largest first
+            self.descending = sort != 'name'
+
+    @tracer.traced('ui.fileselector.refresh_library')
+    def _refresh_library(self, *args):
+        data = []
+        for entry in self.library.query(self.search, self.sort,
+                                        self.descending):
+            if entry['error']:
+                info = entry['error']
+            elif not entry['described']:
+                info = 'scanning...'
+            else:
+                info = (f"{entry['duration']:.0f}min, "
+                        f"{entry['max_x']-entry['min_x']:.0f}x"
+                        f"{entry['max_y']-entry['min_y']:.0f}mm, "
+                        f"{entry['lines']} lines, "
+                        f"laser {entry['laser_length']/1000:.1f}m")
+            data.append({
+                'path': entry['path'],
+                'name': entry['name'],
+                'info': info,
+                'thumbnail': self.thumbnail(entry),
+                'selected': entry['name'] == self.selected_file,
+            })
+        self.ids.library.data = data
+
+    def thumbnail(self, entry):
+        ''' The texture of the thumbnail of a library entry, or None '''
+        if not entry['described'] or entry['error']:
+            return None
+        key = entry['hash']
+        if key not in self.thumbnails:
+            png = self.library.thumbnail(entry['path'])
+            if not png:
+                return None
+            self.thumbnails[key] = CoreImage(BytesIO(png), ext='png').texture
+        return self.thumbnails[key]
 
     def on_file_selected(self, selection):
         if not selection:
@@ -49,56 +123,238 @@ class FileSelector(BoxLayout):
         app.root.ids.home.ids.job_control.selected_file = self.selected_file
 
         file_path = os.path.join(base_dir, self.selected_file)
+        self.ids.plotted_preview.selected_file = file_path
+        entry = self.library.entry(file_path)
+        if entry and entry['described'] and not entry['error']:
+            self.ids.plotted_preview.job_duration = entry['duration']
+        self.refresh_library()
+        Thread(target=self._read_text, args=(file_path,), daemon=True).start()
+
+    def _read_text(self, file_path):
+        ''' Open the text of a file and count its lines, the disk (or usb
+        stick) can be slow '''
         try:
-            with open(file_path, 'r') as gcode_file:
-                # read a 1000 bytes for a preview
-                gcode_text = [l.strip() for l in gcode_file.readlines(1000)]
-                gcode_text.append('...')
-            self.valid_gcode_selected = True
+            text = GcodeText(file_path)
+            text.lines(0, VIEWER_LINES, errors='strict')
+            len(text)
+            valid = True
         except UnicodeDecodeError:
-            gcode_text = ["Could not read the file. No valid gcode.",
-                          'Please select a ".nc", ".gcode", or ".txt" file']
-            self.valid_gcode_selected = False
-        except FileNotFoundError:
-            # selected a folder?
+            valid = False
+        except (OSError, ValueError):
+            # selected a folder, or removed
+            return
+        self._show_text(file_path, text, valid)
+
+    @mainthread
+    def _show_text(self, file_path, text, valid):
+        if file_path != self.ids.plotted_preview.selected_file:
+            return  # an other file was selected meanwhile
+        self.valid_gcode_selected = valid
+        self.ids.gcode_preview.show(text if valid else None)
+        if valid:
+            # parsed in the background, the preview is ready sooner
+            parse_ahead(file_path)
+
+    def queue_selected(self):
+        ''' Add the selected file to the job queue, it is parsed while the
+        current job runs '''
+        job = self.jobs.add(os.path.join(base_dir, self.selected_file))
+        self.optimize_state = f'Queued as job {len(self.jobs)}'
+        return job
+
+    def optimize_selected(self):
+        ''' Write a copy of the selected file with the cuts reordered to
+        reduce the travel moves, then select the new file. '''
+        self.optimize_state = 'Optimizing...'
+        Thread(target=self._optimize, daemon=True,
+               args=(os.path.join(base_dir, self.selected_file),)).start()
+
+    def _optimize(self, filename):
+        ''' Runs in a thread, the file is parsed by the JobQueue workers so
+        the current job of the GcodeReader is not touched '''
+        try:
+            toolpath = parse_ahead(filename).result()
+            if toolpath.error:
+                self._optimized(f'Can not optimize: {toolpath.error}')
+                return
+
+            # rapids move at the max rate of the slowest axis
+            config = self.machine.grbl_config
+            rapid_rate = min(config.get('$110', RAPID_RATE),
+                             config.get('$111', RAPID_RATE))
+            optimizer = PathOptimizer(filename, toolpath.paths, rapid_rate)
+            optimizer.optimize()
+            if optimizer.time_saved <= 0:
+                self._optimized('Travel is already optimal')
+                return
+
+            name, ext = os.path.splitext(filename)
+            out_filename = optimizer.write(f'{name}_optimized{ext}')
+        except ValueError as e:
+            # a line between the cuts that can not be reordered
+            self._optimized(f'Can not optimize: {e}')
+            return
+        except Exception as e:
+            _log.exception(f'optimizing {filename} failed')
+            self._optimized(f'Optimizing failed: {e}')
             return
+        self._optimized(
+            f'Saves {optimizer.time_saved:.1f}min of travel '
+            f'({optimizer.travel_before:.0f}mm -> '
+            f'{optimizer.travel_after:.0f}mm)', out_filename)
 
-        # show part of the text in a recycleview
-        data = []
-        for nr in range(len(gcode_text)):
-            data.append({
-                'line_nr': nr,
-                'gcode': gcode_text[nr],
-            })
-        self.ids.gcode_preview.data = data
-        self.ids.plotted_preview.selected_file = file_path
+    @mainthread
+    def _optimized(self, state, out_filename=None):
+        self.optimize_state = state
+        if out_filename is not None:
+            self.on_file_selected([out_filename])
 
     def clear_mem(self):
         self.reader.reset()
         self.ids.plotted_preview.canvas.remove_group('gcode')
+        self.ids.plotted_preview.canvas.remove_group('progress')
         self.ids.plotted_preview.plotted_file = ''
 
-    def find_usb(self):
-        if os.name == 'nt':
+
+class GcodeViewer(BoxLayout):
+    ''' Shows the text of a gcode file of any size. The recycleview holds a
+    window of VIEWER_LINES lines, which moves when it is scrolled to its
+    end. The slider scrolls through the whole file. A selected line is
+    highlighted in the plotted toolpath. '''
+    filename = StringProperty('')
+    line_count = NumericProperty(0)
+    first_line = NumericProperty(0)     # of the window
+    selected_line = NumericProperty(-1)
+    status = StringProperty('')
+
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        self.text = None
+        self._moving = False    # the window, not scrolled by the user
+
+    def show(self, text):
+        ''' Show a GcodeText, or the help text if it is None '''
+        self.text = text
+        self.selected_line = -1
+        self.status = ''
+        if text is None:
+            self.filename = ''
+            self.line_count = 0
+            self.ids.lines.data = [
+                {'line_nr': -1, 'gcode': line, 'selected': False}
+                for line in ('Could not read the file. No valid gcode.',
+                             'Please select a ".nc", ".gcode", or ".txt" '
+                             'file')]
+            return
+        self.filename = text.filename
+        self.line_count = len(text)
+        self._load(0)
+
+    def _load(self, first, top=None):
+        ''' Fill the window from line first on, scrolled to line top '''
+        first = max(min(first, self.line_count - VIEWER_LINES), 0)
+        lines = self.text.lines(first, VIEWER_LINES)
+        if not lines and self.text.changed():
+            self.status = 'the file was changed'
+        self.ids.lines.data = [
+            {'line_nr': first+k, 'gcode': line,
+             'selected': first+k == self.selected_line}
+            for k, line in enumerate(lines)]
+        self.first_line = first
+        top = first if top is None else top
+
+        self._moving = True
+        view = self.ids.lines
+        hidden = len(lines)*VIEWER_LINE_HEIGHT - view.height
+        view.scroll_y = min(max(
+            1 - (top-first)*VIEWER_LINE_HEIGHT/hidden, 0), 1) \
+            if hidden > 0 else 1
+        self.ids.scroll.value = self.line_count - top
+        self._moving = False
+
+    def top_line(self):
+        ''' The first line that is shown '''
+        view = self.ids.lines
+        hidden = max(len(view.data)*VIEWER_LINE_HEIGHT - view.height, 0)
+        return self.first_line + int((1-view.scroll_y)*hidden
+                                     / VIEWER_LINE_HEIGHT)
+
+    def scrolled(self, scroll_y):
+        ''' Move the window when it is scrolled to an end '''
+        if self._moving or self.text is None:
+            return
+        end = self.first_line + len(self.ids.lines.data)
+        if scroll_y <= 0 and end < self.line_count:
+            top = self.top_line()
+            self._load(self.first_line + VIEWER_LINES//2, top)
+        elif scroll_y >= 1 and self.first_line > 0:
+            top = self.top_line()
+            self._load(self.first_line - VIEWER_LINES//2, top)
+
+    def scroll_to(self, line):
+        ''' Show line at the top '''
+        if self._moving or self.text is None:
+            return
+        line = max(min(int(line), self.line_count-1), 0)
+        self._load(line - VIEWER_LINES//4, line)
+
+    def goto(self, line):
+        ''' Show and select a line, the number as text '''
+        try:
+            line = int(line)
+        except ValueError:
+            return
+        self.scroll_to(line)
+        self.select_line(line)
+
+    def select_line(self, line_nr):
+        if self.text is None or not 0 <= line_nr < self.line_count:
             return
+        self.selected_line = line_nr
+        for row in self.ids.lines.data:
+            row['selected'] = row['line_nr'] == line_nr
+        self.ids.lines.refresh_from_data()
+
+    def search(self, query, backwards=False):
+        ''' Select the next (or previous) line with query, searched in the
+        background '''
+        if self.text is None or not query:
+            return
+        line = self.selected_line if self.selected_line >= 0 \
+            else self.top_line() - 1
+        self.status = 'searching...'
+        Thread(target=self._search, daemon=True,
+               args=(self.text, query, line, backwards)).start()
+
+    def _search(self, text, query, line, backwards):
+        found = text.search(query, line, backwards)
+        self._found(text, query, found)
+
+    @mainthread
+    def _found(self, text, query, line):
+        if text is not self.text:
+            return  # an other file was selected meanwhile
+        if line is None:
+            self.status = f'{query} not found'
+            return
+        self.status = ''
+        self.goto(line)
+
 
-        # get devices
-        sdb_devices = map(os.path.realpath, glob('/sys/block/sd*'))
-        usb_devices = (dev for dev in sdb_devices
-                       if 'usb' in dev.split('/')[5])
-        devices = dict((os.path.basename(dev), dev) for dev in usb_devices)
+class GcodeLine(ButtonBehavior, BoxLayout):
+    ''' A line of the GcodeViewer '''
+    line_nr = NumericProperty(0)
+    gcode = StringProperty('')
+    selected = BooleanProperty(False)
 
-        # get mount points
-        output = check_output(['mount']).splitlines()
-        def is_usb(path): return any(dev in path for dev in devices)
-        usb_info = (line for line in output if is_usb(line.split()[0]))
-        print([(info.split()[0], info.split()[2]) for info in usb_info])
 
-        # create hardlink
-        for info in usb_info:
-            mnt_point = info.mnt_point
-            os.link(mnt_point, os.path.join(
-                base_dir, os.path.basename(mnt_point)))
+class LibraryRow(ButtonBehavior, BoxLayout):
+    ''' A file of the library, with its thumbnail '''
+    path = StringProperty('')
+    name = StringProperty('')
+    info = StringProperty('')
+    thumbnail = ObjectProperty(None, allownone=True)
+    selected = BooleanProperty(False)
 
 
 class PlottedGcode(RelativeLayout):
@@ -116,9 +372,17 @@ class PlottedGcode(RelativeLayout):
     def __init__(self, **kw):
         super().__init__(**kw)
         self.paths = []
+        self.scale = 1
+
+        # part of the toolpath that is already colored as executed
+        self.progress_index = None
+        self.progress_points = 0
 
         app = App.get_running_app()
         self.reader = app.gcode
+        self.terminal = app.terminal
+
+        app.machine.add_grbl_callback(self.update_progress)
 
     def do_painting(self):
         self.painter = Thread(target=self.draw_gcode_file)
@@ -133,6 +397,12 @@ class PlottedGcode(RelativeLayout):
 
         filename = self.selected_file
         _log.info(f'Calculating paths of {filename}')
+        # parsed by a worker process, which does not compete with the
+        # streaming threads, then taken from the toolpath cache
+        try:
+            parse_ahead(filename).result()
+        except Exception as e:
+            _log.error(f'parsing {filename} in the background failed: {e!r}')
         self.paths = self.reader.handle_file(filename)
         self.max_x = self.reader.max_x
         self.max_y = self.reader.max_y
@@ -157,6 +427,7 @@ class PlottedGcode(RelativeLayout):
         size_x = -min_x + max_x
         size_y = -min_y + max_y
         scale = min(self.width/size_x, self.height/size_y)
+        self.scale = scale
 
         space_opt = [1, 2, 5, 10, 20, 50, 100, 200]
         spacing = min(space_opt, key=lambda x: abs(x-size_x/4))
@@ -164,6 +435,9 @@ class PlottedGcode(RelativeLayout):
 
         self.canvas.remove_group('gcode')
         self.canvas.remove_group('grid')
+        self.canvas.remove_group('progress')
+        self.canvas.remove_group('highlight')
+        self.progress_index = None
         with self.canvas:
             # draw max, min lines and place labels
             Color(0.90, 0.90, 0.90)
@@ -224,3 +498,58 @@ class PlottedGcode(RelativeLayout):
                         (_path.points_y[i]-min_y)*scale,
                     )
                     line.points.extend(scaled_point)
+
+    def highlight_line(self, filename, line_nr):
+        ''' Mark the moves of a line of the plotted file, the line before
+        gives the start of the move '''
+        self.canvas.remove_group('highlight')
+        index = self.reader.line_index
+        if line_nr < 0 or not self.paths or not self.plotted_file or \
+                os.path.abspath(index.filename) != os.path.abspath(filename):
+            return
+
+        first, last = index.points_of_line(line_nr)
+        scale = self.scale
+        with self.canvas:
+            Color(0.95, 0.25, 0.25)
+            for _path, start, stop in index.point_ranges(first-1, last):
+                if stop - start < 2 and first > 0:
+                    continue    # only the start, in the path before
+                points = []
+                for i in range(start, stop):
+                    points.append((_path.points_x[i]-self.min_x)*scale)
+                    points.append((_path.points_y[i]-self.min_y)*scale)
+                Line(points=points, width=2.5, group='highlight')
+
+    @mainthread
+    @tracer.traced('ui.fileselector.update_progress')
+    def update_progress(self, status):
+        ''' Color the part of the toolpath that is executed by grbl. Only the
+        points completed since the last status report are drawn. '''
+        index = self.reader.line_index
+        if not self.plotted_file or not self.paths or not len(index):
+            return
+
+        done = index.points_done(self.terminal.last_job_line)
+        if index is not self.progress_index or done < self.progress_points:
+            # other file or a new job (repeat) started
+            self.canvas.remove_group('progress')
+            self.progress_index = index
+            self.progress_points = 0
+        if done <= self.progress_points:
+            return
+
+        scale = self.scale
+        with self.canvas:
+            Color(0.95, 0.75, 0.15)
+            for _path, first, last in index.point_ranges(
+                    self.progress_points, done):
+                # start at the previous point to connect to the drawn part
+                first = max(first-1, 0)
+                points = []
+                for i in range(first, last):
+                    points.append((_path.points_x[i]-self.min_x)*scale)
+                    points.append((_path.points_y[i]-self.min_y)*scale)
+                Line(points=points, width=1.5, group='progress')
+
+        self.progress_points = done
@@ -1,7 +1,4 @@
 
-# dependencies
-import ruamel.yaml
-
 # kivy imports
 from kivy.app import App
 from kivy.clock import mainthread
@@ -9,14 +6,10 @@ from kivy.properties import BooleanProperty, NumericProperty
 from kivy.uix.boxlayout import BoxLayout
 
 # submodules
+from laserinterface.datamanager.config import config_manager as config
 from laserinterface.ui.themedwidgets import ShadedBoxLayout
 
 
-yaml = ruamel.yaml.YAML()
-config_file = 'laserinterface/data/config.yaml'
-with open(config_file, 'r') as ymlfile:
-    config = yaml.load(ymlfile)
-
 # Colors in RGBA
 STATE = {
     'GREEN':  [0.2, 0.5, 0.2, 1],
@@ -29,6 +22,7 @@ STATE = {
 
 class GpioInputIcons(BoxLayout):
     temp_state = NumericProperty(99)
+    temp_found = BooleanProperty(False)     # a temperature sensor was read
     cooling_state = BooleanProperty(False)
     front_cover_state = BooleanProperty(False)
     top_cover_state = BooleanProperty(False)
@@ -63,11 +57,14 @@ class GpioInputIcons(BoxLayout):
 
     @mainthread
     def change_temp(self, temp):
-        self.temp_state = temp
+        self.temp_found = temp is not None
+        if temp is not None:
+            self.temp_state = temp
 
 
 class GpioInputLabels(ShadedBoxLayout):
     temp_state = NumericProperty(99)
+    temp_found = BooleanProperty(False)     # a temperature sensor was read
     cooling_state = BooleanProperty(False)
     front_cover_state = BooleanProperty(False)
     top_cover_state = BooleanProperty(False)
@@ -101,7 +98,9 @@ class GpioInputLabels(ShadedBoxLayout):
 
     @mainthread
     def change_temp(self, temp):
-        self.temp_state = temp
+        self.temp_found = temp is not None
+        if temp is not None:
+            self.temp_state = temp
 
 
 class GpioOutputController(ShadedBoxLayout):
@@ -4,8 +4,6 @@ from threading import Thread
 from os import path
 import logging
 import time
-import re
-import ruamel.yaml
 
 # kivy imports
 from kivy.app import App
@@ -19,14 +17,16 @@ from kivy.uix.popup import Popup
 
 # Submodules
 from laserinterface.data.grbl_doc import COMMANDS
+from laserinterface.datamanager.config import config_manager as config
+from laserinterface.datamanager.tracing import tracer
+from laserinterface.helpers.realtimelane import OVERRIDE_STEPS
+from laserinterface.helpers.toolpathcache import toolpath_cache
 from laserinterface.ui.themedwidgets import ShadedBoxLayout
 
 _log = logging.getLogger().getChild(__name__)
 
-yaml = ruamel.yaml.YAML()
-config_file = 'laserinterface/data/config.yaml'
-with open(config_file, 'r') as ymlfile:
-    config = yaml.load(ymlfile)
+# seconds after the last change the overrides follow the reports of grbl
+OVERRIDE_SETTLE = 2.0
 
 
 class JobController(ShadedBoxLayout):
@@ -47,9 +47,10 @@ class JobController(ShadedBoxLayout):
     job_active = BooleanProperty(False)
     job_duration = NumericProperty(0)
     job_progress = BoundedNumericProperty(100)
+    start_line = NumericProperty(0)
+    next_job = StringProperty('')
 
     paused = False
-    stop_sending_job = False
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -60,10 +61,21 @@ class JobController(ShadedBoxLayout):
         self.machine = app.machine
         self.grbl = app.grbl
         self.gpio = app.gpio
+        self.gcode = app.gcode
         self.callback = app.callback
+        self.jobs = app.jobs
+        # the jobs run on the primary station, so the machines screen shows
+        # and stops them
+        self.station = app.machines.primary
+        self.streamer = self.station.streamer
         self.not_zero_popup = NotAtZeroPopup(self)
 
+        # the override targets sent, shown until grbl reports them
+        self._overrides = {'feed': 100, 'power': 100}
+        self._override_time = 0
+
         self.machine.add_grbl_callback(self.update_state)
+        self.jobs.callbacks.append(self.update_queue)
 
     def set_zero(self):
         self.grbl.serial_send('G92 X0 Y0 Z0')
@@ -91,8 +103,21 @@ class JobController(ShadedBoxLayout):
         self.callback.do_callback('JOB_START')
 
         _log.info('starting job '+self.selected_file)
-        self.job_thread = Thread(target=self.send_full_file, daemon=True)
-        self.job_thread.start()
+        # grbl pulls the lines of the file, no thread is needed to send them
+        _path = path.join(config['GENERAL']['GCODE_DIR'], self.selected_file)
+        # a file parsed ahead can be resumed without previewing it first
+        toolpath = toolpath_cache.get(_path)
+        line_index = toolpath.index if toolpath else self.gcode.line_index
+        try:
+            self.station.start_job(_path, self.repeat_count,
+                                   self.start_line, line_index,
+                                   on_done=self.job_done)
+        except (OSError, RuntimeError) as e:
+            _log.error(f'Could not start the job: {e}')
+            self.callback.do_callback('JOB_STOP')
+            return
+        self.progress_timer = Clock.schedule_interval(
+            self.update_progress, 0.3)
 
         app.root.job_active = True
         self.job_active = True
@@ -112,125 +137,86 @@ class JobController(ShadedBoxLayout):
 
     def stop_job(self):
         # first reset to immediately halt the machine
-        self.stop_sending_job = True
+        self.streamer.stop()
         self.grbl.serial_send('M5')
 
-    def send_full_file(self):
-        def update_progress(dt):
-            self.job_duration = int(time.time() - start_time)
-            self.job_progress = int(size_done*100/size_total/self.repeat_count)
-
-        def finish_job(dt):
-            self.callback.do_callback('JOB_STOP')
-            _log.info('Finished sending a file.')
-            self.job_progress = 100
-            app.root.job_active = False
-            self.job_active = False
-
-        size_total = 1
-        size_done = 1
-        repeats = 0
-
-        app = App.get_running_app()
-        start_time = time.time()
-        timer = Clock.schedule_interval(update_progress, 0.3)
-
-        # keep only the first x numbers of a decimal
-        trim_nr = config['GENERAL']['TRIM_DECIMALS_TO']
-        re_decimals = re.compile(r'(\w[+-]?\d+\.\d{'+str(trim_nr)+r'})\d+')
-        # spaces and comments (**) and ;**
-        re_comments = re.compile(r'\((.*?)\)|;(.*)')
-        re_redundant = re.compile(r'\+|\s|\(.*?\)|;.*')
-
-        _path = path.join(config['GENERAL']['GCODE_DIR'], self.selected_file)
-
-        while repeats < self.repeat_count:
-            repeats += 1
-            size_total = path.getsize(_path)
-            size_done = 0
-            with open(_path, 'r') as file:
-                for line in file:
-                    if self.stop_sending_job:
-                        timer.cancel()
-                        Clock.schedule_once(finish_job, 0)
-                        self.stop_sending_job = False
-                        return
+    def update_progress(self, dt):
+        self.job_duration = int(self.streamer.duration)
+        self.job_progress = int(self.streamer.progress)
 
-                    size_done += len(line)
-                    line = line.strip().upper()
-
-                    # trim decimals:
-                    if trim_nr:
-                        line = re_decimals.sub(r'\1', line)
-
-                    # store comments to terminal, then strip them
-                    comments = re_comments.search(line)
-                    if comments:
-                        self.terminal.store_comment(comments.group(0))
-                    line = re_redundant.sub('', line)
-
-                    if line == '':
-                        continue
-
-                    # send line but wait if buffer is full. does queue three
-                    self.grbl.serial_send(line, blocking=True, queue_count=3)
-
-        # wait until all lines are received
-        while len(self.terminal.line_wait_for_ok) > 0:
-            time.sleep(0.1)
+    @mainthread
+    def job_done(self, summary):
+        # called by the sender thread when the job is finished or stopped
+        self.progress_timer.cancel()
+        self.callback.do_callback('JOB_STOP')
+        _log.info('Finished sending a file.')
+        self.job_progress = 100
+        self.start_line = 0
+        App.get_running_app().root.job_active = False
+        self.job_active = False
+        if summary:
+            self.terminal.store_comment(summary)
+        self.select_next()
+
+    def select_next(self):
+        ''' Select the next queued job, it is parsed ahead so its preview is
+        shown at once. The operator starts it, a laser never starts on its
+        own. '''
+        job = self.jobs.pop_ready()
+        if job is None:
+            return
+        self.selected_file = path.relpath(
+            job.filename, config['GENERAL']['GCODE_DIR'])
+        self.repeat_count = job.repeat_count
+        self.terminal.store_comment(f'next job: {self.selected_file}')
+        Thread(target=self.gcode.handle_file, args=(job.filename,),
+               daemon=True).start()
 
-        timer.cancel()
-        Clock.schedule_once(finish_job, 0)
+    @mainthread
+    def update_queue(self, job=None):
+        ''' Show the next queued job '''
+        job = self.jobs.next()
+        if job is None:
+            self.next_job = ''
+            return
+        name = path.basename(job.filename)
+        if job.status == 'ready':
+            self.next_job = f'{name} ({job.duration:.0f}min)'
+        else:
+            self.next_job = f'{name} ({job.status})'
+        if len(self.jobs) > 1:
+            self.next_job += f' +{len(self.jobs)-1} more'
 
     def override_power(self, command):
-        gcode = 0
-        if command == '-10':
-            gcode = COMMANDS['power -10']
-            self.power_override -= 10
-        elif command == '-1':
-            gcode = COMMANDS['power -1']
-            self.power_override -= 1
-        elif command == 'reset':
-            gcode = COMMANDS['power reset']
-            self.power_override = 100
-        elif command == '+1':
-            gcode = COMMANDS['power +1']
-            self.power_override += 1
-        elif command == '+10':
-            gcode = COMMANDS['power +10']
-            self.power_override += 10
-
-        if gcode:
-            Thread(target=self.grbl.serial_send, args=(gcode,)).start()
+        if command == 'reset':
+            self.set_override('power', 100)
+        elif command in OVERRIDE_STEPS:
+            self.set_override(
+                'power', self.power_override + OVERRIDE_STEPS[command])
 
     def override_feed(self, command):
-        gcode = 0
-        if command == '-10':
-            gcode = COMMANDS['feed -10']
-            self.feed_override -= 10
-        elif command == '-1':
-            gcode = COMMANDS['feed -1']
-            self.feed_override -= 1
-        elif command == 'reset':
-            gcode = COMMANDS['feed reset']
-            self.feed_override = 100
-        elif command == '+1':
-            gcode = COMMANDS['feed +1']
-            self.feed_override += 1
-        elif command == '+10':
-            gcode = COMMANDS['feed +10']
-            self.feed_override += 10
-
-        if gcode:
-            Thread(target=self.grbl.serial_send, args=(gcode,)).start()
+        if command == 'reset':
+            self.set_override('feed', 100)
+        elif command in OVERRIDE_STEPS:
+            self.set_override(
+                'feed', self.feed_override + OVERRIDE_STEPS[command])
+
+    def set_override(self, kind, value):
+        ''' Set the target of an override ('feed' or 'power'), quick
+        changes are coalesced into few override commands '''
+        setattr(self, f'{kind}_override', int(value))
+        value = getattr(self, f'{kind}_override')   # clamped
+        if self._overrides.get(kind) == value:
+            return
+        self._overrides[kind] = value
+        self._override_time = time.monotonic()
+        self.grbl.override(kind, value)
 
     @mainthread
+    @tracer.traced('ui.jobcontroller.update_state')
     def update_state(self, status):
         if not status.get('state'):
             return
-        if status['state'] == 'Idle' and self.job_active:
-            print('gcode is not being send fast enough!!')
-
         fs = status.get('FS')
         if fs:
             self.actual_feed = fs[0]
@@ -238,6 +224,12 @@ class JobController(ShadedBoxLayout):
         else:
             self.actual_feed = status.get('FS')
             self.actual_power = -1
+        ov = status.get('Ov')
+        if ov and time.monotonic()-self._override_time > OVERRIDE_SETTLE:
+            # after a reset of grbl, or a change by another interface
+            for kind, value in (('feed', ov[0]), ('power', ov[2])):
+                self._overrides[kind] = int(value)
+                setattr(self, f'{kind}_override', int(value))
 
 
 class NotAtZeroPopup(Popup):
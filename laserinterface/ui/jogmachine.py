@@ -1,23 +1,20 @@
 
 # dependencies
 import logging
-import ruamel.yaml
 
 # kivy imports
 from kivy.app import App
-from kivy.properties import NumericProperty
+from kivy.properties import BooleanProperty, NumericProperty
 
 # Submodules
 from laserinterface.data.grbl_doc import COMMANDS
+from laserinterface.datamanager.config import config_manager
 from laserinterface.ui.themedwidgets import ShadedBoxLayout
 
 
 _log = logging.getLogger().getChild(__name__)
 
-yaml = ruamel.yaml.YAML()
-config_file = 'laserinterface/data/config.yaml'
-with open(config_file, 'r') as ymlfile:
-    pulse_dur = yaml.load(ymlfile, )['GENERAL']['LASER_PULSE_DURATION']
+pulse_dur = config_manager['GENERAL']['LASER_PULSE_DURATION']
 
 
 class Jogger(ShadedBoxLayout):
@@ -26,6 +23,8 @@ class Jogger(ShadedBoxLayout):
 
     stepsize = NumericProperty(stepsize_range[7])
     feedrate = NumericProperty(feedrate_range[5])
+    # jog while a button is held, instead of a step per release
+    continuous = BooleanProperty(False)
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -72,8 +71,21 @@ class Jogger(ShadedBoxLayout):
         self.grbl.serial_send(gcode)
         return
 
+    def press(self, command):
+        if self.continuous:
+            command = command.upper()
+            x = 1 if '+X' in command else -1 if '-X' in command else 0
+            y = 1 if '+Y' in command else -1 if '-Y' in command else 0
+            self.grbl.jog(x, y, self.feedrate)
+
+    def release(self, command):
+        if self.continuous:
+            self.grbl.stop_jog()
+        else:
+            self.jog(command)
+
     def stop_jog(self):
-        self.grbl.serial_send(COMMANDS['cancel jog'])
+        self.grbl.stop_jog()
 
     def go_to_zero(self):
         self.grbl.serial_send(f'$J=G90X0Y0F{self.feedrate}')
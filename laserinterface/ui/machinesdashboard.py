@@ -0,0 +1,90 @@
+# dependencies
+import logging
+import os
+
+# kivy imports
+from kivy.app import App
+from kivy.clock import Clock
+from kivy.factory import Factory
+
+# submodules
+from laserinterface.datamanager.config import config_manager
+from laserinterface.datamanager.tracing import tracer
+from laserinterface.ui.themedwidgets import ShadedBoxLayout
+
+_log = logging.getLogger().getChild(__name__)
+
+
+class MachinesDashboard(ShadedBoxLayout):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # MachinesDashboard shows the state and job of every machine of the
+        # MachinePool, one row per machine. The file selected on the job
+        # screen can be queued on the other interlocked machines, the
+        # primary machine is started from the job screen. Every queued job
+        # is started by the operator, after confirming it in a popup.
+        self.machines = App.get_running_app().machines
+
+        Clock.schedule_once(self.update, 0)
+        Clock.schedule_interval(self.update, 0.5)
+
+    @tracer.traced('ui.machinesdashboard.update')
+    def update(self, dt):
+        data = []
+        for status in self.machines.status():
+            if not status['connected']:
+                state = 'not connected'
+            elif not status['interlocked']:
+                state = status['state'] + '\nno interlock'
+            else:
+                state = status['state']
+            job = os.path.basename(status['file']) or '-'
+            if status['queued']:
+                job += f" (+{status['queued']} queued)"
+            data.append({
+                'name': status['name'],
+                'port': str(status['port']),
+                'state': state,
+                'buffer_fill': status['buffer_fill'],
+                'job': job,
+                'progress': status['progress'],
+                'duration': int(status['duration']),
+                'can_queue': (status['connected'] and status['interlocked']
+                              and not status['primary']),
+                'can_start': (status['connected'] and status['interlocked']
+                              and status['queued'] > 0 and not status['file']),
+                'dashboard': self,
+            })
+        self.ids.rv.data = data
+
+    def queue_selected(self, name):
+        ''' Queue the file selected on the job screen on machine name '''
+        app = App.get_running_app()
+        selected = app.root.ids.home.ids.job_control.selected_file
+        filename = os.path.join(
+            config_manager['GENERAL']['GCODE_DIR'], selected)
+        if not os.path.isfile(filename):
+            app.root.ids.sm.current = 'job'
+            return
+        try:
+            self.machines[name].queue_job(filename)
+        except RuntimeError as e:
+            _log.error(f'Could not queue {selected}: {e}')
+        self.update(0)
+
+    def confirm_next(self, name):
+        ''' Ask the operator to confirm the next queued job of machine name '''
+        filename = self.machines[name].next_job
+        if filename is None:
+            return
+        Factory.StartNextPopup(
+            dashboard=self, name=name,
+            filename=os.path.basename(filename)).open()
+
+    def start_next(self, name):
+        ''' Start the next queued job of machine name, once confirmed '''
+        try:
+            self.machines[name].start_next()
+        except RuntimeError as e:
+            _log.error(f'Could not start the next job of {name}: {e}')
+        self.update(0)
@@ -6,6 +6,9 @@ from kivy.graphics import Line, Color
 from kivy.properties import StringProperty, NumericProperty
 from kivy.uix.relativelayout import RelativeLayout
 
+# submodules
+from laserinterface.datamanager.tracing import tracer
+
 
 class MachineView(RelativeLayout):
     state = StringProperty()
@@ -26,6 +29,10 @@ class MachineView(RelativeLayout):
         self.gpio = app.gpio
         self.gcode = app.gcode
 
+        # part of the toolpath that is already colored as executed
+        self.progress_index = None
+        self.progress_points = 0
+
         self.machine.add_grbl_callback(self.update_state)
         self.gcode.add_new_job_callback(self.update_gcode)
 
@@ -57,6 +64,7 @@ class MachineView(RelativeLayout):
                     self.grid_width*scale, self.height-i*spacing*scale))
 
     @mainthread
+    @tracer.traced('ui.machineview.update_state')
     def update_state(self, status):
         if not status.get('state'):
             return
@@ -77,8 +85,10 @@ class MachineView(RelativeLayout):
 
         if old_wco != self.wco:
             self.update_gcode()
+        self.draw_progress()
 
     @mainthread
+    @tracer.traced('ui.machineview.update_gcode')
     def update_gcode(self):
         if not self.full_report.get('WCO'):
             return False
@@ -95,6 +105,8 @@ class MachineView(RelativeLayout):
         oy = self.height/self.scale
 
         self.canvas.remove_group('gcode')
+        self.canvas.remove_group('progress')
+        self.progress_index = None
         with self.canvas:
             # draw max, min lines and place labels
             Color(0.20, 0.80, 0.90)
@@ -105,3 +117,39 @@ class MachineView(RelativeLayout):
                 (wco_x+min_x+ox)*self.scale, (wco_y+max_y+oy)*self.scale,
                 (wco_x+min_x+ox)*self.scale, (wco_y+min_y+oy)*self.scale,
             ))
+
+    def draw_progress(self):
+        ''' Draw the part of the job that is executed by grbl on the workspace.
+        Only the points completed since the last status report are added. '''
+        index = self.gcode.line_index
+        if not len(index) or not self.full_report.get('WCO'):
+            return
+
+        done = index.points_done(self.terminal.last_job_line)
+        if index is not self.progress_index or done < self.progress_points:
+            # other file or a new job (repeat) started
+            self.canvas.remove_group('progress')
+            self.progress_index = index
+            self.progress_points = 0
+        if done <= self.progress_points:
+            return
+
+        # coordinate offsets
+        ox = self.grid_width + self.full_report['WCO'][0]
+        oy = self.height/self.scale + self.full_report['WCO'][1]
+
+        with self.canvas:
+            Color(0.95, 0.75, 0.15)
+            for _path, first, last in index.point_ranges(
+                    self.progress_points, done):
+                if not _path.laser_on:
+                    continue
+                # start at the previous point to connect to the drawn part
+                first = max(first-1, 0)
+                points = []
+                for i in range(first, last):
+                    points.append((_path.points_x[i]+ox)*self.scale)
+                    points.append((_path.points_y[i]+oy)*self.scale)
+                Line(points=points, width=1.1, group='progress')
+
+        self.progress_points = done
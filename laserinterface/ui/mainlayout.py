@@ -1,24 +1,29 @@
 
 # dependencies
+from importlib import import_module
+from threading import Thread
 import logging
 import os
-import ruamel.yaml
 
 # kivy imports
 from kivy.app import App
 from kivy import resources
 from kivy.clock import Clock
-from kivy.properties import NumericProperty, StringProperty
+from kivy.factory import Factory
+from kivy.lang import Builder
+from kivy.properties import ListProperty, NumericProperty, ObjectProperty
+from kivy.properties import StringProperty
 from kivy.uix.floatlayout import FloatLayout
+from kivy.uix.screenmanager import Screen
 
 
-from laserinterface.ui.callbackdisplay import CallbackDisplay
-from laserinterface.ui.fileselector import FileSelector, PlottedGcode
+from laserinterface.datamanager.config import config_manager
+from laserinterface.datamanager.startup import profiler
+from laserinterface.datamanager.tracing import tracer
 from laserinterface.ui.gpiodisplay import GpioInputIcons
 from laserinterface.ui.gpiodisplay import GpioInputLabels
 from laserinterface.ui.gpiodisplay import GpioOutputController
 from laserinterface.ui.jobcontroller import JobController
-from laserinterface.ui.jogmachine import Jogger
 from laserinterface.ui.machineview import MachineView
 from laserinterface.ui.settings import ConnectGrbl, GrblConfig
 from laserinterface.ui.terminaldisplay import TerminalDisplay
@@ -29,10 +34,51 @@ data_dir = os.path.join(os.path.dirname(__file__), '..', 'data')
 print(data_dir)
 resources.resource_add_path(data_dir)
 
-yaml = ruamel.yaml.YAML()
-config_file = 'laserinterface/data/config.yaml'
-with open(config_file, 'r') as ymlfile:
-    grbl_buffer_size = yaml.load(ymlfile)['GRBL']['RX_BUFFER_SIZE']
+grbl_buffer_size = config_manager['GRBL']['RX_BUFFER_SIZE']
+
+# The widgets of the screens that are not shown at startup are imported when
+# their screen is shown the first time (or preloaded after the startup).
+LAZY_WIDGETS = {
+    'CallbackDisplay': 'laserinterface.ui.callbackdisplay',
+    'FileSelector': 'laserinterface.ui.fileselector',
+    'PlottedGcode': 'laserinterface.ui.fileselector',
+    'Jogger': 'laserinterface.ui.jogmachine',
+    'MachinesDashboard': 'laserinterface.ui.machinesdashboard',
+}
+for name, module in LAZY_WIDGETS.items():
+    Factory.register(name, module=module)
+
+kv_dir = os.path.join(os.path.dirname(__file__), 'kv')
+loaded_kv_files = set()
+
+
+def preload_screens():
+    ''' Import the modules of the lazy screens in the background, so showing
+    them the first time only builds the widgets '''
+    with profiler.phase('preload screen modules'):
+        for module in set(LAZY_WIDGETS.values()):
+            import_module(module)
+
+
+class LazyScreen(Screen):
+    ''' Screen that builds its content when it is shown the first time.
+    content is the name of the widget class, its rules are in kv_files. '''
+    content = StringProperty()
+    kv_files = ListProperty()
+    widget = ObjectProperty(None, allownone=True)
+
+    def on_pre_enter(self, *args):
+        if self.widget is None:
+            self.build()
+
+    def build(self):
+        with profiler.phase(f'build screen {self.name}'):
+            for kv_file in self.kv_files:
+                if kv_file not in loaded_kv_files:
+                    Builder.load_file(os.path.join(kv_dir, kv_file))
+                    loaded_kv_files.add(kv_file)
+            self.widget = Factory.get(self.content)()
+            self.add_widget(self.widget)
 
 
 # main layout with topbar and screenmanager
@@ -56,21 +102,29 @@ class MainLayout(FloatLayout):
         self.connectgrbl = ConnectGrbl()
         self.connectgrbl.grbl = self.grbl
 
-        if not self.grbl.connect():
-            Clock.schedule_once(self.connectgrbl.open, 0)
+        # grbl resets when connecting, so it is done in the background
+        Thread(target=self.connect_grbl, daemon=True).start()
 
         self.machine.add_grbl_callback(self.update_state)
         Clock.schedule_interval(self.update_properties, 0.05)
 
+    def connect_grbl(self):
+        with profiler.phase('connect grbl'):
+            App.get_running_app().machines.connect()
+        if not self.grbl.connected:
+            Clock.schedule_once(self.connectgrbl.open, 0)
+
     def open_grblconnect(self):
         self.connectgrbl.open()
 
     def open_grblconfig(self):
         self.grblconfig.open()
 
+    @tracer.traced('ui.mainlayout.update_properties')
     def update_properties(self, dt):
-        self.grbl_buffer = sum(self.grbl.chars_in_buffer.queue)
+        self.grbl_buffer = self.grbl.buffer_fill
 
+    @tracer.traced('ui.mainlayout.update_state')
     def update_state(self, report):
         self.grbl_state = report.get('state', '??')
         self.ids.resume_btn.visible = (self.grbl_state == 'Hold:0')
@@ -1,7 +1,6 @@
 
 # dependencies
 import logging
-import ruamel.yaml
 import serial
 import serial.tools.list_ports
 
@@ -12,13 +11,11 @@ from kivy.uix.button import Button
 from kivy.uix.popup import Popup
 
 from laserinterface.data.grbl_doc import CONFIG
+from laserinterface.datamanager.config import config_manager
 
 _log = logging.getLogger().getChild(__name__)
 
-yaml = ruamel.yaml.YAML()
-config_file = 'laserinterface/data/config.yaml'
-with open(config_file, 'r') as ymlfile:
-    config = yaml.load(ymlfile, )['GRBL']
+config = config_manager['GRBL']
 
 
 class ConnectGrbl(Popup):
@@ -77,11 +74,7 @@ class ConnectGrbl(Popup):
 
         if self.grbl.connected:
             self.connect_state = 'connected succesful'
-            with open(config_file, 'r') as ymlfile:
-                full_config = yaml.load(ymlfile)
-            full_config['GRBL']['PORT'] = port
-            with open(config_file, 'w') as ymlfile:
-                yaml.dump(full_config, ymlfile)
+            config_manager.update('GRBL', 'PORT', port)
         else:
             self.connect_state = 'Connection failed'
 
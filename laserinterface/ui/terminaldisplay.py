@@ -8,6 +8,7 @@ from kivy.clock import mainthread, Clock
 from kivy.properties import BooleanProperty
 
 # submodules
+from laserinterface.datamanager.tracing import tracer
 from laserinterface.ui.themedwidgets import ShadedBoxLayout
 
 _log = logging.getLogger().getChild(__name__)
@@ -34,6 +35,7 @@ class TerminalDisplay(ShadedBoxLayout):
         self.update_terminal()
 
     @mainthread
+    @tracer.traced('ui.terminaldisplay.update_terminal')
     def update_terminal(self):
         lines = self.terminal.get_all_lines(verbose=self.show_verbose)
         data = []